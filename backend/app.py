@@ -1,20 +1,32 @@
+import json
 import os
-from typing import Any
-from flask import Flask, request, send_from_directory, session
+from typing import Any, Callable, Iterator
+from flask import Flask, Response, request, send_from_directory, session
 from bot.irc import OsuIrc
+from bot.metrics import render
 from bot.roommanager import RoomManager
-from bot.room import Room
-from bot.beatmap import RoomBeatmap
-from bot.enums import BOT_MODE, TEAM_MODE, SCORE_MODE, PLAY_MODE, RANK_STATUS, RoomData
+from bot.workers import WORKER_TIMEOUT, RoomWorkerPool, WorkerTimeoutError
+from bot.enums import (
+    BOT_MODE,
+    TEAM_MODE,
+    SCORE_MODE,
+    PLAY_MODE,
+    RANK_STATUS,
+    MessageResponse,
+    RoomData,
+    RoomQuery,
+)
 from flask_cors import CORS
 from bot.helpers import (
-    parse_room_data,
     extract_enum,
+    get_extra_credentials,
     get_user_credentials,
     is_password_valid,
     is_username_valid,
+    parse_fields,
+    parse_room_query,
 )
-from app_enums import BotEnums, LoginResponse, MessageResponse, Session
+from app_enums import BotEnums, LoginResponse, Session
 from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
 
 
@@ -23,71 +35,64 @@ app.secret_key = os.environ.get("SECRET_KEY", "BAD_SECRET_KEY")
 cors = CORS(app, resources={r"/*": {"origins": "*"}}, supports_credentials=True)
 
 credentials = get_user_credentials()
+accounts = [credentials, *get_extra_credentials()]
 
-irc = OsuIrc(username=credentials.get("username", ""), password=credentials.get("password", ""))
-
-roommanager = RoomManager(irc=irc)
-
-
-def create_room(data: Any) -> tuple[RoomData | MessageResponse, int]:
-    try:
-        parse_room_data(data)
-    except Exception as e:
-        return {"message": str(e)}, 400
-
-    data["irc"] = irc
-    data["beatmap"] = RoomBeatmap(**data.pop("beatmap"))
-    room = Room(**data)
-    new_room = roommanager.add_room(room)
-    new_room.create()
-
-    return new_room.get_json(), 201
-
-
-def update_room(unique_id: str, data: Any) -> tuple[MessageResponse | RoomData, int]:
-    if not unique_id:
-        return {"message": "Missing room_id on data"}, 400
-
-    try:
-        parse_room_data(data)
-    except Exception as e:
-        return {"message": str(e)}, 400
-
-    room = roommanager.get_room(unique_id=unique_id)
+roommanager: RoomManager | RoomWorkerPool
 
-    if not room:
-        return {"message": "No room found!"}, 400
+if os.environ.get("ROOM_WORKERS") == "True":
+    # one worker process per account, see bot/workers.py
+    roommanager = RoomWorkerPool(accounts=accounts)
+else:
+    irc = OsuIrc(
+        username=credentials.get("username", ""),
+        password=credentials.get("password", ""),
+    )
+    roommanager = RoomManager(irc=irc)
 
-    room.configure(**data)
+    for account in accounts[1:]:
+        roommanager.add_shard(
+            OsuIrc(username=account["username"], password=account["password"])
+        )
 
-    return room.get_json(), 200
 
+@app.errorhandler(WorkerTimeoutError)
+def worker_timeout(error: WorkerTimeoutError) -> tuple[MessageResponse, int]:
+    """a room worker process is stuck or overloaded, the request may be retried"""
+    return WORKER_TIMEOUT, 503
 
-def delete_room(room_unique_id: str) -> tuple[MessageResponse | RoomData, int]:
-    if not session.get("is_admin"):
-        return {"message": "You are not Authorized user!"}, 401
-
-    if not room_unique_id:
-        return {"message": "Missing room_id"}, 400
 
-    room = roommanager.get_room(unique_id=room_unique_id)
+def json_response(etag: str, dump: Callable[[], str | None]) -> Response:
+    """serialized json with an ETag, 304 without serializing anything when the client has it already"""
+    if etag and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    elif (data := dump()) is not None:
+        response = app.response_class(data, mimetype="application/json")
+    else:
+        return app.response_class(
+            '{"message":"No room found"}', status=400, mimetype="application/json"
+        )
 
-    if not room:
-        return {"message": "No room found!"}, 400
+    if etag:
+        response.set_etag(etag)
 
-    room.send_close()
-    roommanager.remove_room(room)
-
-    return {"message": "Room has been deleted"}, 204
+    return response
 
 
 @app.route("/room", methods=["GET", "POST", "DELETE", "PUT"])
-def room() -> tuple[MessageResponse | RoomData | list[RoomData], int]:
-    if not irc.is_running:
+def room() -> Response | tuple[MessageResponse | RoomData, int]:
+    if not roommanager.is_running:
         return {"message": "Irc is not running..."}, 400
 
     if request.method == "GET":
-        return roommanager.get_rooms_json(), 200
+        try:
+            query = parse_room_query(request.args)
+        except ValueError as e:
+            return {"message": str(e)}, 400
+
+        return json_response(
+            roommanager.get_rooms_etag(query=query),
+            lambda: roommanager.dump_rooms_json(query),
+        )
 
     if request.method == "POST":
         print(session)
@@ -95,32 +100,79 @@ def room() -> tuple[MessageResponse | RoomData | list[RoomData], int]:
         if not session.get("is_admin"):
             return {"message": "You are not Authorized user!"}, 401
 
-        return create_room(request.get_json())
+        return roommanager.create_room(request.get_json())
 
     return {"message": "Wrong Method!"}, 400
 
 
+@app.route("/room/events")
+def room_events() -> Response | tuple[MessageResponse, int]:
+    """server-sent events, a snapshot of every room and then the changes to them as deltas"""
+    if not roommanager.is_running:
+        return {"message": "Irc is not running..."}, 400
+
+    publisher = roommanager.publisher
+    subscriber = (
+        publisher.subscribe()
+    )  # before the snapshot so no change falls in between
+
+    try:
+        rooms_json = roommanager.dump_rooms_json()
+    except Exception:
+        publisher.unsubscribe(
+            subscriber
+        )  # or the workers would keep forwarding events for nobody
+        raise
+
+    publisher.seed(json.loads(rooms_json))
+    snapshot = f"event: snapshot\ndata: {rooms_json}\n\n"
+
+    def stream() -> Iterator[str]:
+        try:
+            yield snapshot
+            yield from subscriber.stream()
+        finally:
+            publisher.unsubscribe(subscriber)
+
+    return app.response_class(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/metrics")
+def metrics_view() -> Response:
+    """Prometheus text format, the metrics are only formatted when scraped"""
+    return app.response_class(
+        render(roommanager.collect_metrics()), content_type="text/plain; version=0.0.4"
+    )
+
+
 @app.route("/room/<room_unique_id>", methods=["GET", "PUT", "DELETE"])
-def room_view(room_unique_id: str) -> tuple[MessageResponse | RoomData, int]:
-    if not irc.is_running:
+def room_view(room_unique_id: str) -> Response | tuple[MessageResponse | RoomData, int]:
+    if not roommanager.is_running:
         return {"message": "Irc is not running..."}, 400
 
     if request.method == "GET":
-        room = roommanager.get_room(unique_id=room_unique_id)
-
-        if not room:
-            return {"message": "No room found"}, 400
+        try:
+            fields = parse_fields(request.args.get("fields", ""))
+        except ValueError as e:
+            return {"message": str(e)}, 400
 
-        return room.get_json(), 200
+        etag = roommanager.get_rooms_etag(room_unique_id, RoomQuery(fields=fields))
+        return json_response(
+            etag, lambda: roommanager.dump_room_json(room_unique_id, fields)
+        )
 
     if not session.get("is_admin"):
         return {"message": "You are not Authorized user!"}, 401
 
     if request.method == "PUT":
-        return update_room(room_unique_id, request.get_json())
+        return roommanager.update_room(room_unique_id, request.get_json())
 
     if request.method == "DELETE":
-        return delete_room(room_unique_id)
+        return roommanager.delete_room(room_unique_id)
 
     return {"message": "Wrong Method"}, 400
 
@@ -130,10 +182,9 @@ def start_irc() -> Any:
     if not session.get("is_admin"):
         return {"message": "You are not Authorized user!"}, 401
 
-    if irc.is_running:
+    if roommanager.is_running:
         return {"message": "IRC is already running..."}, 400
 
-    irc.start()
     roommanager.start(run_on_thread=True)
     return {"message": "IRC is now running..."}, 200
 
@@ -143,7 +194,7 @@ def stop_irc() -> tuple[MessageResponse, int]:
     if not session.get("is_admin"):
         return {"message": "You are not Authorized user!"}, 401
 
-    irc.stop()
+    roommanager.stop()
     return {"message": "IRC is now stopped..."}, 200
 
 
@@ -166,7 +217,7 @@ def login() -> tuple[LoginResponse | MessageResponse, int]:
     return {
         "message": "ok",
         "is_admin": True,
-        "is_irc_running": irc.is_running,
+        "is_irc_running": roommanager.is_running,
         "username": username,
     }, 200
 
@@ -185,7 +236,7 @@ def get_session() -> Session:
     return {
         "username": session.get("username", ""),
         "is_admin": session.get("is_admin") is True,
-        "is_irc_running": irc.is_running,
+        "is_irc_running": roommanager.is_running,
     }
 
 
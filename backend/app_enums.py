@@ -1,4 +1,5 @@
 from typing import TypedDict
+from bot.enums import MessageResponse
 
 
 class BotEnums(TypedDict):
@@ -17,9 +18,5 @@ class Session(TypedDict):
     is_irc_running: bool
 
 
-class MessageResponse(TypedDict):
-    message: str
-
-
 class LoginResponse(MessageResponse, Session):
     pass
@@ -0,0 +1,129 @@
+"""
+Memory kept per parsed irc line, measured with tracemalloc, for the old MessageDict against the
+IrcMessage record, and the cost of the RoomManager receive path before and after QUIT and
+non #mp_ traffic is rejected ahead of parsing and debug logging.
+
+usage: python -m benchmarks.bench_allocations [irc log, one raw line per line]
+"""
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+from bot.irc import OsuIrc
+from bot.parsers import parse_message, peek_message
+from bot.roommanager import RoomManager
+from my_logger import formatter, logger
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "data", "lobby_traffic.txt")
+REPEAT = 200
+
+
+def legacy_parse_message(message: str) -> Optional[dict[str, str]]:
+    """parse_message before IrcMessage"""
+    words = message.strip().split(" ")
+
+    if len(words) < 3 or not message.startswith(":"):
+        return None
+
+    sender = words[0][1:].rstrip("!cho@ppy.sh!cho@cho.ppy.sh")
+    command = words[1]
+    channel = words[2]
+    message = " ".join(words[3:])
+
+    if command in {"JOIN", "PART", "QUIT"}:
+        channel = ""
+        message = " ".join(words[2:])
+
+    return dict(
+        sender=sender, command=command, channel=channel, message=message.lstrip(":")
+    )
+
+
+def legacy_receive(message: str) -> None:
+    """the front of RoomManager.on_message_receive before the early reject, without room dispatch"""
+    message_dict = legacy_parse_message(message)
+
+    if not message_dict:
+        return
+
+    if message_dict.get("command") != "QUIT":
+        logger.debug(message_dict)
+
+
+def measure_records(
+    parse: Callable[[str], Any], lines: list[str]
+) -> tuple[float, float]:
+    """bytes and blocks kept alive per parsed line"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    records = [parse(line) for line in lines]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    size = sum(stat.size_diff for stat in stats) - sys.getsizeof(records)
+    blocks = sum(stat.count_diff for stat in stats) - 1
+    return size / len(lines), blocks / len(lines)
+
+
+def measure_receive(receive: Callable[[str], None], lines: list[str]) -> float:
+    """microseconds per line going through the receive path"""
+    started = time.perf_counter()
+
+    for line in lines:
+        receive(line)
+
+    return (time.perf_counter() - started) / len(lines) * 1e6
+
+
+def main() -> None:
+    with open(
+        sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CORPUS, "r", encoding="utf-8"
+    ) as f:
+        lines = [line.rstrip("\r\n") for line in f if line.strip()] * REPEAT
+
+    # keep debug formatting on like my_logger does, but write it nowhere
+    devnull = open(os.devnull, "w")
+    handler = logging.StreamHandler(devnull)
+    handler.setFormatter(formatter)
+    handlers = logger.handlers[:]
+    logger.handlers = [handler]
+
+    manager = RoomManager(irc=OsuIrc(username="bench", password="bench"))
+    print(f"{len(lines):,} lines")
+
+    for name, parse in [
+        ("MessageDict", legacy_parse_message),
+        ("IrcMessage", parse_message),
+    ]:
+        size, blocks = measure_records(parse, lines)
+        print(f"{name:>12} record: {size:>6.0f} B {blocks:>5.1f} blocks per line")
+
+    relevant = sum(1 for line in lines if is_parsed(manager, line))
+
+    receivers: list[tuple[str, Callable[[str], None], int]] = [
+        ("before", legacy_receive, len(lines)),
+        ("after", manager.on_message_receive, relevant),
+    ]
+
+    for name, receive, parsed in receivers:
+        micros = measure_receive(receive, lines)
+        print(
+            f"{name:>12} receive: {micros:>6.2f} us per line, {parsed:,} lines parsed and logged"
+        )
+
+    logger.handlers = handlers
+    devnull.close()
+
+
+def is_parsed(manager: RoomManager, line: str) -> bool:
+    command, channel = peek_message(line)
+    return command != "QUIT" and (
+        channel.startswith("#mp_") or channel == manager.irc.username
+    )
+
+
+if __name__ == "__main__":
+    main()
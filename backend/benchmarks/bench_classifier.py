@@ -0,0 +1,127 @@
+"""
+Lines per second classifying BanchoBot lines, the old Room.on_message_receive if/elif chain
+(with the parse_slot of the time) against bot.classifier.
+
+usage: python -m benchmarks.bench_classifier [irc log, one raw line per line]
+"""
+import os
+import re
+import sys
+import timeit
+from typing import Any
+from bot.classifier import classify_bancho_message
+from bot.constants import VALID_ROLES
+from bot.enums import SlotInfo
+from bot.parsers import get_beatmap_id_from_url, normalize_username, parse_message
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), "data", "lobby_traffic.txt")
+
+
+def legacy_parse_slot(message: str) -> SlotInfo:
+    """bot.parsers.parse_slot before it split around the url"""
+    message_words = message.split()
+    slot = message_words[1]
+
+    if message_words[2] != "Ready":
+        status = " ".join(message_words[2:4])
+        url = message_words[4]
+        user_roles = " ".join(message_words[5:])
+    else:
+        status = message_words[2]
+        url = message_words[3]
+        user_roles = " ".join(message_words[4:])
+
+    username = user_roles
+    roles = []
+    start_roles_index = user_roles.rfind("[")
+
+    if user_roles.endswith("]") and start_roles_index != -1:
+        roles = user_roles[start_roles_index + 1 : -1].replace(" ", "").split("/")
+        roles = roles[:-1] + roles[-1].split(",")
+
+        if any(role.strip() not in VALID_ROLES for role in roles):
+            roles = []
+        else:
+            username = user_roles[: start_roles_index - 1]
+
+    username = username.strip().replace(" ", "_")
+    user_id = url.split("/")[-1]
+
+    return SlotInfo(
+        slot=int(slot) if slot.isdigit() else 0,
+        status=status,
+        user_id=user_id,
+        username=username,
+        roles=roles,
+    )
+
+
+def legacy_classify(message: str) -> Any:
+    """the classification part of Room.on_message_receive before bot.classifier"""
+    if message == "Closed the match":
+        return "closed"
+    elif "joined in slot" in message:
+        return normalize_username(message.split(" joined in slot")[0])
+    elif message.endswith("left the game."):
+        return normalize_username(message.split(" left the game.")[0])
+    elif message.endswith(" became the host."):
+        return normalize_username(message.split(" became the host.")[0])
+    elif message == "The match has started!":
+        return "started"
+    elif message == "The match has finished!":
+        return "finished"
+    elif message == "All players are ready":
+        return "ready"
+    elif message.startswith("Beatmap changed to: "):
+        search = re.search("Beatmap.*?: (.*)? \\[(.*?)\\] \\((.*)?\\)", message)
+        return search and int(search.group(3).split("/")[-1])
+    elif message.startswith("Changed beatmap to "):
+        message_split = message.split(" ")
+        return "".join(message_split[4:]), get_beatmap_id_from_url(message_split[3])
+    elif message.startswith("Slot "):
+        return legacy_parse_slot(message)
+    elif message.startswith("Players: "):
+        return int(message.split(" ")[-1])
+    return None
+
+
+def load_bancho_messages(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        parsed = [parse_message(line) for line in f]
+
+    return [
+        message.message
+        for message in parsed
+        if message and message.sender == "BanchoBot"
+    ]
+
+
+def main() -> None:
+    messages = load_bancho_messages(
+        sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CORPUS
+    )
+    rounds = 20
+    number = max(1, 10000 // len(messages))
+    print(
+        f"{len(messages)} BanchoBot lines x {number}, best of {rounds} alternating rounds"
+    )
+    classifiers = {
+        "if/elif chain": legacy_classify,
+        "classifier": classify_bancho_message,
+    }
+    best = dict.fromkeys(classifiers, float("inf"))
+
+    # alternated rather than one after the other, so a noisy stretch of the machine affects both
+    for _ in range(rounds):
+        for name, classify in classifiers.items():
+            seconds = timeit.timeit(
+                lambda: [classify(message) for message in messages], number=number
+            )
+            best[name] = min(best[name], seconds)
+
+    for name, seconds in best.items():
+        print(f"{name:>14}: {len(messages) * number / seconds:>12,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
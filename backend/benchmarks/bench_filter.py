@@ -0,0 +1,161 @@
+"""
+Time to pick the first passing map of every beatmapset of a search page: the per map
+get_beatmap_errors loop RoomBeatmap used before bot.beatmapfilter, which formats every error
+message, against one vectorized BeatmapFilter pass, with and without building the page columns
+(SearchPool builds them once per page for every room sharing it).
+
+usage: python -m benchmarks.bench_filter [pages, default 200]
+"""
+import random
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any
+from bot.beatmap import RoomBeatmap
+from bot.beatmapfilter import BeatmapColumns, make_beatmap
+from bot.enums import PLAY_MODE, RANK_STATUS
+
+SETS_PER_PAGE = 50  # osu! search page size
+
+
+def build_page(rng: random.Random) -> list[Any]:
+    beatmapsets = []
+
+    for _ in range(SETS_PER_PAGE):
+        beatmaps = [
+            make_beatmap(
+                difficulty_rating=round(rng.uniform(1, 8), 2),
+                ar=round(rng.uniform(5, 10), 1),
+                cs=round(rng.uniform(2, 6), 1),
+                bpm=rng.randint(100, 260),
+                total_length=rng.randint(60, 400),
+                mode_int=rng.choice([0, 0, 0, 1, 3]),
+                mode=SimpleNamespace(name="OSU"),
+            )
+            for _ in range(rng.randint(1, 10))
+        ]
+
+        for beatmap in beatmaps:
+            beatmap.ranked = rng.choice(list(RANK_STATUS))
+
+        beatmaps.sort(
+            key=lambda beatmap: float(beatmap.difficulty_rating), reverse=True
+        )
+        beatmapsets.append(SimpleNamespace(beatmaps=beatmaps))
+
+    return beatmapsets
+
+
+def legacy_get_beatmap_errors(room_beatmap: RoomBeatmap, beatmap: Any) -> list[str]:
+    """get_beatmap_errors before BeatmapFilter, every message is formatted up front"""
+    rank_status = " | ".join([rank.name for rank in room_beatmap.rank_status])
+    error_checks = [
+        (
+            f"Play Mode {beatmap.mode.name} != {room_beatmap.play_mode.name}",
+            beatmap.mode_int == room_beatmap.play_mode,
+        ),
+        (
+            f"Star {beatmap.difficulty_rating} != {room_beatmap.star[0]}-{room_beatmap.star[1]}*",
+            room_beatmap.check_star(beatmap.difficulty_rating),
+        ),
+        (
+            f"Rank Status {beatmap.ranked.name} != [{rank_status}]",
+            beatmap.ranked.value
+            in [status.value for status in room_beatmap.rank_status],
+        ),
+        (
+            f"AR {beatmap.ar} != {room_beatmap.ar[0]}-{room_beatmap.ar[1]}",
+            room_beatmap.check_ar(beatmap.ar),
+        ),
+        (
+            f"BPM {beatmap.bpm} != {room_beatmap.bpm[0]}-{room_beatmap.bpm[1]}",
+            room_beatmap.check_bpm(beatmap.bpm),
+        ),
+        (
+            f"Length {beatmap.total_length} != {room_beatmap.length[0]}-{room_beatmap.length[1]}",
+            room_beatmap.check_length(beatmap.total_length),
+        ),
+        (
+            f"CS {beatmap.cs} != {room_beatmap.cs[0]}-{room_beatmap.cs[1]}",
+            room_beatmap.check_cs(beatmap.cs),
+        ),
+    ]
+    return [error for error, is_valid in error_checks if not is_valid]
+
+
+def legacy_pick(
+    room_beatmap: RoomBeatmap, page: list[Any], columns: BeatmapColumns
+) -> list[Any]:
+    picked = []
+
+    for beatmapset in page:
+        for beatmap in beatmapset.beatmaps:
+            if not legacy_get_beatmap_errors(room_beatmap, beatmap):
+                picked.append(beatmap)
+                break
+
+    return picked
+
+
+def columnar_pick(
+    room_beatmap: RoomBeatmap, page: list[Any], columns: BeatmapColumns
+) -> list[Any]:
+    columns = BeatmapColumns.from_beatmapsets(page)
+    return [
+        columns.beatmaps[row]
+        for row in room_beatmap.get_filter().get_first_rows(columns)
+    ]
+
+
+def filter_pick(
+    room_beatmap: RoomBeatmap, page: list[Any], columns: BeatmapColumns
+) -> list[Any]:
+    return [
+        columns.beatmaps[row]
+        for row in room_beatmap.get_filter().get_first_rows(columns)
+    ]
+
+
+def main() -> None:
+    rng = random.Random(0)
+    pages = [
+        build_page(rng) for _ in range(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
+    ]
+    columns = [BeatmapColumns.from_beatmapsets(page) for page in pages]
+    beatmaps = sum(len(page_columns) for page_columns in columns)
+    print(f"{len(pages)} pages, {beatmaps:,} beatmaps")
+
+    # placeholders up to the high-water mark keep RoomBeatmap from searching the osu! api
+    room_beatmap = RoomBeatmap(
+        play_mode=PLAY_MODE.OSU,
+        star=(4.0, 6.0),
+        bpm=(120, 200),
+        rank_status=[RANK_STATUS.RANKED, RANK_STATUS.LOVED],
+        beatmap_list=[
+            SimpleNamespace(id=index) for index in range(RoomBeatmap.high_water_mark)
+        ],
+    )
+    expected: list[Any] = []
+
+    for name, pick in [
+        ("per map", legacy_pick),
+        ("columns + filter", columnar_pick),
+        ("filter only", filter_pick),
+    ]:
+        started = time.perf_counter()
+        picked = [
+            beatmap
+            for page, page_columns in zip(pages, columns)
+            for beatmap in pick(room_beatmap, page, page_columns)
+        ]
+        elapsed = time.perf_counter() - started
+
+        expected = expected or picked
+        note = "" if picked == expected else " (picked different maps)"
+        print(
+            f"{name:>16}: {elapsed / len(pages) * 1e6:>8.1f} us per page, {len(picked):,} maps picked{note}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Throughput of splitting a synthetic irc stream into lines at several recv buffer sizes:
+the original decode + split of every recv chunk, asyncio StreamReader.readline as OsuIrc
+used it before bot.framing, and StreamReader.read feeding a LineFramer as OsuIrc does now.
+
+usage: python -m benchmarks.bench_framing [stream size in MB, default 100]
+"""
+import asyncio
+import random
+import sys
+import time
+from typing import Callable
+from bot.framing import LineFramer
+
+BUFFER_SIZES = [2048, 16 * 1024, 64 * 1024, 256 * 1024]
+SAMPLE_LINES = [
+    ":BanchoBot!cho@ppy.sh PRIVMSG #mp_108 :Some Player joined in slot 3.",
+    ":BanchoBot!cho@ppy.sh PRIVMSG #mp_108 :Slot 1  Not Ready https://osu.ppy.sh/u/2 Some Player  [Host / Hidden]",
+    ":Some_Player!cho@ppy.sh PRIVMSG #mp_108 :!skip",
+    ":Другой_игрок!cho@ppy.sh PRIVMSG #mp_108 :привет всем",
+    ":プレイヤー!cho@ppy.sh PRIVMSG #mp_108 :こんにちは、よろしく",
+    ":Someone!cho@ppy.sh QUIT :ping timeout 80s",
+    ":Someone!cho@ppy.sh JOIN :#osu",
+    "PING :cho.ppy.sh",
+]
+
+
+def build_stream(size: int) -> tuple[bytes, int]:
+    rng = random.Random(0)
+    lines = [f"{rng.choice(SAMPLE_LINES)}\r\n".encode() for _ in range(4096)]
+    block = b"".join(lines)
+    repeat = max(1, size // len(block))
+    return block * repeat, len(lines) * repeat
+
+
+def legacy_split(chunks: list[bytes]) -> int:
+    """the old message_generator framing, errors="replace" so split characters don't stop the run"""
+    total = 0
+    buffer = ""
+
+    for chunk in chunks:
+        messages = f"{buffer}{chunk.decode(errors='replace')}".split("\n")
+        buffer = messages[-1]
+        total += len(messages) - 1
+
+    return total
+
+
+def framer_split(chunks: list[bytes]) -> int:
+    framer = LineFramer()
+    return sum(len(framer.feed(chunk)) for chunk in chunks)
+
+
+async def feed_reader(reader: asyncio.StreamReader, chunks: list[bytes]) -> None:
+    for chunk in chunks:
+        reader.feed_data(chunk)
+        await asyncio.sleep(0)
+
+    reader.feed_eof()
+
+
+def readline_split(chunks: list[bytes]) -> int:
+    async def run() -> int:
+        reader = asyncio.StreamReader()
+        feeder = asyncio.create_task(feed_reader(reader, chunks))
+        total = 0
+
+        while line := await reader.readline():
+            line.decode(errors="replace").rstrip("\r\n")
+            total += 1
+
+        await feeder
+        return total
+
+    return asyncio.run(run())
+
+
+def reader_framer_split(chunks: list[bytes]) -> int:
+    async def run() -> int:
+        reader = asyncio.StreamReader(limit=len(chunks[0]))
+        feeder = asyncio.create_task(feed_reader(reader, chunks))
+        framer = LineFramer()
+        total = 0
+
+        while data := await reader.read(len(chunks[0])):
+            total += len(framer.feed(data))
+
+        await feeder
+        return total
+
+    return asyncio.run(run())
+
+
+def measure(
+    split: Callable[[list[bytes]], int], chunks: list[bytes], size: int
+) -> tuple[float, int]:
+    started = time.perf_counter()
+    lines = split(chunks)
+    return size / (time.perf_counter() - started) / 1024 / 1024, lines
+
+
+def main() -> None:
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 100) * 1024 * 1024
+    stream, expected = build_stream(size)
+    print(f"{len(stream) / 1024 / 1024:.0f} MB, {expected:,} lines")
+
+    for buffer_size in BUFFER_SIZES:
+        view = memoryview(stream)
+        chunks = [
+            bytes(view[index : index + buffer_size])
+            for index in range(0, len(stream), buffer_size)
+        ]
+
+        for name, split in [
+            ("decode + split", legacy_split),
+            ("readline", readline_split),
+            ("read + framer", reader_framer_split),
+            ("framer only", framer_split),
+        ]:
+            throughput, lines = measure(split, chunks, len(stream))
+            note = "" if lines == expected else f" ({lines:,} lines)"
+            print(f"{buffer_size:>7} B {name:>14}: {throughput:>8,.0f} MB/s{note}")
+
+        del view, chunks
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Cold import time of the bot modules, each in a fresh interpreter the way app.py, tests and
+room worker processes start. Nothing may reach the osu! api while importing, so CLIENT_ID and
+CLIENT_SECRET are cleared: an import that needs the api fails here instead of being timed.
+
+usage: python -m benchmarks.bench_import [runs per module, default 5]
+"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = [
+    "bot.osuapi",
+    "bot.beatmapcache",
+    "bot.beatmap",
+    "bot.room",
+    "bot.roommanager",
+    "bot.workers",
+    "app",
+]
+
+
+def time_import(module: str, env: dict[str, str], runs: int) -> float | None:
+    """median seconds, None when the import fails"""
+    timings = []
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", f"import {module}"], env=env, capture_output=True
+        )
+
+        if result.returncode:
+            return None
+
+        timings.append(time.perf_counter() - started)
+
+    return statistics.median(timings)
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    env = {
+        key: value
+        for key, value in os.environ.items()
+        if key not in ("CLIENT_ID", "CLIENT_SECRET")
+    }
+    env.update(
+        USERNAME="bench", PASSWORD="bench"
+    )  # app.py needs bancho credentials, it doesn't connect
+
+    startup = time_import("sys", env, runs) or 0.0
+    print(
+        f"{'module':>18} {'ms':>8}  (interpreter startup {startup * 1e3:.0f} ms included)"
+    )
+
+    for module in MODULES:
+        seconds = time_import(module, env, runs)
+        print(
+            f"{module:>18} {'failed' if seconds is None else f'{seconds * 1e3:.0f}':>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Local BeatmapIndex queries against paging the plays_desc search until enough maps pass, for
+loose and tight room filters over synthetic search pages. The page count is the number of
+osu! api round trips generate_beatmaps needed before the index. Then every page is added
+again, as rooms searching the same sets would, to check the index doesn't grow and to time how
+long add_page waits while a query rebuilds it.
+
+usage: python -m benchmarks.bench_index [beatmapsets, default 20000]
+"""
+import random
+import statistics
+import sys
+import threading
+import time
+from typing import Any
+from benchmarks.bench_filter import SETS_PER_PAGE, build_page
+from bot.beatmapfilter import BeatmapColumns, BeatmapFilter
+from bot.beatmapindex import BeatmapIndex
+from bot.enums import RANK_STATUS
+
+WANTED = 6  # RoomBeatmap.high_water_mark
+REPEAT = 200
+FILTERS = {
+    "loose": BeatmapFilter(
+        0, (0, 10), (0, 10), (0, 10), (0, 300), (0, 1000), frozenset(RANK_STATUS)
+    ),
+    "5.5-6.5*": BeatmapFilter(
+        0, (5.5, 6.5), (0, 10), (0, 10), (0, 300), (0, 1000), frozenset({1, 2, 4})
+    ),
+    "tight": BeatmapFilter(
+        0, (5.5, 6.5), (9, 10), (0, 10), (170, 200), (120, 240), frozenset({1, 2})
+    ),
+}
+
+
+def pages_needed(
+    pages: list[tuple[list[Any], BeatmapColumns]], beatmap_filter: BeatmapFilter
+) -> int:
+    found = 0
+
+    for index, (_, columns) in enumerate(pages, start=1):
+        found += len(beatmap_filter.get_first_rows(columns))
+
+        if found >= WANTED:
+            return index
+
+    return len(pages)
+
+
+def readd(index: BeatmapIndex, pages: list[tuple[list[Any], BeatmapColumns]]) -> None:
+    for beatmapsets, columns in pages:
+        index.add_page(beatmapsets, columns)
+
+    waits = []
+    building = threading.Thread(target=index.get_index)
+    building.start()
+
+    while building.is_alive():
+        started = time.perf_counter()
+        index.add_page(*pages[0])
+        waits.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    beatmaps = len(index.get_index())
+    elapsed = time.perf_counter() - started
+    print(
+        f"added again: {len(index):,} beatmapsets, {beatmaps:,} beatmaps, rebuilt in {elapsed:.3f} s,"
+        f" add_page waited at most {max(waits, default=0) * 1e3:.2f} ms during a rebuild"
+    )
+
+
+def main() -> None:
+    rng = random.Random(0)
+    page_count = (int(sys.argv[1]) if len(sys.argv) > 1 else 20000) // SETS_PER_PAGE
+    pages = []
+    index = BeatmapIndex(path="")
+
+    for page_index in range(page_count):
+        beatmapsets = build_page(rng)
+
+        for set_index, beatmapset in enumerate(beatmapsets):
+            beatmapset.id = page_index * SETS_PER_PAGE + set_index
+            beatmapset.title = f"set {beatmapset.id}"
+            beatmapset.play_count = (
+                page_count - page_index
+            ) * SETS_PER_PAGE - set_index
+
+        columns = BeatmapColumns.from_beatmapsets(beatmapsets)
+        pages.append((beatmapsets, columns))
+        index.add_page(beatmapsets, columns)
+
+    started = time.perf_counter()
+    beatmaps = len(index.get_index())
+    print(
+        f"{len(index):,} beatmapsets, {beatmaps:,} beatmaps, index built in {time.perf_counter() - started:.3f} s"
+    )
+
+    for name, beatmap_filter in FILTERS.items():
+        timings = []
+
+        for _ in range(REPEAT):
+            started = time.perf_counter()
+            picked = index.query(beatmap_filter, limit=WANTED)
+            timings.append(time.perf_counter() - started)
+
+        median = statistics.median(timings) * 1e6
+        needed = pages_needed(pages, beatmap_filter)
+        print(
+            f"{name:>9}: index query {median:>7.1f} us for {len(picked)} maps, search paging needs {needed} pages"
+        )
+
+    readd(index, pages)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+OsuIrc + RoomManager + Room under load against the local FakeBancho. Every step makes N lobbies
+through `mp make`, joins M players to each and replays the #mp_ chat of the lobby traffic corpus
+from them, with a ready -> start -> finish cycle and a player leaving and rejoining every round.
+
+Reported per step: dispatch latency percentiles (player line written by the fake server until
+its Room.on_message_receive returned), outbound queue wait, CPU time and RSS of the process.
+Bancho allows 10 messages per 5 seconds, the default budget is raised so the rooms, not the
+rate limit, are measured; pass 10 to see the real limit.
+
+usage: python -m benchmarks.bench_load [lobbies, default 1,10,50,100] [players, default 8] [messages per 5 s]
+"""
+import logging
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable
+from benchmarks.bench_classifier import DEFAULT_CORPUS
+from bot.beatmap import RoomBeatmap
+from bot.fakebancho import FakeBancho
+from bot.irc import OsuIrc
+from bot.outbound import TokenBucket
+from bot.parsers import parse_message
+from bot.room import Room
+from bot.roommanager import RoomManager
+from my_logger import logger
+
+ROUNDS = 5
+ROUND_INTERVAL = 1.0  # seconds between rounds of chat, ready and the leave/rejoin
+MATCH_LENGTH = 0.5
+TIMEOUT = 60.0
+
+
+@dataclass
+class LoadRoom(Room):
+    on_handled: Callable[
+        [str, str], None
+    ] | None = None  # (room id, sender) after every player line
+
+    def on_message_receive(self, sender: str, message: str) -> None:
+        try:
+            super().on_message_receive(sender, message)
+        finally:
+            if sender != "BanchoBot" and self.on_handled:
+                self.on_handled(self.room_id, sender)
+
+
+class LoadBeatmap(RoomBeatmap):
+    """placeholder maps with their titles, rotated in a loop so rooms never search or look up the osu! api"""
+
+    def rotate(self) -> None:
+        with self._lock:
+            self.beatmap_list.append(self.beatmap_list.pop(0))
+            self._version += 1
+
+
+@dataclass
+class Latencies:
+    """write times of player lines, matched in order per (room, player) as rooms handle them"""
+
+    pending: dict[tuple[str, str], deque[float]]
+    samples: list[float]
+    lock: threading.Lock
+
+    def sent(self, room_id: str, username: str) -> None:
+        with self.lock:
+            self.pending.setdefault((room_id, username), deque()).append(
+                time.perf_counter()
+            )
+
+    def handled(self, room_id: str, username: str) -> None:
+        now = time.perf_counter()
+
+        with self.lock:
+            pending = self.pending.get((room_id, username))
+
+            if pending:
+                self.samples.append(now - pending.popleft())
+
+    def is_drained(self) -> bool:
+        with self.lock:
+            return not any(self.pending.values())
+
+
+def load_chat(path: str) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        parsed = [parse_message(line) for line in f]
+
+    return [
+        message.message
+        for message in parsed
+        if message
+        and message.sender != "BanchoBot"
+        and message.channel.startswith("#mp_")
+    ]
+
+
+def get_rss() -> int:
+    """resident set size in bytes, the peak where /proc is missing"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = TIMEOUT) -> bool:
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+
+        time.sleep(0.01)
+
+    return True
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    return (
+        sorted(samples)[min(int(len(samples) * fraction), len(samples) - 1)]
+        if samples
+        else 0.0
+    )
+
+
+def run_step(lobbies: int, players: int, capacity: int, chat: list[str]) -> str:
+    bancho = FakeBancho(keep_received=False, match_length=MATCH_LENGTH)
+    irc = OsuIrc(
+        username="bot", password="secret", host="127.0.0.1", port=bancho.start()
+    )
+    irc.rate_limiter = TokenBucket(capacity=capacity)
+    manager = RoomManager(irc=irc)
+    latencies = Latencies(pending={}, samples=[], lock=threading.Lock())
+
+    for index in range(lobbies):
+        # placeholder maps up to the high-water mark keep RoomBeatmap from searching the osu! api
+        ids = range(
+            index * RoomBeatmap.high_water_mark + 1,
+            (index + 1) * RoomBeatmap.high_water_mark + 1,
+        )
+        beatmap_list = [
+            SimpleNamespace(
+                id=map_id, beatmapset_id=map_id, url=f"https://osu.ppy.sh/b/{map_id}"
+            )
+            for map_id in ids
+        ]
+        beatmap = LoadBeatmap(
+            beatmap_list=beatmap_list,
+            _titles={map_id: f"Load map {map_id}" for map_id in ids},
+        )
+        manager.add_room(
+            LoadRoom(
+                irc=irc,
+                beatmap=beatmap,
+                name=f"load {index}",
+                on_handled=latencies.handled,
+            )
+        )
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    manager.start(run_on_thread=True)
+
+    rooms = list(manager.rooms.values())
+
+    for room in rooms:
+        room.create()
+
+    if not wait_for(
+        lambda: all(room.is_connected and room.is_configured for room in rooms)
+    ):
+        return "rooms were not created in time"
+
+    created = time.perf_counter() - started
+    usernames = [f"player_{index}" for index in range(players)]
+
+    for room in rooms:
+        for username in usernames:
+            bancho.join_player(room.room_id, username)
+
+    for round_index in range(ROUNDS):
+        for room in rooms:
+            for player_index, username in enumerate(usernames):
+                latencies.sent(room.room_id, username)
+                bancho.chat(
+                    room.room_id,
+                    username,
+                    chat[(round_index * players + player_index) % len(chat)],
+                )
+
+            leaving = usernames[round_index % players]
+            bancho.leave_player(room.room_id, leaving)
+            bancho.join_player(room.room_id, leaving)
+            bancho.ready(room.room_id)
+
+        time.sleep(ROUND_INTERVAL)
+
+    drained = wait_for(latencies.is_drained)
+    wait_for(lambda: not len(irc.outbound))
+    cpu = time.process_time() - cpu_started
+    stats = irc.get_queue_stats().values()
+    manager.stop()
+    bancho.stop()
+
+    samples = latencies.samples
+    sent = sum(channel["sent"] for channel in stats)
+    average_wait = sum(
+        channel["average_wait"] * channel["sent"] for channel in stats
+    ) / max(sent, 1)
+    max_wait = max([channel["max_wait"] for channel in stats], default=0.0)
+    return (
+        f"{lobbies:>7} {players:>7} {created:>8.2f} {len(samples):>8} "
+        f"{statistics.median(samples) * 1e3 if samples else 0:>7.2f} "
+        f"{percentile(samples, 0.95) * 1e3:>7.2f} {percentile(samples, 0.99) * 1e3:>7.2f} "
+        f"{int(sent):>6} {average_wait * 1e3:>8.1f} {max_wait * 1e3:>8.1f} "
+        f"{cpu:>6.2f} {get_rss() / 2**20:>7.1f}" + ("" if drained else "  (lines lost)")
+    )
+
+
+def main() -> None:
+    logger.setLevel(logging.WARNING)
+    lobby_counts = [
+        int(count)
+        for count in (sys.argv[1] if len(sys.argv) > 1 else "1,10,50,100").split(",")
+    ]
+    players = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    chat = load_chat(DEFAULT_CORPUS)
+
+    print(
+        f"{ROUNDS} rounds of {ROUND_INTERVAL:.0f} s, {capacity} messages per 5 s, latencies and waits in ms"
+    )
+    print(
+        f"{'lobbies':>7} {'players':>7} {'create s':>8} {'lines':>8} {'p50':>7} {'p95':>7} {'p99':>7} "
+        f"{'sent':>6} {'avg wait':>8} {'max wait':>8} {'cpu s':>6} {'rss MiB':>7}"
+    )
+
+    for lobbies in lobby_counts:
+        print(run_step(lobbies, players, capacity, chat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Measures RoomManager.on_message_receive dispatch cost as the number of rooms grows.
+
+usage: python -m benchmarks.bench_room_routing
+"""
+import logging
+import timeit
+from bot.beatmap import RoomBeatmap
+from bot.irc import OsuIrc
+from bot.room import Room
+from bot.roommanager import RoomManager
+from my_logger import logger
+
+ROOM_COUNTS = [1, 10, 50, 100, 250, 500]
+ITERATIONS = 20000
+
+
+def build_manager(total_rooms: int) -> RoomManager:
+    irc = OsuIrc(username="bench", password="bench")
+    manager = RoomManager(irc=irc)
+
+    for index in range(total_rooms):
+        # placeholder maps up to the high-water mark keep RoomBeatmap from searching the osu! api
+        beatmap = RoomBeatmap(beatmap_list=[None] * RoomBeatmap.high_water_mark)
+        room = manager.add_room(Room(irc=irc, beatmap=beatmap, name=f"room {index}"))
+        room.set_room_id(f"#mp_{100000 + index}")
+
+    return manager
+
+
+def main() -> None:
+    logger.setLevel(logging.WARNING)
+    print(f"{'rooms':>8} {'ns/line':>10}")
+
+    for total_rooms in ROOM_COUNTS:
+        manager = build_manager(total_rooms)
+        # the last room added is the worst case for a linear scan
+        line = f":someone!cho@ppy.sh PRIVMSG #mp_{100000 + total_rooms - 1} :hello everyone"
+        seconds = min(
+            timeit.repeat(
+                lambda: manager.on_message_receive(line), number=ITERATIONS, repeat=5
+            )
+        )
+        print(f"{total_rooms:>8} {seconds / ITERATIONS * 1e9:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
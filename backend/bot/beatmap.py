@@ -1,12 +1,105 @@
+import json
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Any
-from bot.osuapi import osu_api
-from ossapi import Beatmap, Cursor, Beatmapset
+from typing import Any, Callable, Sequence
+from bot.beatmapcache import get_beatmapset
+from bot.beatmapfilter import BeatmapFilter, make_beatmap
+from bot.beatmapindex import beatmap_index
+from bot.beatmappool import beatmap_pool, beatmap_refiller
+from bot.scheduler import FakeClock, Scheduler, Timer, scheduler
+from bot.workqueue import api_workers
+from ossapi import Beatmap, Beatmapset
 from bot.enums import PLAY_MODE, RANK_STATUS, RoomBeatmapData
 from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
-from my_logger import logger
+from my_logger import get_logger
 
-default_beatmapset = osu_api.beatmapset(beatmapset_id=2005593)
+logger = get_logger("beatmaps")
+
+DEFAULT_BEATMAPSET_ID = 2005593  # current map of rooms without maps of their own
+DEFAULT_BEATMAP_PATH = os.path.join(
+    os.path.dirname(__file__), "data", "default_beatmap.json"
+)
+
+
+def load_fallback_beatmap(path: str) -> Beatmap:
+    """the bundled default map record, it only knows the beatmapset"""
+    with open(path, "r", encoding="utf-8") as f:
+        attributes = json.load(f)
+
+    beatmap = Beatmap.__new__(Beatmap)
+    beatmap.__dict__.update(attributes)
+    return beatmap
+
+
+@dataclass
+class DefaultBeatmap:
+    """
+    The default map, fetched (through the beatmap cache) on first use rather than at import.
+    The fetch runs on `executor` so room events reading it never wait on the osu! api, the bundled
+    record stands in until it gets through and it is retried every `retry` seconds.
+    """
+
+    beatmapset_id: int = DEFAULT_BEATMAPSET_ID
+    path: str = DEFAULT_BEATMAP_PATH
+    retry: float = 300.0
+    fetch: Callable[[int], Beatmapset | None] = get_beatmapset
+    clock: Callable[[], float] = time.monotonic
+    executor: Executor = field(default_factory=lambda: api_workers)
+
+    _beatmap: Beatmap | None = None
+    _retry_at: float | None = None  # set while the bundled record is used
+    _loading: Future[None] | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def is_stale(self) -> bool:
+        return self._beatmap is None or (
+            self._retry_at is not None and self.clock() >= self._retry_at
+        )
+
+    def get(self) -> Beatmap:
+        if self.is_stale():
+            with self._lock:
+                if self._beatmap is None:
+                    self._beatmap, self._retry_at = (
+                        load_fallback_beatmap(self.path),
+                        self.clock(),
+                    )
+
+                if self.is_stale() and not self._loading:
+                    self._loading = self.executor.submit(self.load)
+
+        assert self._beatmap
+        return self._beatmap
+
+    def load(self) -> None:
+        beatmap = None
+
+        try:
+            beatmapset = self.fetch(self.beatmapset_id)
+            beatmap = (
+                beatmapset.beatmaps[0] if beatmapset and beatmapset.beatmaps else None
+            )
+        except Exception:
+            logger.warning(
+                "Failed to fetch the default beatmapset %s",
+                self.beatmapset_id,
+                exc_info=True,
+            )
+
+        with self._lock:
+            if beatmap:
+                self._beatmap, self._retry_at = beatmap, None
+            else:
+                self._retry_at = self.clock() + self.retry
+
+            self._loading = None
+
+
+default_beatmap = DefaultBeatmap()
 
 
 @dataclass
@@ -17,37 +110,93 @@ class RoomBeatmap:
     cs: tuple[float, float] = (0.00, 10.00)
     length: tuple[int, int] = (0, 1000000)
     bpm: tuple[int, int] = (0, 200)
-    rank_status: list[RANK_STATUS] = field(default_factory=lambda: [status for status in RANK_STATUS])
+    rank_status: list[RANK_STATUS] = field(
+        default_factory=lambda: [status for status in RANK_STATUS]
+    )
     genre: BeatmapsetSearchGenre = BeatmapsetSearchGenre.ANY
     language: BeatmapsetSearchLanguage = BeatmapsetSearchLanguage.ANY
     beatmap_list: list[Beatmap] = field(default_factory=list)
 
-    _cursor: Cursor | None = None
+    low_water_mark: int = 3  # refill in the background when fewer maps are left
+    high_water_mark: int = 6  # refill up to this many maps
+    retry_delay: float = 30.0  # until a failed fill is tried again
+    scheduler: Scheduler = field(default_factory=lambda: scheduler)
+
+    _page: int = 0  # next page of the shared search pool
+    _generation: int = (
+        0  # bumped when filters change, refills for older filters are discarded
+    )
+    _version: int = 0  # bumped on every change to the maps, see Room.get_json_text
+    _titles: dict[int, str] = field(
+        default_factory=dict
+    )  # beatmap id -> title from the search results
+    _filter: BeatmapFilter | None = (
+        None  # built from the filters above, dropped when they change
+    )
+    _served: set[int] = field(
+        default_factory=set
+    )  # beatmapset ids queued since the filters changed
+    _filled: tuple[int, str] = (
+        -1,
+        "",
+    )  # (generation, "ready" or "failed") of the last fill, see status
+    _retry: Timer | None = None  # scheduled after a failed fill
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    on_ready: Callable[
+        [], None
+    ] | None = None  # after the first fill for the current filters
+    on_changed: Callable[
+        [], None
+    ] | None = None  # after another thread changed the maps, titles or status
 
     def __post_init__(self) -> None:
-        self.generate_beatmaps()
+        self.warm()
+
+    @property
+    def status(self) -> str:
+        """pending until the maps for the current filters were generated once"""
+        generation, status = self._filled
+        return status if generation == self._generation else "pending"
 
     @property
     def current(self) -> Beatmap:
-        return self.beatmap_list[0] if self.beatmap_list else default_beatmapset.beatmaps[0]
+        return self.beatmap_list[0] if self.beatmap_list else default_beatmap.get()
+
+    def get_version(self) -> int:
+        return self._version
 
     def set_current(self, beatmap: Beatmap) -> Beatmap:
-        self.beatmap_list.insert(0, beatmap)
+        with self._lock:
+            self.beatmap_list.insert(0, beatmap)
+            self._version += 1
+
         return self.current
 
-    def get_json(self) -> RoomBeatmapData:
-        return {
-            "play_mode": self.play_mode.name,
-            "star": self.star,
-            "ar": self.ar,
-            "cs": self.cs,
-            "length": self.length,
-            "bpm": self.bpm,
-            "rank_status": [rank.name for rank in self.rank_status],
-            "lists": self.get_json_list(),
-            "current": self.current_json(),
-            "genre": self.genre.name,
-            "language": self.language.name,
+    def get_json(self, fields: Sequence[str] = ()) -> RoomBeatmapData:
+        """every field or only `fields`, the ones not asked for (like the whole lists) are never built"""
+        getters: dict[str, Callable[[], Any]] = {
+            "play_mode": lambda: self.play_mode.name,
+            "star": lambda: self.star,
+            "ar": lambda: self.ar,
+            "cs": lambda: self.cs,
+            "length": lambda: self.length,
+            "bpm": lambda: self.bpm,
+            "rank_status": lambda: [rank.name for rank in self.rank_status],
+            "lists": self.get_json_list,
+            "current": self.current_json,
+            "genre": lambda: self.genre.name,
+            "language": lambda: self.language.name,
+            "status": lambda: self.status,
+            "progress": lambda: (
+                min(len(self.beatmap_list), self.high_water_mark),
+                self.high_water_mark,
+            ),
+        }
+        return {  # type: ignore[return-value]
+            name: getter()
+            for name, getter in getters.items()
+            if not fields or name in fields
         }
 
     def current_json(self) -> Beatmap:
@@ -67,7 +216,7 @@ class RoomBeatmap:
             for beatmap in self.beatmap_list
         ]
 
-    def configure(self, **kwargs: dict[str, Any]) -> None:
+    def configure(self, **kwargs: Any) -> None:
         changed = False
 
         for key, value in kwargs.items():
@@ -76,47 +225,213 @@ class RoomBeatmap:
                 setattr(self, key, value)
 
         if changed:
-            self._cursor = None
-            self.beatmap_list = []
+            with self._lock:
+                self._generation += 1
+                self._version += 1
+                self._filter = None
+                self._served.clear()
+                self._page = 0
+                self.beatmap_list = []
+                self._titles.clear()
+
+            self.warm()
+
+    def warm(self) -> None:
+        """generate the maps on the refiller thread, callers never wait on the osu! api"""
+        if len(self.beatmap_list) >= self.high_water_mark:
+            self._filled = (
+                self._generation,
+                "ready",
+            )  # given up front, tests and benchmarks
+            return
+
+        beatmap_refiller.request(self, self.fill)
+
+    def fill(self) -> None:
+        """generate_beatmaps, recording whether it got through for the filters it ran with"""
+        generation = self._generation
+        status = "failed"
+
+        try:
             self.generate_beatmaps()
+            status = "ready"
+        finally:
+            with self._lock:
+                is_current = generation == self._generation
+                became_ready = (
+                    is_current and status == "ready" and self.status != "ready"
+                )
+
+                if is_current:
+                    self._filled = (generation, status)
+                    self._version += 1
+
+                if is_current and status == "failed" and not self._retry:
+                    self._retry = self.scheduler.call_later(
+                        self.retry_delay, self.retry
+                    )
+
+            if became_ready and self.on_ready:
+                self.on_ready()
+            elif self.on_changed:
+                self.on_changed()
+
+    def retry(self) -> None:
+        """fill again after a failed fill, unless the filters changed or a refill got through since"""
+        with self._lock:
+            self._retry = None
+
+        if self.status == "failed":
+            beatmap_refiller.request(self, self.fill)
+
+    def stop(self) -> None:
+        """cancel the retry of a failed fill, for rooms being removed"""
+        with self._lock:
+            retry, self._retry = self._retry, None
+
+        if retry:
+            self.scheduler.cancel(retry)
 
     def generate_beatmaps(self) -> list[Beatmap]:
-        if len(self.beatmap_list) >= 3:
-            return self.beatmap_list
+        """fill beatmap_list up to the high-water mark, the api is only called outside the lock"""
+        generation = self._generation
+        pool = beatmap_pool.get(self.play_mode, self.genre, self.language)
+
+        # sets already indexed come from a local query, the search is only paged for sets not indexed yet
+        candidates = beatmap_index.query(
+            self.get_filter(),
+            self.genre,
+            self.language,
+            exclude=self._served,
+            limit=self.high_water_mark - len(self.beatmap_list),
+        )
 
-        logger.info("generating beatmaps...")
+        with self._lock:
+            if generation == self._generation:
+                for beatmap, beatmapset in candidates:
+                    self.add_beatmap(beatmap, beatmapset)
 
-        q = osu_api.search_beatmapsets(
-            mode=self.play_mode,
-            sort="plays_desc",
-            cursor=self._cursor,
-            genre=self.genre,
-            language=self.language,
-        )
-        self._cursor = q.cursor
+        # progress is published after every batch of maps, not only once the fill finishes
+        if candidates and self.on_changed:
+            self.on_changed()
 
-        for beatmapset in q.beatmapsets:
-            beatmapset.beatmaps.sort(key=lambda x: x.difficulty_rating, reverse=True)
+        while len(self.beatmap_list) < self.high_water_mark:
+            page = pool.get_page(self._page)
+            queued = len(self.beatmap_list)
 
-            for beatmap in beatmapset.beatmaps:
-                if not self.get_beatmap_errors(beatmap):
-                    self.beatmap_list.append(beatmap)
+            with self._lock:
+                if generation != self._generation:
                     break
 
-        return self.generate_beatmaps()
+                if not page:
+                    # every result was seen, start over from the most played maps on the next refill
+                    self._page = 0
+                    self._served.clear()
+                    break
+
+                page_index, beatmapsets, columns = page
+                self._page = page_index + 1
+
+                # the first map of every beatmapset that passes, one vectorized pass over the page
+                for row in self.get_filter().get_first_rows(columns):
+                    beatmapset = beatmapsets[columns.set_index[row]]
+
+                    if beatmapset.id not in self._served:
+                        self.add_beatmap(columns.beatmaps[row], beatmapset)
+
+            if len(self.beatmap_list) != queued and self.on_changed:
+                self.on_changed()
+
+        return self.beatmap_list
+
+    def add_beatmap(self, beatmap: Beatmap, beatmapset: Beatmapset) -> None:
+        """queue a generated map, expects the lock to be held"""
+        self.beatmap_list.append(beatmap)
+        self._titles[beatmap.id] = beatmapset.title
+        self._served.add(beatmapset.id)
+        self._version += 1
+
+    def refill(self) -> None:
+        if len(self.beatmap_list) < self.low_water_mark:
+            beatmap_refiller.request(self, self.fill)
 
     def rotate(self) -> None:
-        self.beatmap_list.pop(0)
-        self.generate_beatmaps()
+        with self._lock:
+            if self.beatmap_list:
+                self._titles.pop(self.beatmap_list.pop(0).id, None)
+                self._version += 1
+
+        self.refill()
 
     def get_queue(self) -> str:
         if not self.beatmap_list:
             return "No Beatmaps"
 
-        queue_links = [f"[{beatmap.url} {beatmap.beatmapset().title}]" for beatmap in self.beatmap_list[1:3]]
+        queue_links = [
+            f"[{beatmap.url} {self.get_title(beatmap)}]"
+            for beatmap in self.beatmap_list[1:3]
+        ]
         return ", ".join(queue_links)
 
-    def is_in_range(self, value: float | int, minimum: float | int, maximum: float | int) -> bool:
+    def get_title(self, beatmap: Beatmap) -> str:
+        """the title from the search results, for maps queued without one it is fetched on api_workers"""
+        with self._lock:
+            title = self._titles.get(beatmap.id)
+
+            if title is None:
+                self._titles[beatmap.id] = ""  # being fetched
+
+        if title is None:
+            api_workers.submit(self.fetch_title, beatmap)
+
+        return title or f"Beatmap {beatmap.id}"
+
+    def fetch_title(self, beatmap: Beatmap) -> None:
+        title = None
+
+        try:
+            title = self.load_title(beatmap)
+        except Exception:
+            logger.warning(
+                "Failed to fetch the title of beatmap %s", beatmap.id, exc_info=True
+            )
+
+        with self._lock:
+            if self._titles.get(beatmap.id) != "":
+                return  # rotated out or the filters changed meanwhile
+
+            if title is None:
+                del self._titles[beatmap.id]  # fetched again on the next lookup
+                return
+
+            self._titles[beatmap.id] = title
+            self._version += 1
+
+        if self.on_changed:
+            self.on_changed()
+
+    def load_title(self, beatmap: Beatmap) -> str:
+        return str(get_beatmapset(beatmap.beatmapset_id).title)
+
+    def get_filter(self) -> BeatmapFilter:
+        beatmap_filter = self._filter
+
+        if not beatmap_filter:
+            beatmap_filter = self._filter = BeatmapFilter(
+                play_mode=self.play_mode.value,
+                star=self.star,
+                ar=self.ar,
+                cs=self.cs,
+                bpm=self.bpm,
+                length=self.length,
+                rank_status=frozenset(status.value for status in self.rank_status),
+            )
+
+        return beatmap_filter
+
+    def is_in_range(
+        self, value: float | int, minimum: float | int, maximum: float | int
+    ) -> bool:
         return minimum <= value and maximum >= value
 
     def check_star(self, star: float) -> bool:
@@ -135,7 +450,7 @@ class RoomBeatmap:
         return self.is_in_range(length, self.length[0], self.length[1])
 
     def check_rank(self, status: int) -> bool:
-        return status in [status.value for status in self.rank_status]
+        return status in self.get_filter().rank_status
 
     def get_beatmapset_errors(self, beatmapset: Beatmapset) -> list[str]:
         errors = []
@@ -144,8 +459,14 @@ class RoomBeatmap:
         genre_id = beatmapset.genre.get("id")
         language_id = beatmapset.language.get("id")
 
-        genre = BeatmapsetSearchGenre(genre_id) if genre_id else BeatmapsetSearchGenre.ANY
-        language = BeatmapsetSearchLanguage(language_id) if language_id else BeatmapsetSearchLanguage.ANY
+        genre = (
+            BeatmapsetSearchGenre(genre_id) if genre_id else BeatmapsetSearchGenre.ANY
+        )
+        language = (
+            BeatmapsetSearchLanguage(language_id)
+            if language_id
+            else BeatmapsetSearchLanguage.ANY
+        )
 
         if self.genre != BeatmapsetSearchGenre.ANY and self.genre != genre:
             errors.append(f"Genre {genre.name} != {self.genre.name}")
@@ -156,32 +477,39 @@ class RoomBeatmap:
         return errors
 
     def get_beatmap_errors(self, beatmap: Beatmap) -> list[str]:
-        errors: list[str] = []
-
-        error_checks = [
-            (f"Play Mode {beatmap.mode.name} != {self.play_mode.name}", beatmap.mode_int == self.play_mode.value),
+        """the filters a map breaks, messages are only formatted for the failed checks"""
+        error_checks: list[tuple[bool, Callable[[], str]]] = [
+            (
+                beatmap.mode_int == self.play_mode.value,
+                lambda: f"Play Mode {beatmap.mode.name} != {self.play_mode.name}",
+            ),
             (
-                f"Star {beatmap.difficulty_rating} != {self.star[0]}-{self.star[1]}*",
                 self.check_star(beatmap.difficulty_rating),
+                lambda: f"Star {beatmap.difficulty_rating} != {self.star[0]}-{self.star[1]}*",
             ),
             (
-                f"Rank Status {beatmap.ranked.name} != [{' | '.join([rank.name for rank in self.rank_status])}]",
                 self.check_rank(beatmap.ranked.value),
+                lambda: f"Rank Status {beatmap.ranked.name} != [{' | '.join(rank.name for rank in self.rank_status)}]",
+            ),
+            (
+                self.check_ar(beatmap.ar),
+                lambda: f"AR {beatmap.ar} != {self.ar[0]}-{self.ar[1]}",
+            ),
+            (
+                self.check_bpm(beatmap.bpm),
+                lambda: f"BPM {beatmap.bpm} != {self.bpm[0]}-{self.bpm[1]}",
             ),
-            (f"AR {beatmap.ar} != {self.ar[0]}-{self.ar[1]}", self.check_ar(beatmap.ar)),
-            (f"BPM {beatmap.bpm} != {self.bpm[0]}-{self.bpm[1]}", self.check_bpm(beatmap.bpm)),
             (
-                f"Length {beatmap.total_length} != {self.length[0]}-{self.length[1]}",
                 self.check_length(beatmap.total_length),
+                lambda: f"Length {beatmap.total_length} != {self.length[0]}-{self.length[1]}",
+            ),
+            (
+                self.check_cs(beatmap.cs),
+                lambda: f"CS {beatmap.cs} != {self.cs[0]}-{self.cs[1]}",
             ),
-            (f"CS {beatmap.cs} != {self.cs[0]}-{self.cs[1]}", self.check_cs(beatmap.cs)),
         ]
 
-        for error, is_valid in error_checks:
-            if not is_valid:
-                errors.append(error)
-
-        return errors
+        return [error() for is_valid, error in error_checks if not is_valid]
 
     @property
     def links(self) -> str:
@@ -197,6 +525,148 @@ class RoomBeatmap:
         return f"{osu_link} {beatconnect_link} {chimu_link}"
 
 
+class DefaultBeatmapTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.online = False
+
+        def fetch(beatmapset_id: int) -> Any:
+            if not self.online:
+                raise ConnectionError("offline")
+
+            beatmap = Beatmap.__new__(Beatmap)
+            beatmap.id = 1
+            beatmapset = Beatmapset.__new__(Beatmapset)
+            beatmapset.beatmaps = [beatmap]
+            return beatmapset
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.default = DefaultBeatmap(
+            retry=60, fetch=fetch, clock=lambda: self.now, executor=self.executor
+        )
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+
+    def get(self) -> Beatmap:
+        """after the fetch started by this lookup, if any"""
+        beatmap = self.default.get()
+
+        if loading := self.default._loading:
+            loading.result()
+
+        return beatmap
+
+    def test_offline(self):
+        self.assertEqual(self.get().beatmapset_id, DEFAULT_BEATMAPSET_ID)
+        self.online = True
+        self.assertEqual(self.get().id, 0)  # not retried yet
+
+        self.now = 60
+        self.assertEqual(self.get().id, 0)  # the bundled record while fetching
+        self.assertEqual(self.get().id, 1)
+        self.online = False
+        self.now = 120
+        self.assertEqual(self.get().id, 1)
+
+
+class RoomBeatmapTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(clock=self.clock, run_on_thread=False)
+        self.beatmap = RoomBeatmap(
+            beatmap_list=[make_beatmap(id=index) for index in range(6)],
+            scheduler=self.scheduler,
+        )
+        self.ready: list[str] = []
+        self.changed: list[str] = []
+        self.beatmap.on_ready = lambda: self.ready.append(self.beatmap.status)
+        self.beatmap.on_changed = lambda: self.changed.append(self.beatmap.status)
+        self.generated = (
+            threading.Event()
+        )  # the refiller waits for it, so "pending" can be seen
+
+    def generate(self, fails: bool) -> None:
+        def generate_beatmaps() -> list[Beatmap]:
+            self.generated.wait()
+
+            if fails:
+                raise ConnectionError("offline")
+
+            self.beatmap.beatmap_list = [make_beatmap(id=7)]
+            return self.beatmap.beatmap_list
+
+        self.beatmap.generate_beatmaps = generate_beatmaps  # type: ignore[method-assign]
+
+    def test_status(self):
+        self.assertEqual(self.beatmap.status, "ready")
+
+        self.generate(fails=True)
+        self.beatmap.configure(star=(1.0, 2.0))
+        self.assertEqual(
+            self.beatmap.get_json(["status", "progress"]),
+            {"status": "pending", "progress": (0, 6)},
+        )
+        self.generated.set()
+        beatmap_refiller.join()
+        self.assertEqual(
+            (self.beatmap.status, self.ready, self.changed), ("failed", [], ["failed"])
+        )
+
+        self.generate(fails=False)
+        self.beatmap.refill()
+        beatmap_refiller.join()
+        self.assertEqual((self.beatmap.status, self.ready), ("ready", ["ready"]))
+        self.assertEqual(self.beatmap.get_json(["progress"]), {"progress": (1, 6)})
+
+    def test_title(self):
+        fetched = threading.Event()
+        changed = threading.Event()
+        self.beatmap.on_changed = changed.set
+        beatmap = self.beatmap.beatmap_list[1]
+
+        def load_title(beatmap: Beatmap) -> str:
+            fetched.wait()
+            return f"title {beatmap.id}"
+
+        self.beatmap.load_title = load_title  # type: ignore[method-assign]
+
+        # the lookup doesn't wait for the fetch, the title is there once it got through
+        self.assertEqual(self.beatmap.get_title(beatmap), "Beatmap 1")
+        self.assertEqual(self.beatmap.get_title(beatmap), "Beatmap 1")
+        fetched.set()
+        self.assertTrue(changed.wait(1))
+        self.assertEqual(self.beatmap.get_title(beatmap), "title 1")
+
+    def test_retry(self):
+        self.generate(fails=True)
+        self.generated.set()
+        self.beatmap.configure(star=(1.0, 2.0))
+        beatmap_refiller.join()
+        self.assertEqual((self.beatmap.status, len(self.scheduler)), ("failed", 1))
+
+        self.clock.advance(self.beatmap.retry_delay)
+        self.scheduler.run_pending()
+        beatmap_refiller.join()
+        self.assertEqual(
+            (self.beatmap.status, len(self.scheduler)), ("failed", 1)
+        )  # still offline
+
+        self.generate(fails=False)
+        self.clock.advance(self.beatmap.retry_delay)
+        self.scheduler.run_pending()
+        beatmap_refiller.join()
+        self.assertEqual(
+            (self.beatmap.status, len(self.scheduler), self.ready),
+            ("ready", 0, ["ready"]),
+        )
+
+        self.generate(fails=True)
+        self.beatmap.configure(star=(2.0, 3.0))
+        beatmap_refiller.join()
+        self.beatmap.stop()
+        self.assertEqual(len(self.scheduler), 0)
+
+
 if __name__ == "__main__":
-    bm = RoomBeatmap()
-    print(bm.current)
+    unittest.main()
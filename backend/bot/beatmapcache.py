@@ -0,0 +1,243 @@
+import io
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from ossapi import Beatmap, Beatmapset, Ossapi
+from bot.enums import RANK_STATUS
+from bot.metrics import metrics
+from bot.osuapi import LazyApi, osu_api
+
+FOREVER = float("inf")
+
+api_seconds = metrics.histogram(
+    "osu_api_seconds", "osu! api call latency, by call.", ("call",)
+)
+cache_requests = metrics.counter(
+    "beatmap_cache_requests_total",
+    "Beatmap cache lookups, by kind and memory, disk or miss.",
+    ("kind", "result"),
+)
+
+# seconds a cached map stays fresh, by rank status. ranked and loved maps don't change anymore
+RANK_STATUS_TTL: dict[int, float] = {
+    RANK_STATUS.RANKED: FOREVER,
+    RANK_STATUS.APPROVED: FOREVER,
+    RANK_STATUS.LOVED: FOREVER,
+    RANK_STATUS.QUALIFIED: 60 * 60,
+    RANK_STATUS.PENDING: 60 * 60,
+    RANK_STATUS.WIP: 60 * 60,
+    RANK_STATUS.GRAVEYARD: 6 * 60 * 60,
+}
+DEFAULT_TTL = 60 * 60
+
+
+def get_ttl(value: Beatmap | Beatmapset) -> float:
+    ranked = getattr(value, "ranked", None)
+    status = getattr(ranked, "value", ranked)
+    return DEFAULT_TTL if status is None else RANK_STATUS_TTL.get(status, DEFAULT_TTL)
+
+
+class ApiPickler(pickle.Pickler):
+    # ossapi models keep a reference to the api client, store a placeholder instead
+    def persistent_id(self, obj: Any) -> str | None:
+        return "osu_api" if isinstance(obj, (Ossapi, LazyApi)) else None
+
+
+class ApiUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == "osu_api":
+            return osu_api
+        raise pickle.UnpicklingError(f"Unknown persistent id {pid}")
+
+
+def dumps(value: Any) -> bytes:
+    buffer = io.BytesIO()
+    ApiPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    return buffer.getvalue()
+
+
+def loads(data: bytes) -> Any:
+    return ApiUnpickler(io.BytesIO(data)).load()
+
+
+@dataclass
+class BeatmapCache:
+    """
+    osu! api beatmap/beatmapset responses cached in memory (LRU) and in SQLite,
+    keyed by kind and id, expiring by rank status (see RANK_STATUS_TTL).
+    """
+
+    path: str = os.environ.get(
+        "BEATMAP_CACHE_PATH", os.path.join(os.getcwd(), "cache", "beatmaps.sqlite3")
+    )
+    memory_size: int = 2048
+    clock: Callable[[], float] = time.time
+
+    hits: int = 0
+    memory_hits: int = 0
+    misses: int = 0
+
+    _memory: OrderedDict[tuple[str, int], tuple[float, Any]] = field(
+        default_factory=OrderedDict
+    )
+    _connection: sqlite3.Connection | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if not self._connection:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "kind TEXT NOT NULL, id INTEGER NOT NULL, expires_at REAL NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (kind, id))"
+            )
+
+        return self._connection
+
+    def get(self, kind: str, key: int) -> Any | None:
+        now = self.clock()
+
+        with self._lock:
+            cached = self._memory.get((kind, key))
+
+            if cached and cached[0] > now:
+                self._memory.move_to_end((kind, key))
+                self.hits += 1
+                self.memory_hits += 1
+                cache_requests.inc(labels=(kind, "memory"))
+                return cached[1]
+
+            row = self.connection.execute(
+                "SELECT expires_at, data FROM cache WHERE kind = ? AND id = ? AND expires_at > ?",
+                (kind, key, now),
+            ).fetchone()
+
+            if not row:
+                self.misses += 1
+                cache_requests.inc(labels=(kind, "miss"))
+                return None
+
+            self.hits += 1
+            cache_requests.inc(labels=(kind, "disk"))
+            value = loads(row[1])
+            self.remember(kind, key, row[0], value)
+            return value
+
+    def put(self, kind: str, key: int, value: Any) -> None:
+        expires_at = self.clock() + get_ttl(value)
+
+        with self._lock:
+            self.remember(kind, key, expires_at, value)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache (kind, id, expires_at, data) VALUES (?, ?, ?, ?)",
+                (kind, key, expires_at, dumps(value)),
+            )
+            self.connection.commit()
+
+    def remember(self, kind: str, key: int, expires_at: float, value: Any) -> None:
+        self._memory[(kind, key)] = (expires_at, value)
+        self._memory.move_to_end((kind, key))
+
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_or_fetch(self, kind: str, key: int, fetch: Callable[[int], Any]) -> Any:
+        value = self.get(kind, key)
+
+        if value is None:
+            started = time.perf_counter()
+
+            try:
+                value = fetch(key)
+            finally:
+                api_seconds.observe(time.perf_counter() - started, (kind,))
+
+            if value:
+                self.put(kind, key, value)
+
+        return value
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "memory_size": len(self._memory),
+        }
+
+
+beatmap_cache = BeatmapCache()
+
+
+def get_beatmap(beatmap_id: int) -> Beatmap:
+    return beatmap_cache.get_or_fetch("beatmap", beatmap_id, osu_api.beatmap)
+
+
+def get_beatmapset(beatmapset_id: int) -> Beatmapset:
+    return beatmap_cache.get_or_fetch("beatmapset", beatmapset_id, osu_api.beatmapset)
+
+
+class BeatmapCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.cache = BeatmapCache(
+            path=":memory:", memory_size=2, clock=lambda: self.now
+        )
+
+    def make_beatmap(self, beatmap_id: int, ranked: RANK_STATUS) -> Beatmap:
+        beatmap = Beatmap.__new__(Beatmap)
+        beatmap.id = beatmap_id
+        beatmap.ranked = ranked
+        return beatmap
+
+    def get_id(self, beatmap_id: int) -> int | None:
+        beatmap = self.cache.get("beatmap", beatmap_id)
+        return None if beatmap is None else int(beatmap.id)
+
+    def test_ttl(self):
+        self.cache.put("beatmap", 1, self.make_beatmap(1, RANK_STATUS.RANKED))
+        self.cache.put("beatmap", 2, self.make_beatmap(2, RANK_STATUS.PENDING))
+
+        self.now = 24 * 60 * 60
+        self.assertEqual(self.get_id(1), 1)
+        self.assertIsNone(self.cache.get("beatmap", 2))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_lru(self):
+        for beatmap_id in [1, 2, 3]:
+            self.cache.put(
+                "beatmap", beatmap_id, self.make_beatmap(beatmap_id, RANK_STATUS.RANKED)
+            )
+
+        self.assertEqual(self.get_id(3), 3)
+        self.assertEqual(self.cache.memory_hits, 1)
+
+        # evicted from memory, still on disk
+        self.assertEqual(self.get_id(1), 1)
+        self.assertEqual(self.cache.memory_hits, 1)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_get_or_fetch(self):
+        fetched: list[int] = []
+
+        def fetch(beatmap_id: int) -> Beatmap:
+            fetched.append(beatmap_id)
+            return self.make_beatmap(beatmap_id, RANK_STATUS.LOVED)
+
+        self.cache.get_or_fetch("beatmap", 7, fetch)
+        self.cache.get_or_fetch("beatmap", 7, fetch)
+        self.assertEqual(fetched, [7])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import math
+import unittest
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any
+import numpy as np
+from ossapi import Beatmap, Beatmapset
+
+Range = tuple[float, float]
+
+
+def get_number(beatmap: Beatmap, attribute: str) -> float:
+    value = getattr(beatmap, attribute, None)
+    return math.nan if value is None else float(value)  # nan fails every range check
+
+
+@dataclass
+class BeatmapColumns:
+    """a page of search results as one array per filtered attribute, a row per beatmap"""
+
+    beatmaps: list[Beatmap]
+    set_index: np.ndarray  # index of the beatmapset of each row in the page
+    star: np.ndarray
+    ar: np.ndarray
+    cs: np.ndarray
+    bpm: np.ndarray
+    length: np.ndarray
+    mode: np.ndarray
+    ranked: np.ndarray
+
+    @classmethod
+    def from_beatmapsets(cls, beatmapsets: list[Beatmapset]) -> "BeatmapColumns":
+        rows = [
+            (index, beatmap)
+            for index, beatmapset in enumerate(beatmapsets)
+            for beatmap in beatmapset.beatmaps
+        ]
+        beatmaps = [beatmap for _, beatmap in rows]
+
+        def column(attribute: str) -> np.ndarray:
+            return np.array(
+                [get_number(beatmap, attribute) for beatmap in beatmaps],
+                dtype=np.float64,
+            )
+
+        return cls(
+            beatmaps=beatmaps,
+            set_index=np.array([index for index, _ in rows], dtype=np.int64),
+            star=column("difficulty_rating"),
+            ar=column("ar"),
+            cs=column("cs"),
+            bpm=column("bpm"),
+            length=column("total_length"),
+            mode=np.array([beatmap.mode_int for beatmap in beatmaps], dtype=np.int64),
+            ranked=np.array(
+                [beatmap.ranked.value for beatmap in beatmaps], dtype=np.int64
+            ),
+        )
+
+    @classmethod
+    def concatenate(cls, chunks: list["BeatmapColumns"]) -> "BeatmapColumns":
+        """pages appended into one, set_index is expected to be offset already"""
+        if not chunks:
+            return cls.from_beatmapsets([])
+
+        return cls(
+            beatmaps=[beatmap for chunk in chunks for beatmap in chunk.beatmaps],
+            **{
+                name: np.concatenate([getattr(chunk, name) for chunk in chunks])
+                for name in [
+                    "set_index",
+                    "star",
+                    "ar",
+                    "cs",
+                    "bpm",
+                    "length",
+                    "mode",
+                    "ranked",
+                ]
+            },
+        )
+
+    def take(self, rows: np.ndarray) -> "BeatmapColumns":
+        """the given rows in the given order"""
+        return BeatmapColumns(
+            beatmaps=[self.beatmaps[row] for row in rows.tolist()],
+            **{
+                name: getattr(self, name)[rows]
+                for name in [
+                    "set_index",
+                    "star",
+                    "ar",
+                    "cs",
+                    "bpm",
+                    "length",
+                    "mode",
+                    "ranked",
+                ]
+            },
+        )
+
+    def __len__(self) -> int:
+        return len(self.beatmaps)
+
+
+@dataclass(frozen=True)
+class BeatmapFilter:
+    """the map filters of a room, evaluated over a whole page of BeatmapColumns at once"""
+
+    play_mode: int
+    star: Range
+    ar: Range
+    cs: Range
+    bpm: Range
+    length: Range
+    rank_status: frozenset[int]
+
+    def get_ranges(self) -> dict[str, Range]:
+        """column name -> inclusive range, play mode as a range of one value"""
+        return {
+            "mode": (self.play_mode, self.play_mode),
+            "star": self.star,
+            "ar": self.ar,
+            "cs": self.cs,
+            "bpm": self.bpm,
+            "length": self.length,
+        }
+
+    def get_mask(
+        self, columns: BeatmapColumns, rows: np.ndarray | slice | None = None
+    ) -> np.ndarray:
+        """passing rows of the columns, or of only `rows` of them"""
+
+        def select(values: np.ndarray) -> np.ndarray:
+            return values if rows is None else values[rows]
+
+        mask: np.ndarray = np.isin(select(columns.ranked), list(self.rank_status))
+
+        for name, (minimum, maximum) in self.get_ranges().items():
+            values = select(getattr(columns, name))
+            mask &= (values >= minimum) & (values <= maximum)
+
+        return mask
+
+    def get_first_rows(self, columns: BeatmapColumns) -> list[int]:
+        """the first passing row of every beatmapset, in page order"""
+        if not len(columns):
+            return []
+
+        rows = np.flatnonzero(self.get_mask(columns))
+        _, first = np.unique(columns.set_index[rows], return_index=True)
+        return [int(row) for row in rows[first]]
+
+
+def make_beatmap(**attributes: Any) -> Any:
+    """search result stand-in for tests and benchmarks"""
+    beatmap: dict[str, Any] = dict(
+        difficulty_rating=5.0, ar=9.0, cs=4.0, bpm=180, total_length=120, mode_int=0
+    )
+    beatmap.update({"ranked": 1, **attributes})
+    beatmap["ranked"] = SimpleNamespace(value=beatmap["ranked"])
+    return SimpleNamespace(**beatmap)
+
+
+class BeatmapFilterTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.filter = BeatmapFilter(
+            play_mode=0,
+            star=(4.0, 6.0),
+            ar=(0.0, 10.0),
+            cs=(0.0, 10.0),
+            bpm=(0, 200),
+            length=(0, 300),
+            rank_status=frozenset({1, 4}),
+        )
+
+    def test_mask(self):
+        beatmaps = [
+            make_beatmap(),
+            make_beatmap(difficulty_rating=6.5),
+            make_beatmap(mode_int=3),
+            make_beatmap(ranked=-2),
+            make_beatmap(bpm=None),
+        ]
+        columns = BeatmapColumns.from_beatmapsets([SimpleNamespace(beatmaps=beatmaps)])
+        self.assertEqual(
+            self.filter.get_mask(columns).tolist(), [True, False, False, False, False]
+        )
+
+    def test_first_rows(self):
+        beatmapsets: Any = [
+            SimpleNamespace(
+                beatmaps=[
+                    make_beatmap(difficulty_rating=7),
+                    make_beatmap(),
+                    make_beatmap(),
+                ]
+            ),
+            SimpleNamespace(beatmaps=[make_beatmap(difficulty_rating=7)]),
+            SimpleNamespace(beatmaps=[]),
+            SimpleNamespace(beatmaps=[make_beatmap(difficulty_rating=4.5)]),
+        ]
+        columns = BeatmapColumns.from_beatmapsets(beatmapsets)
+        self.assertEqual(self.filter.get_first_rows(columns), [1, 4])
+        self.assertEqual(
+            self.filter.get_first_rows(BeatmapColumns.from_beatmapsets([])), []
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,472 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections.abc import Container
+from dataclasses import dataclass, field, replace
+from types import SimpleNamespace
+from typing import Any, Callable, NamedTuple
+import numpy as np
+from ossapi import Beatmap, Beatmapset
+from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
+from bot.beatmapcache import dumps, loads
+from bot.beatmapfilter import BeatmapColumns, BeatmapFilter, make_beatmap
+from my_logger import get_logger
+
+logger = get_logger("beatmaps")
+
+RANGE_COLUMNS = [
+    "mode",
+    "star",
+    "ar",
+    "cs",
+    "bpm",
+    "length",
+]  # see BeatmapFilter.get_ranges
+QUERY_CHUNK = (
+    4096  # rows checked at once, queries stop at the first chunk that fills the limit
+)
+
+
+def get_search_id(beatmapset: Beatmapset, attribute: str, searched: int) -> int:
+    """genre or language id of a search result, the one searched for when the result leaves it out"""
+    value = getattr(beatmapset, attribute, None)
+    value = value.get("id") if isinstance(value, dict) else getattr(value, "id", value)
+    return (
+        value if isinstance(value, int) else searched
+    )  # ANY (0) when neither is known
+
+
+class IndexSnapshot(NamedTuple):
+    """the index as of its last rebuild, never changed afterwards so queries read it without the lock"""
+
+    columns: BeatmapColumns  # rows of the newest copy of every set only, most played sets first
+    pages: np.ndarray  # number of the page each row was added with
+    sorted: dict[str, tuple[np.ndarray, np.ndarray]]  # range column -> (rows, values)
+    sets: dict[
+        str, np.ndarray
+    ]  # id, genre, language, plays and page by beatmapset position
+    beatmapsets: list[Beatmapset]
+
+
+def build_snapshot(
+    previous: IndexSnapshot | None,
+    pending: list[tuple[int, BeatmapColumns]],
+    sets: dict[str, list[int]],
+    beatmapsets: list[Beatmapset],
+) -> IndexSnapshot:
+    """the previous snapshot with the pending pages merged in and the rows of replaced sets dropped"""
+    set_columns = {
+        name: np.array(values, dtype=np.int64) for name, values in sets.items()
+    }
+    chunks = [previous.columns] if previous else []
+    pages = [previous.pages] if previous else []
+
+    for page, page_columns in pending:
+        chunks.append(page_columns)
+        pages.append(np.full(len(page_columns), page, dtype=np.int64))
+
+    columns = BeatmapColumns.concatenate(chunks)
+    row_pages = np.concatenate(pages) if pages else np.zeros(0, dtype=np.int64)
+
+    # a set added again only keeps the rows of the page that added it last
+    alive = np.flatnonzero(set_columns["page"][columns.set_index] == row_pages)
+    set_index = columns.set_index[alive]
+    # most played sets first, the maps of a set stay in page order
+    rows = alive[np.lexsort((alive, set_index, -set_columns["plays"][set_index]))]
+    columns = columns.take(rows)
+    sorted_columns = {}
+
+    for name in RANGE_COLUMNS:
+        order = np.argsort(getattr(columns, name), kind="stable")
+        sorted_columns[name] = (order, getattr(columns, name)[order])
+
+    return IndexSnapshot(
+        columns, row_pages[rows], sorted_columns, set_columns, beatmapsets
+    )
+
+
+@dataclass
+class BeatmapIndex:
+    """
+    Every beatmapset seen in search results, as one BeatmapColumns with a sorted index per range
+    filter, so rooms pick candidate maps locally and only search the osu! api for sets they haven't
+    had yet. Persisted to `path` (an empty path keeps it in memory), which can also be a prebuilt dump.
+
+    New pages wait in `_pending` until the next query rebuilds the snapshot. The rebuild runs outside
+    the lock, queries meanwhile answer from the previous snapshot and pages keep being added.
+    """
+
+    path: str = os.environ.get(
+        "BEATMAP_INDEX_PATH", os.path.join(os.getcwd(), "cache", "beatmap_index.pickle")
+    )
+    save_interval: float = 5 * 60
+    clock: Callable[[], float] = time.monotonic
+
+    beatmapsets: list[Beatmapset] = field(
+        default_factory=list
+    )  # a set seen again replaces its older copy
+    _positions: dict[int, int] = field(
+        default_factory=dict
+    )  # beatmapset id -> position in beatmapsets
+    _sets: dict[str, list[int]] = field(
+        default_factory=lambda: {
+            "id": [],
+            "genre": [],
+            "language": [],
+            "plays": [],
+            "page": [],
+        }
+    )
+    _pending: list[tuple[int, BeatmapColumns]] = field(
+        default_factory=list
+    )  # (page, columns by set position)
+    _pages: int = 0
+    _snapshot: IndexSnapshot | None = None
+
+    _is_loaded: bool = False
+    _unsaved: int = 0  # beatmapsets added since the last save
+    _saved_at: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _build_lock: threading.Lock = field(
+        default_factory=threading.Lock
+    )  # one rebuild at a time
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def add_page(
+        self,
+        beatmapsets: list[Beatmapset],
+        columns: BeatmapColumns | None = None,
+        genre: BeatmapsetSearchGenre = BeatmapsetSearchGenre.ANY,
+        language: BeatmapsetSearchLanguage = BeatmapsetSearchLanguage.ANY,
+    ) -> None:
+        """index a page of search results, a set indexed before is replaced by its newer copy"""
+        with self._lock:
+            self.load()
+            self.add(beatmapsets, columns, genre.value, language.value)
+            self._unsaved += len(beatmapsets)
+
+        if (
+            self.path
+            and self._unsaved
+            and self.clock() - self._saved_at > self.save_interval
+        ):
+            self.save()
+
+    def add(
+        self,
+        beatmapsets: list[Beatmapset],
+        columns: BeatmapColumns | None,
+        genre: int,
+        language: int,
+    ) -> None:
+        """expects the lock to be held"""
+        if columns is None:
+            columns = BeatmapColumns.from_beatmapsets(beatmapsets)
+
+        self._pages += 1
+        positions = []
+
+        for beatmapset in beatmapsets:
+            position = self._positions.get(beatmapset.id)
+            # a set found again through an ANY search keeps the genre or language it was found with before
+            genre_id = get_search_id(beatmapset, "genre", genre)
+            language_id = get_search_id(beatmapset, "language", language)
+            plays = getattr(beatmapset, "play_count", 0) or 0
+
+            if position is None:
+                position = self._positions[beatmapset.id] = len(self.beatmapsets)
+                self.beatmapsets.append(beatmapset)
+                self._sets["id"].append(beatmapset.id)
+                self._sets["genre"].append(genre_id)
+                self._sets["language"].append(language_id)
+                self._sets["plays"].append(plays)
+                self._sets["page"].append(self._pages)
+            else:
+                self.beatmapsets[position] = beatmapset
+                self._sets["genre"][position] = (
+                    genre_id or self._sets["genre"][position]
+                )
+                self._sets["language"][position] = (
+                    language_id or self._sets["language"][position]
+                )
+                self._sets["plays"][position] = plays
+                self._sets["page"][position] = self._pages
+
+            positions.append(position)
+
+        set_index = np.array(positions, dtype=np.int64)[columns.set_index]
+        self._pending.append((self._pages, replace(columns, set_index=set_index)))
+
+    def get_snapshot(self) -> IndexSnapshot:
+        """the snapshot with every page added so far, or the previous one while another query rebuilds it"""
+        with self._lock:
+            self.load()
+            snapshot = self._snapshot
+
+            if snapshot and not self._pending:
+                return snapshot
+
+        # only the very first build is waited for
+        if not self._build_lock.acquire(blocking=snapshot is None):
+            assert snapshot
+            return snapshot
+
+        try:
+            with self._lock:
+                snapshot, pending = self._snapshot, list(self._pending)
+                sets = {name: list(values) for name, values in self._sets.items()}
+                beatmapsets = list(self.beatmapsets)
+
+            if snapshot and not pending:
+                return snapshot
+
+            snapshot = build_snapshot(snapshot, pending, sets, beatmapsets)
+
+            with self._lock:
+                self._snapshot = snapshot
+                del self._pending[
+                    : len(pending)
+                ]  # pages added during the rebuild wait for the next one
+
+            return snapshot
+        finally:
+            self._build_lock.release()
+
+    def get_index(self) -> BeatmapColumns:
+        """every indexed map in one set of columns"""
+        return self.get_snapshot().columns
+
+    def query(
+        self,
+        beatmap_filter: BeatmapFilter,
+        genre: BeatmapsetSearchGenre = BeatmapsetSearchGenre.ANY,
+        language: BeatmapsetSearchLanguage = BeatmapsetSearchLanguage.ANY,
+        exclude: Container[int] = (),
+        limit: int = 6,
+    ) -> list[tuple[Beatmap, Beatmapset]]:
+        """
+        the first passing map of up to `limit` beatmapsets, most played first, skipping the
+        beatmapset ids in `exclude`
+        """
+        snapshot = self.get_snapshot()
+        columns = snapshot.columns
+
+        if not len(columns) or limit <= 0:
+            return []
+
+        # candidates from the narrowest range, the other filters only look at those
+        candidates: np.ndarray | None = None
+
+        for name, (minimum, maximum) in beatmap_filter.get_ranges().items():
+            sorted_rows, values = snapshot.sorted[name]
+            low, high = np.searchsorted(values, minimum, "left"), np.searchsorted(
+                values, maximum, "right"
+            )
+
+            if candidates is None or high - low < len(candidates):
+                candidates = sorted_rows[low:high]
+
+        assert candidates is not None
+        # back in popularity order, though scanning every row beats sorting most of them
+        candidates = (
+            np.sort(candidates) if len(candidates) < len(columns) // 4 else None
+        )
+        total = len(columns) if candidates is None else len(candidates)
+        picked: list[tuple[Beatmap, Beatmapset]] = []
+        seen: set[int] = set()
+
+        for start in range(0, total, QUERY_CHUNK):
+            chunk = (
+                None if candidates is None else candidates[start : start + QUERY_CHUNK]
+            )
+            rows: np.ndarray | slice = (
+                slice(start, start + QUERY_CHUNK) if chunk is None else chunk
+            )
+            sets = columns.set_index[rows]
+            mask = beatmap_filter.get_mask(columns, rows)
+
+            if genre != BeatmapsetSearchGenre.ANY:
+                mask &= snapshot.sets["genre"][sets] == genre.value
+
+            if language != BeatmapsetSearchLanguage.ANY:
+                mask &= snapshot.sets["language"][sets] == language.value
+
+            passing = np.flatnonzero(mask) + start if chunk is None else chunk[mask]
+
+            # the first passing map of a set is its hardest one
+            for row, position in zip(passing.tolist(), sets[mask].tolist()):
+                beatmapset = snapshot.beatmapsets[position]
+
+                if position in seen or beatmapset.id in exclude:
+                    continue
+
+                seen.add(position)
+                picked.append((columns.beatmaps[row], beatmapset))
+
+                if len(picked) >= limit:
+                    return picked
+
+        return picked
+
+    def load(self) -> None:
+        """read the saved index once, expects the lock to be held"""
+        if self._is_loaded:
+            return
+
+        self._is_loaded = True
+        self._saved_at = self.clock()
+
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                pages: list[tuple[list[Beatmapset], int, int]] = loads(f.read())
+        except Exception:
+            logger.exception("Failed to load the beatmap index from %s", self.path)
+            return
+
+        for beatmapsets, genre, language in pages:
+            self.add(beatmapsets, None, genre, language)
+
+        logger.info(
+            "Loaded %d beatmapsets into the beatmap index", len(self._positions)
+        )
+
+    def save(self) -> None:
+        with self._lock:
+            entries = list(
+                zip(self.beatmapsets, self._sets["genre"], self._sets["language"])
+            )
+            self._unsaved = 0
+            self._saved_at = self.clock()
+
+        # saved as pages per (genre, language), the way load reads them back
+        pages: dict[tuple[int, int], list[Beatmapset]] = {}
+
+        for beatmapset, genre, language in entries:
+            pages.setdefault((genre, language), []).append(beatmapset)
+
+        data = dumps(
+            [
+                (beatmapsets, genre, language)
+                for (genre, language), beatmapsets in pages.items()
+            ]
+        )
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        with open(f"{self.path}.tmp", "wb") as f:
+            f.write(data)
+
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+beatmap_index = BeatmapIndex()
+
+
+def make_beatmapset(
+    beatmapset_id: int, play_count: int, *beatmaps: Any, **attributes: Any
+) -> Any:
+    """search result stand-in for tests and benchmarks"""
+    return SimpleNamespace(
+        id=beatmapset_id,
+        title=f"set {beatmapset_id}",
+        play_count=play_count,
+        beatmaps=list(beatmaps),
+        **attributes,
+    )
+
+
+class BeatmapIndexTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.index = BeatmapIndex(path="")
+        self.filter = BeatmapFilter(
+            play_mode=0,
+            star=(4.0, 6.0),
+            ar=(9.0, 10.0),
+            cs=(0.0, 10.0),
+            bpm=(0, 300),
+            length=(0, 300),
+            rank_status=frozenset({1}),
+        )
+
+    def query(self, **kwargs: Any) -> list[int]:
+        return [beatmap.id for beatmap, _ in self.index.query(self.filter, **kwargs)]
+
+    def test_query(self):
+        self.index.add_page(
+            [
+                make_beatmapset(
+                    1, 10, make_beatmap(id=11, difficulty_rating=7), make_beatmap(id=12)
+                ),
+                make_beatmapset(2, 30, make_beatmap(id=21, ar=8)),
+                make_beatmapset(
+                    3,
+                    20,
+                    make_beatmap(id=31),
+                    make_beatmap(id=32, difficulty_rating=4.5),
+                ),
+            ]
+        )
+        self.index.add_page([make_beatmapset(4, 40, make_beatmap(id=41, ranked=-2))])
+        self.assertEqual(self.query(), [31, 12])
+        self.assertEqual(self.query(exclude={3}), [12])
+        self.assertEqual(self.query(limit=1), [31])
+
+    def test_replace(self):
+        self.index.add_page([make_beatmapset(1, 10, make_beatmap(id=11))])
+        self.assertEqual(self.query(), [11])
+        self.index.add_page([make_beatmapset(1, 10, make_beatmap(id=11, ranked=-2))])
+        self.assertEqual(self.query(), [])
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(len(self.index.get_index()), 1)
+
+        for _ in range(3):
+            self.index.add_page(
+                [make_beatmapset(1, 10, make_beatmap(id=11), make_beatmap(id=12))]
+            )
+            self.index.add_page([make_beatmapset(2, 20, make_beatmap(id=21))])
+
+        self.assertEqual(self.query(), [21, 11])
+        self.assertEqual(
+            len(self.index.get_index()), 3
+        )  # the rows of replaced copies are dropped
+
+    def test_genre(self):
+        self.index.add_page(
+            [
+                make_beatmapset(1, 10, make_beatmap(id=11)),
+                make_beatmapset(2, 20, make_beatmap(id=21), genre={"id": 3}),
+            ],
+        )
+        self.index.add_page(
+            [make_beatmapset(3, 30, make_beatmap(id=31))],
+            genre=BeatmapsetSearchGenre.ANIME,
+        )
+        self.assertEqual(self.query(genre=BeatmapsetSearchGenre.ANIME), [31, 21])
+        self.assertEqual(self.query(), [31, 21, 11])
+
+        # seen again through an ANY search, it keeps the genre it was found with
+        self.index.add_page([make_beatmapset(3, 30, make_beatmap(id=31))])
+        self.assertEqual(self.query(genre=BeatmapsetSearchGenre.ANIME), [31, 21])
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.index.path = os.path.join(directory, "index.pickle")
+            self.index.add_page(
+                [make_beatmapset(1, 10, make_beatmap(id=11))],
+                genre=BeatmapsetSearchGenre.ANIME,
+            )
+            self.index.save()
+
+            loaded = BeatmapIndex(path=self.index.path)
+            picked = loaded.query(self.filter, BeatmapsetSearchGenre.ANIME)
+            self.assertEqual([beatmap.id for beatmap, _ in picked], [11])
+
+
+if __name__ == "__main__":
+    unittest.main()
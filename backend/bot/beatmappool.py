@@ -0,0 +1,263 @@
+import queue
+import threading
+import time
+import unittest
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable
+from ossapi import Beatmapset, Cursor
+from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
+from bot.beatmapcache import api_seconds
+from bot.beatmapfilter import BeatmapColumns
+from bot.beatmapindex import BeatmapIndex, beatmap_index
+from bot.enums import PLAY_MODE
+from bot.osuapi import osu_api
+from my_logger import get_logger
+
+logger = get_logger("beatmaps")
+
+SearchFingerprint = tuple[PLAY_MODE, BeatmapsetSearchGenre, BeatmapsetSearchLanguage]
+
+
+@dataclass
+class SearchPool:
+    """
+    Pages of one `plays_desc` beatmapset search, fetched once and shared by every room
+    searching with the same fingerprint. Rooms only keep their own page index.
+    """
+
+    play_mode: PLAY_MODE
+    genre: BeatmapsetSearchGenre
+    language: BeatmapsetSearchLanguage
+    search: Callable[..., Any] | None = None
+    index: BeatmapIndex | None = (
+        None  # where fetched pages are indexed, beatmap_index by default
+    )
+    max_pages: int = 100
+
+    pages: list[list[Beatmapset]] = field(default_factory=list)
+    columns: list[BeatmapColumns] = field(
+        default_factory=list
+    )  # pages as arrays for BeatmapFilter
+    first_page: int = (
+        0  # absolute index of pages[0], older pages are dropped past max_pages
+    )
+    is_exhausted: bool = False
+
+    _cursor: Cursor | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def total_pages(self) -> int:
+        return self.first_page + len(self.pages)
+
+    def fetch_page(self) -> None:
+        logger.info("generating beatmaps...")
+        search = self.search or osu_api.search_beatmapsets
+        started = time.perf_counter()
+
+        try:
+            result = search(
+                mode=self.play_mode,
+                sort="plays_desc",
+                cursor=self._cursor,
+                genre=self.genre,
+                language=self.language,
+            )
+        finally:
+            api_seconds.observe(time.perf_counter() - started, ("search",))
+
+        for beatmapset in result.beatmapsets:
+            beatmapset.beatmaps.sort(key=lambda x: x.difficulty_rating, reverse=True)
+
+        columns = BeatmapColumns.from_beatmapsets(result.beatmapsets)
+        self.pages.append(result.beatmapsets)
+        self.columns.append(columns)
+        index = beatmap_index if self.index is None else self.index
+        index.add_page(result.beatmapsets, columns, self.genre, self.language)
+        self._cursor = result.cursor
+        self.is_exhausted = not result.cursor
+
+        if len(self.pages) > self.max_pages:
+            self.pages.pop(0)
+            self.columns.pop(0)
+            self.first_page += 1
+
+    def get_page(
+        self, index: int
+    ) -> tuple[int, list[Beatmapset], BeatmapColumns] | None:
+        """(absolute page index, beatmapsets, their columns) at or after `index`, None past the last page"""
+
+        with self._lock:
+            index = max(index, self.first_page)
+
+            while index >= self.total_pages and not self.is_exhausted:
+                self.fetch_page()
+
+            if index >= self.total_pages:
+                return None
+
+            return (
+                index,
+                self.pages[index - self.first_page],
+                self.columns[index - self.first_page],
+            )
+
+
+@dataclass
+class BeatmapPool:
+    """process wide registry of search pools keyed by search fingerprint"""
+
+    pools: dict[SearchFingerprint, SearchPool] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(
+        self,
+        play_mode: PLAY_MODE,
+        genre: BeatmapsetSearchGenre,
+        language: BeatmapsetSearchLanguage,
+    ) -> SearchPool:
+        fingerprint = (play_mode, genre, language)
+
+        with self._lock:
+            pool = self.pools.get(fingerprint)
+
+            if not pool:
+                pool = self.pools[fingerprint] = SearchPool(
+                    play_mode=play_mode, genre=genre, language=language
+                )
+
+            return pool
+
+
+beatmap_pool = BeatmapPool()
+
+
+@dataclass
+class BeatmapRefiller:
+    """
+    Runs room beatmap refills on a background thread so rotating never waits on the osu! api.
+    A room asking again while its refill is still queued is only refilled once.
+    """
+
+    _jobs: queue.Queue[tuple[int, Callable[[], Any]]] = field(
+        default_factory=queue.Queue
+    )
+    _queued: set[int] = field(default_factory=set)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _thread: threading.Thread | None = None
+
+    def request(self, owner: object, refill: Callable[[], Any]) -> None:
+        with self._lock:
+            if id(owner) in self._queued:
+                return
+
+            self._queued.add(id(owner))
+
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self.run, daemon=True, name="beatmap-refiller"
+                )
+                self._thread.start()
+
+        self._jobs.put((id(owner), refill))
+
+    def run(self) -> None:
+        while True:
+            owner_id, refill = self._jobs.get()
+
+            with self._lock:
+                self._queued.discard(owner_id)
+
+            try:
+                refill()
+            except Exception:
+                logger.exception("Beatmap refill failed")
+            finally:
+                self._jobs.task_done()
+
+    def join(self) -> None:
+        """wait until every queued refill is done"""
+        self._jobs.join()
+
+
+beatmap_refiller = BeatmapRefiller()
+
+
+class SearchPoolTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.searches: list[Any] = []
+
+    def search(self, cursor: Any = None, **kwargs: Any) -> Any:
+        self.searches.append(cursor)
+        page = cursor or 0
+        beatmapsets = [SimpleNamespace(id=page * 10 + i, beatmaps=[]) for i in range(2)]
+        return SimpleNamespace(
+            beatmapsets=beatmapsets, cursor=page + 1 if page < 2 else None
+        )
+
+    def make_pool(self, **kwargs: Any) -> SearchPool:
+        return SearchPool(
+            PLAY_MODE.OSU,
+            BeatmapsetSearchGenre.ANY,
+            BeatmapsetSearchLanguage.ANY,
+            search=self.search,
+            index=BeatmapIndex(path=""),
+            **kwargs,
+        )
+
+    def test_shared_pages(self):
+        pool = self.make_pool()
+        self.assertEqual(pool.get_page(1)[0], 1)  # type: ignore[index]
+        self.assertEqual(pool.get_page(0)[1][0].id, 0)  # type: ignore[index]
+        self.assertEqual(pool.get_page(1)[1][0].id, 10)  # type: ignore[index]
+        self.assertEqual(self.searches, [None, 1])
+
+    def test_exhausted(self):
+        pool = self.make_pool()
+        self.assertIsNotNone(pool.get_page(2))
+        self.assertIsNone(pool.get_page(3))
+        self.assertEqual(len(self.searches), 3)
+
+    def test_max_pages(self):
+        pool = self.make_pool(max_pages=1)
+        pool.get_page(1)
+        self.assertEqual(pool.first_page, 1)
+        self.assertEqual(pool.get_page(0)[0], 1)  # type: ignore[index]
+
+    def test_fingerprint(self):
+        pools = BeatmapPool()
+        pool = pools.get(
+            PLAY_MODE.OSU, BeatmapsetSearchGenre.ANY, BeatmapsetSearchLanguage.ANY
+        )
+        self.assertIs(
+            pools.get(
+                PLAY_MODE.OSU, BeatmapsetSearchGenre.ANY, BeatmapsetSearchLanguage.ANY
+            ),
+            pool,
+        )
+        self.assertIsNot(
+            pools.get(
+                PLAY_MODE.MANIA, BeatmapsetSearchGenre.ANY, BeatmapsetSearchLanguage.ANY
+            ),
+            pool,
+        )
+
+
+class BeatmapRefillerTestCase(unittest.TestCase):
+    def test_deduplicate(self):
+        refiller = BeatmapRefiller()
+        release = threading.Event()
+        calls: list[str] = []
+
+        refiller.request(self, release.wait)
+        refiller.request("room", lambda: calls.append("a"))
+        refiller.request("room", lambda: calls.append("b"))
+        release.set()
+        refiller.join()
+
+        self.assertEqual(calls, ["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+import re
+import unittest
+from dataclasses import dataclass
+from typing import Callable
+from bot.enums import SlotInfo
+from bot.parsers import get_beatmap_id_from_url, normalize_username, parse_slot
+
+
+@dataclass(slots=True)
+class MatchClosed:
+    pass
+
+
+@dataclass(slots=True)
+class MatchStarted:
+    pass
+
+
+@dataclass(slots=True)
+class MatchFinished:
+    pass
+
+
+@dataclass(slots=True)
+class AllPlayersReady:
+    pass
+
+
+@dataclass(slots=True)
+class UserJoined:
+    username: str
+    slot: int
+
+
+@dataclass(slots=True)
+class UserLeft:
+    username: str
+
+
+@dataclass(slots=True)
+class HostChanged:
+    username: str
+
+
+@dataclass(slots=True)
+class BeatmapChangedTo:
+    """`Beatmap changed to: ...`, the lobby map changed (!mp map)"""
+
+    title: str
+    version: str
+    url: str
+    beatmap_id: int
+
+
+@dataclass(slots=True)
+class ChangedBeatmapTo:
+    """`Changed beatmap to ...`, the host picked a map"""
+
+    title: str
+    url: str
+    beatmap_id: int
+
+
+@dataclass(slots=True)
+class PlayerCount:
+    players: int
+
+
+@dataclass(slots=True)
+class MatchCreated:
+    match_id: str
+    name: str
+
+
+BanchoEvent = (
+    MatchClosed
+    | MatchStarted
+    | MatchFinished
+    | AllPlayersReady
+    | UserJoined
+    | UserLeft
+    | HostChanged
+    | BeatmapChangedTo
+    | ChangedBeatmapTo
+    | SlotInfo
+    | PlayerCount
+    | MatchCreated
+)
+
+CONSTANT_EVENTS: dict[str, BanchoEvent] = {
+    "Closed the match": MatchClosed(),
+    "The match has started!": MatchStarted(),
+    "The match has finished!": MatchFinished(),
+    "All players are ready": AllPlayersReady(),
+}
+
+BEATMAP_CHANGED_PATTERN = re.compile(r"Beatmap changed to: (.*)? \[(.*?)\] \((.*)?\)")
+CREATED_PATTERN = re.compile(
+    r"Created the tournament match https://osu\.ppy\.sh/mp/(\d*) (.*)"
+)
+
+# the slot of `joined in slot 3.`, `joined in slot 3 for team red.` or `joined in slot 12.` by its first two
+# characters, a lookup is cheaper than trimming and converting them
+SLOT_NUMBERS = {
+    **{f"{slot}{end}": slot for slot in range(1, 10) for end in ". "},
+    **{str(slot): slot for slot in range(10, 17)},
+}
+
+
+def parse_slot_info(message: str) -> SlotInfo | None:
+    return parse_slot(message) if message[5:6].isdigit() else None
+
+
+def parse_players(message: str) -> PlayerCount | None:
+    players = message[len("Players: ") :]
+    return (
+        PlayerCount(int(players))
+        if message.startswith("Players: ") and players.isdigit()
+        else None
+    )
+
+
+def parse_beatmap_changed(message: str) -> BeatmapChangedTo | None:
+    found = BEATMAP_CHANGED_PATTERN.match(message)
+
+    if not found:
+        return None
+
+    title, version, url = found.groups()
+    return BeatmapChangedTo(title, version, url, int(url.split("/")[-1]))
+
+
+def parse_changed_beatmap(message: str) -> ChangedBeatmapTo | None:
+    if not message.startswith("Changed beatmap to "):
+        return None
+
+    words = message.split(" ")
+    url = words[3]
+    return ChangedBeatmapTo("".join(words[4:]), url, get_beatmap_id_from_url(url))
+
+
+def parse_match_created(message: str) -> MatchCreated | None:
+    found = CREATED_PATTERN.fullmatch(message)
+    return MatchCreated(*found.groups()) if found else None
+
+
+# lines starting with a fixed word, looked up by that first word
+PREFIX_PARSERS: dict[str, Callable[[str], BanchoEvent | None]] = {
+    "Slot": parse_slot_info,
+    "Players:": parse_players,
+    "Beatmap": parse_beatmap_changed,
+    "Changed": parse_changed_beatmap,
+    "Created": parse_match_created,
+}
+
+
+def classify_bancho_message(message: str) -> BanchoEvent | None:
+    """
+    turn a BanchoBot line into a typed event, None for lines the bot ignores.
+    fixed lines are a dict lookup. the per player lines, most of a lobby's traffic, all end in "."
+    and are matched on their suffix first, the rest is dispatched on the first word, so a line
+    goes through at most one parser and one precompiled pattern.
+    """
+
+    event = CONSTANT_EVENTS.get(message)
+
+    if event:
+        return event
+
+    if message.endswith("."):
+        username, joined, slot = message.partition(" joined in slot ")
+
+        if joined:
+            return UserJoined(
+                normalize_username(username), SLOT_NUMBERS.get(slot[:2], 0)
+            )
+
+        if message.endswith(" left the game."):
+            return UserLeft(normalize_username(message[: -len(" left the game.")]))
+
+        if message.endswith(" became the host."):
+            return HostChanged(normalize_username(message[: -len(" became the host.")]))
+
+        if " finished playing (" in message:
+            return None
+
+    # a username can be "Slot" or "Changed" too, those lines were matched above
+    parse = PREFIX_PARSERS.get(message.partition(" ")[0])
+    return parse(message) if parse else None
+
+
+class ClassifierTestCase(unittest.TestCase):
+    def test_constant(self):
+        self.assertEqual(
+            classify_bancho_message("The match has started!"), MatchStarted()
+        )
+        self.assertEqual(classify_bancho_message("Closed the match"), MatchClosed())
+
+    def test_users(self):
+        self.assertEqual(
+            classify_bancho_message("Some Player joined in slot 3."),
+            UserJoined("Some_Player", 3),
+        )
+        self.assertEqual(
+            classify_bancho_message("Some Player joined in slot 3 for team red."),
+            UserJoined("Some_Player", 3),
+        )
+        self.assertEqual(
+            classify_bancho_message("Some Player left the game."),
+            UserLeft("Some_Player"),
+        )
+        self.assertEqual(
+            classify_bancho_message("Some Player became the host."),
+            HostChanged("Some_Player"),
+        )
+        self.assertEqual(
+            classify_bancho_message("Slot joined in slot 12."), UserJoined("Slot", 12)
+        )
+        self.assertIsNone(
+            classify_bancho_message(
+                "Some Player finished playing (Score: 1000, PASSED)."
+            )
+        )
+
+    def test_beatmap(self):
+        self.assertEqual(
+            classify_bancho_message(
+                "Beatmap changed to: Artist - Title [Insane] (https://osu.ppy.sh/b/123)",
+            ),
+            BeatmapChangedTo(
+                "Artist - Title", "Insane", "https://osu.ppy.sh/b/123", 123
+            ),
+        )
+        self.assertEqual(
+            classify_bancho_message(
+                "Changed beatmap to https://osu.ppy.sh/b/456 Artist - Title"
+            ),
+            ChangedBeatmapTo("Artist-Title", "https://osu.ppy.sh/b/456", 456),
+        )
+
+    def test_settings(self):
+        self.assertEqual(classify_bancho_message("Players: 4"), PlayerCount(4))
+        self.assertEqual(
+            classify_bancho_message(
+                "Slot 1  Not Ready https://osu.ppy.sh/u/2 Some Player  [Host / Hidden]"
+            ),
+            SlotInfo(
+                slot=1,
+                status="Not Ready",
+                user_id="2",
+                username="Some_Player",
+                roles=["Host", "Hidden"],
+            ),
+        )
+        self.assertEqual(
+            classify_bancho_message(
+                "Slot 16 No Map    https://osu.ppy.sh/u/7 [Some]  Player   [Team Red]"
+            ),
+            SlotInfo(
+                slot=16,
+                status="No Map",
+                user_id="7",
+                username="[Some]_Player",
+                roles=["TeamRed"],
+            ),
+        )
+
+    def test_created(self):
+        self.assertEqual(
+            classify_bancho_message(
+                "Created the tournament match https://osu.ppy.sh/mp/108 d9f0-room"
+            ),
+            MatchCreated("108", "d9f0-room"),
+        )
+
+    def test_ignored(self):
+        self.assertIsNone(
+            classify_bancho_message(
+                "Room name: test, History: https://osu.ppy.sh/mp/108"
+            )
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
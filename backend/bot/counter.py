@@ -1,67 +1,117 @@
-import threading, time
-from dataclasses import dataclass
+import threading
+from dataclasses import dataclass, field
 from typing import Callable
 import unittest
+from bot.scheduler import FakeClock, Scheduler, Timer, scheduler
 
 
 @dataclass
 class Counter:
+    """
+    Counts down on the shared scheduler thread while start and stop come from the room's listener.
+    Every start and stop begins a new generation, a second scheduled by an older one is ignored.
+    Seconds are due at fixed offsets from the start, a late one doesn't push back the ones after it.
+    """
+
     count: int = 0
-    run_thread: threading.Thread | None = None
     on_finished: Callable[[], None] | None = None
     on_count: Callable[[int], None] | None = None
     is_running: bool = False
+    scheduler: Scheduler = field(default_factory=lambda: scheduler)
+    _timer: Timer | None = None
+    _started_at: float = 0.0
+    _seconds: int = 0  # seconds scheduled since the start
+    _generation: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def run(self, generation: int) -> None:
+        """announce the current count and wait a second on the shared scheduler"""
+        with self._lock:
+            if generation != self._generation or not self.is_running:
+                return
+
+            self._timer = None
+            finished = self.count <= 0
+
+            if finished:
+                self.is_running = False
+            else:
+                count = self.count
+                self._seconds += 1
+                deadline = self._started_at + self._seconds
+                self._timer = self.scheduler.call_at(
+                    deadline, self.next_second, generation
+                )
+
+        # outside the lock, the callbacks may start or stop the counter again
+        if finished:
+            if self.on_finished:
+                self.on_finished()
+        elif self.on_count:
+            self.on_count(count)
+
+    def next_second(self, generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
 
-    def run(self, count: int = 3) -> None:
-        self.count = count
-
-        while self.count and self.is_running:
-            if self.on_count:
-                self.on_count(self.count)
-
-            time.sleep(1)
             self.count -= 1
 
-        if not self.is_running:
-            return
+        self.run(generation)
 
-        if self.on_finished:
-            self.on_finished()
+    def _stop(self) -> None:
+        self._generation += 1
+        self.is_running = False
 
-        return
+        if self._timer:
+            self.scheduler.cancel(self._timer)
+            self._timer = None
 
     def stop(self) -> None:
-        self.is_running = False
+        with self._lock:
+            self._stop()
 
     def start(self, count: int) -> None:
-        if self.run_thread:
-            self.stop()
-            self.run_thread.join()
+        with self._lock:
+            self._stop()
+            self.count = count
+            self._started_at = self.scheduler.clock()
+            self._seconds = 0
+            self.is_running = True
+            generation = self._generation
 
-        self.is_running = True
-        self.run_thread = threading.Thread(target=self.run, args=(count,))
-        self.run_thread.start()
+        self.run(generation)
 
 
 class CounterTestCase(unittest.TestCase):
     def __init__(self, methodName: str = "runTest") -> None:
         super().__init__(methodName)
 
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(clock=self.clock, run_on_thread=False)
+
+    def advance(self, seconds: int) -> None:
+        for _ in range(seconds):
+            self.clock.advance(1)
+            self.scheduler.run_pending()
+
     def test_stop(self):
-        counter = Counter()
+        counter = Counter(scheduler=self.scheduler)
         counter.start(3)
         counter.stop()
         self.assertFalse(counter.is_running)
         self.assertEqual(counter.count, 3)
+        self.assertEqual(len(self.scheduler), 0)
 
     def test_start(self):
-        counter = Counter()
+        counter = Counter(scheduler=self.scheduler)
         counter.start(3)
         self.assertTrue(counter.is_running)
         counter.stop()
 
     def test_multiple_start(self):
-        counter = Counter()
+        counter = Counter(scheduler=self.scheduler)
         counter.start(60)
         self.assertEqual(counter.count, 60)
         counter.stop()
@@ -69,6 +119,60 @@ class CounterTestCase(unittest.TestCase):
         self.assertEqual(counter.count, 40)
         counter.stop()
 
+    def test_count(self):
+        counts: list[int] = []
+        finished: list[bool] = []
+        counter = Counter(
+            scheduler=self.scheduler,
+            on_count=counts.append,
+            on_finished=lambda: finished.append(True),
+        )
+        counter.start(3)
+
+        self.advance(2)
+        self.assertEqual(counts, [3, 2, 1])
+        self.assertFalse(finished)
+
+        self.advance(1)
+        self.assertEqual(finished, [True])
+        self.assertFalse(counter.is_running)
+
+    def test_restart(self):
+        counts: list[int] = []
+        counter = Counter(scheduler=self.scheduler, on_count=counts.append)
+        counter.start(30)
+        counter.start(10)
+
+        self.advance(1)
+        self.assertEqual(counts, [30, 10, 9])
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_late_second(self):
+        counts: list[int] = []
+        counter = Counter(scheduler=self.scheduler, on_count=counts.append)
+        counter.start(3)
+
+        # the scheduler ran the first second half a second late, the next one is still due at 2s
+        self.clock.advance(1.5)
+        self.scheduler.run_pending()
+        self.clock.advance(0.5)
+        self.scheduler.run_pending()
+        self.assertEqual(counts, [3, 2, 1])
+
+    def test_stale_second(self):
+        counts: list[int] = []
+        counter = Counter(scheduler=self.scheduler, on_count=counts.append)
+        counter.start(5)
+        stale = counter._generation
+        counter.start(3)
+
+        counter.next_second(
+            stale
+        )  # a second of the first run, already popped by the scheduler thread
+        self.advance(1)
+        self.assertEqual(counts, [5, 3, 2])
+        self.assertEqual(len(self.scheduler), 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,5 +1,5 @@
 from enum import Enum, IntEnum
-from typing import TypedDict
+from typing import NamedTuple, TypedDict
 from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
 from ossapi import Beatmap
 
@@ -36,6 +36,13 @@ class MESSAGE_YIELD(Enum):
     RECONNECTED = "RECONNECTED"
 
 
+class MESSAGE_PRIORITY(IntEnum):
+    CONTROL = 0  # state changing commands (!mp host, !mp start, !mp map, ...)
+    INFO = (
+        1  # chatter that can be dropped under load (countdowns, !queue replies, links)
+    )
+
+
 class RANK_STATUS(IntEnum):
     RANKED = 1
     APPROVED = 2
@@ -46,21 +53,40 @@ class RANK_STATUS(IntEnum):
     GRAVEYARD = -2
 
 
-class MessageDict(TypedDict):
+class IrcMessage(NamedTuple):
     sender: str
     command: str
     channel: str
     message: str
 
 
-class SlotDict(TypedDict):
-    status: str
+class SlotInfo(NamedTuple):
+    """a `Slot N ...` line of !mp settings"""
+
     slot: int
+    status: str
     user_id: str
     username: str
     roles: list[str]
 
 
+class RoomQuery(NamedTuple):
+    """filters, page and projection of a /room listing, see parse_room_query"""
+
+    bot_mode: str | None = None  # BOT_MODE name
+    play_mode: str | None = None  # PLAY_MODE name
+    is_connected: bool | None = None
+    offset: int = 0
+    limit: int | None = None
+    fields: tuple[
+        str, ...
+    ] = ()  # RoomData keys, "beatmap.<RoomBeatmapData key>" for parts of the beatmap
+
+
+class MessageResponse(TypedDict):
+    message: str
+
+
 class UserCredentials(TypedDict):
     username: str
     password: str
@@ -75,6 +101,7 @@ class RoomData(TypedDict):
     team_mode: str
     score_mode: str
     room_size: int
+    shard: str
     is_connected: bool
     is_configured: bool
     is_created: bool
@@ -95,3 +122,5 @@ class RoomBeatmapData(TypedDict):
     current: Beatmap
     genre: BeatmapsetSearchGenre
     language: BeatmapsetSearchLanguage
+    status: str  # RoomBeatmap.status, "pending" while the maps are generated in the background
+    progress: tuple[int, int]  # maps queued, out of the high-water mark
@@ -0,0 +1,363 @@
+import asyncio
+import itertools
+import threading
+import time
+import unittest
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+BANCHO = ":BanchoBot!cho@ppy.sh PRIVMSG"
+
+
+@dataclass
+class FakeMatch:
+    match_id: int
+    name: str
+    referee: asyncio.StreamWriter  # the connection BanchoBot answers, the last one to join
+    players: list[str] = field(default_factory=list)
+    host: str = ""
+    beatmap_id: int = 0
+    is_playing: bool = False
+
+    @property
+    def channel(self) -> str:
+        return f"#mp_{self.match_id}"
+
+
+@dataclass
+class FakeBancho:
+    """
+    local stand-in for irc.ppy.sh, used to exercise OsuIrc without the real server.
+    Speaks the part of Bancho the bot uses: PASS/NICK, `mp make`, JOIN answered with 332 or 403,
+    and the `!mp` referee commands, with players joining, leaving and chatting driven by the caller.
+    """
+
+    host: str = "127.0.0.1"
+    port: int = 0
+    received: list[str] = field(default_factory=list)
+    keep_received: bool = True  # off for load tests
+    match_length: float = 0.0  # seconds from "!mp start" to "The match has finished!"
+    matches: dict[str, FakeMatch] = field(default_factory=dict)  # "#mp_<id>" -> match
+
+    _loop: asyncio.AbstractEventLoop | None = None
+    _loop_thread: threading.Thread | None = None
+    _server: asyncio.AbstractServer | None = None
+    _clients: list[asyncio.StreamWriter] = field(default_factory=list)
+    _nicknames: dict[asyncio.StreamWriter, str] = field(default_factory=dict)
+    _match_ids: Iterator[int] = field(default_factory=lambda: itertools.count(1))
+
+    def start(self) -> int:
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def run() -> None:
+            assert self._loop
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self.on_client_connected, self.host, self.port)
+            )
+            self.port = self._server.sockets[0].getsockname()[1]
+            started.set()
+            self._loop.run_forever()
+
+        self._loop_thread = threading.Thread(target=run, daemon=True)
+        self._loop_thread.start()
+        started.wait()
+        return self.port
+
+    def stop(self) -> None:
+        if not self._loop or not self._loop_thread:
+            return
+
+        async def shutdown() -> None:
+            for client in self._clients:
+                client.close()
+
+            if self._server:
+                self._server.close()
+                await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+
+    async def on_client_connected(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._clients.append(writer)
+
+        try:
+            while line := await reader.readline():
+                self.on_line(writer, line.decode().rstrip("\r\n"))
+        except ConnectionError:
+            pass
+        finally:
+            if writer in self._clients:
+                self._clients.remove(writer)
+            writer.close()
+
+    def on_line(self, writer: asyncio.StreamWriter, line: str) -> None:
+        if self.keep_received:
+            self.received.append(line)
+
+        command, _, arguments = line.partition(" ")
+
+        if command == "NICK":
+            self._nicknames[writer] = arguments
+            writer.write(
+                f":cho.ppy.sh 001 {arguments} :Welcome to the osu!Bancho.\r\n".encode()
+            )
+        elif command == "JOIN":
+            self.on_join(writer, arguments.lstrip(":"))
+        elif command == "PRIVMSG":
+            target, _, message = arguments.partition(" :")
+            message = message.strip()
+
+            if target == "BanchoBot" and message.startswith("mp make "):
+                self.on_make(writer, message[len("mp make ") :])
+            elif target in self.matches and message.startswith("!mp "):
+                self.on_referee_command(self.matches[target], message[len("!mp ") :])
+
+    def on_make(self, writer: asyncio.StreamWriter, name: str) -> None:
+        match = FakeMatch(next(self._match_ids), name, referee=writer)
+        self.matches[match.channel] = match
+        nickname = self._nicknames.get(writer, "")
+        url = f"https://osu.ppy.sh/mp/{match.match_id}"
+        writer.write(
+            f"{BANCHO} {nickname} :Created the tournament match {url} {name}\r\n".encode()
+        )
+
+    def on_join(self, writer: asyncio.StreamWriter, channel: str) -> None:
+        nickname = self._nicknames.get(writer, "")
+        match = self.matches.get(channel)
+
+        if not match:
+            writer.write(
+                f":cho.ppy.sh 403 {nickname} {channel} :No such channel {channel}\r\n".encode()
+            )
+            return
+
+        match.referee = writer
+        writer.write(f":{nickname}!cho@ppy.sh JOIN :{channel}\r\n".encode())
+        writer.write(
+            f":cho.ppy.sh 332 {nickname} {channel} :multiplayer game #{match.match_id}\r\n".encode()
+        )
+
+    def on_referee_command(self, match: FakeMatch, command: str) -> None:
+        # the bot appends chatter after " | " to some commands, bancho only reads the command
+        name, _, arguments = command.partition(" | ")[0].strip().partition(" ")
+
+        match name:
+            case "name":
+                match.name = arguments
+                self.send_bancho(match, f'Room name updated to "{arguments}"')
+            case "password":
+                self.send_bancho(
+                    match,
+                    "Changed the match password"
+                    if arguments
+                    else "Removed the match password",
+                )
+            case "set":
+                self.send_bancho(match, "Changed match settings")
+            case "mods":
+                self.send_bancho(match, "Enabled FreeMod")
+            case "addref":
+                self.send_bancho(match, f"Added {arguments} to the match referees")
+            case "map":
+                match.beatmap_id = int(arguments.split(" ")[0] or 0)
+                self.send_bancho(
+                    match,
+                    f"Changed beatmap to https://osu.ppy.sh/b/{match.beatmap_id} Fake - Map",
+                )
+            case "host":
+                if arguments in match.players:
+                    match.host = arguments
+                    self.send_bancho(match, f"{arguments} became the host.")
+                else:
+                    self.send_bancho(match, "User not found")
+            case "start":
+                self.start_match(match)
+            case "abort":
+                match.is_playing = False
+                self.send_bancho(match, "Aborted the match")
+            case "settings":
+                self.send_settings(match)
+            case "close":
+                del self.matches[match.channel]
+                self.send_bancho(match, "Closed the match")
+
+    def send_bancho(self, match: FakeMatch, message: str) -> None:
+        match.referee.write(f"{BANCHO} {match.channel} :{message}\r\n".encode())
+
+    def send_settings(self, match: FakeMatch) -> None:
+        lines = [
+            f"Room name: {match.name}, History: https://osu.ppy.sh/mp/{match.match_id}",
+            f"Beatmap: https://osu.ppy.sh/b/{match.beatmap_id} Fake - Map",
+            "Team mode: HeadToHead, Win condition: Score",
+            "Active mods: Freemod",
+            f"Players: {len(match.players)}",
+        ]
+
+        for slot, player in enumerate(match.players, start=1):
+            roles = "[Host]" if player == match.host else ""
+            lines.append(
+                f"Slot {slot}  Not Ready https://osu.ppy.sh/u/{slot} {player:<16} {roles}".rstrip()
+            )
+
+        for line in lines:
+            self.send_bancho(match, line)
+
+    def start_match(self, match: FakeMatch) -> None:
+        if match.is_playing or not self._loop:
+            return
+
+        match.is_playing = True
+        self.send_bancho(match, "The match has started!")
+        self._loop.call_later(self.match_length, self.finish_match, match)
+
+    def finish_match(self, match: FakeMatch) -> None:
+        if match.is_playing and self.matches.get(match.channel) is match:
+            match.is_playing = False
+            self.send_bancho(match, "The match has finished!")
+
+    def call(self, callback: Callable[..., Any], *args: Any) -> None:
+        """run on the server loop, every FakeMatch change goes through here"""
+        assert self._loop
+        self._loop.call_soon_threadsafe(callback, *args)
+
+    def join_player(self, channel: str, username: str) -> None:
+        def join() -> None:
+            match = self.matches.get(channel)
+
+            if match and username not in match.players:
+                match.players.append(username)
+                self.send_bancho(
+                    match, f"{username} joined in slot {len(match.players)}."
+                )
+
+        self.call(join)
+
+    def leave_player(self, channel: str, username: str) -> None:
+        def leave() -> None:
+            match = self.matches.get(channel)
+
+            if match and username in match.players:
+                match.players.remove(username)
+                self.send_bancho(match, f"{username} left the game.")
+
+        self.call(leave)
+
+    def chat(self, channel: str, username: str, message: str) -> None:
+        def send() -> None:
+            match = self.matches.get(channel)
+
+            if match:
+                match.referee.write(
+                    f":{username}!cho@ppy.sh PRIVMSG {channel} :{message}\r\n".encode()
+                )
+
+        self.call(send)
+
+    def ready(self, channel: str) -> None:
+        def send() -> None:
+            match = self.matches.get(channel)
+
+            if match:
+                self.send_bancho(match, "All players are ready")
+
+        self.call(send)
+
+    def push(self, line: str) -> None:
+        """send a raw line to every connected client"""
+        assert self._loop
+
+        def write() -> None:
+            for client in self._clients:
+                client.write(f"{line}\r\n".encode())
+
+        self._loop.call_soon_threadsafe(write)
+
+    def drop_clients(self) -> None:
+        assert self._loop
+
+        def close() -> None:
+            for client in self._clients:
+                client.close()
+
+        self._loop.call_soon_threadsafe(close)
+
+    def wait_for(self, predicate: Callable[[], bool], timeout: float = 5.0) -> bool:
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if predicate():
+                return True
+            time.sleep(0.01)
+
+        return predicate()
+
+
+class FakeBanchoTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        from bot.irc import OsuIrc
+
+        self.bancho = FakeBancho()
+        self.irc = OsuIrc(
+            username="bot",
+            password="secret",
+            host="127.0.0.1",
+            port=self.bancho.start(),
+        )
+        self.messages = self.irc.message_generator()
+        self.irc.start()
+
+    def tearDown(self) -> None:
+        self.irc.stop()
+        self.bancho.stop()
+
+    def next_message(self, *commands: str) -> str:
+        """next line carrying one of `commands`, skips the welcome and the rest"""
+        for message in self.messages:
+            if isinstance(message, str) and message.split(" ")[1] in commands:
+                return message
+
+        return ""
+
+    def test_match(self):
+        self.irc.send_private_message("BanchoBot", "mp make room")
+        self.assertIn(
+            "Created the tournament match https://osu.ppy.sh/mp/1 room",
+            self.next_message("PRIVMSG"),
+        )
+
+        self.irc.send("JOIN #mp_1")
+        self.assertIn(" 332 bot #mp_1 ", self.next_message("332", "403"))
+        self.irc.send("JOIN #mp_2")
+        self.assertIn(" 403 bot #mp_2 ", self.next_message("332", "403"))
+
+        self.bancho.join_player("#mp_1", "player")
+        self.assertTrue(
+            self.next_message("PRIVMSG").endswith(":player joined in slot 1.")
+        )
+        self.irc.send_private_message("#mp_1", "!mp host player")
+        self.assertTrue(
+            self.next_message("PRIVMSG").endswith(":player became the host.")
+        )
+        self.irc.send_private_message("#mp_1", "!mp start")
+        self.assertTrue(
+            self.next_message("PRIVMSG").endswith(":The match has started!")
+        )
+        self.assertTrue(
+            self.next_message("PRIVMSG").endswith(":The match has finished!")
+        )
+
+
+if __name__ == "__main__":
+    bancho = FakeBancho(port=6667)
+    print(f"Fake bancho listening on {bancho.host}:{bancho.start()}")
+
+    try:
+        input("Enter to exit")
+    finally:
+        bancho.stop()
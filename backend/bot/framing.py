@@ -0,0 +1,97 @@
+import unittest
+from dataclasses import dataclass, field
+
+
+@dataclass
+class LineFramer:
+    """
+    Splits a raw irc byte stream into decoded lines.
+    Chunks are appended to one reusable buffer and everything up to the last newline is decoded
+    straight from a memoryview, so a utf-8 character split across two reads is never decoded
+    half way. Consumed bytes are only compacted away once they make up most of the buffer.
+    """
+
+    max_line_length: int = 64 * 1024
+
+    _buffer: bytearray = field(default_factory=bytearray)
+    _start: int = 0  # first byte of the unfinished line
+    _scanned: int = 0  # bytes already searched for a newline
+
+    def __len__(self) -> int:
+        return len(self._buffer) - self._start
+
+    def feed(self, data: bytes) -> list[str]:
+        buffer = self._buffer
+        buffer += data
+
+        start = self._start
+        end = buffer.rfind(b"\n", self._scanned)
+        lines: list[str] = []
+
+        if end != -1:
+            # every complete line is decoded and split in one go, the partial tail stays raw
+            with memoryview(buffer) as view:
+                text = str(view[start:end], "utf-8", "replace")
+
+            lines = text.split("\r\n")
+
+            if len(lines) <= buffer.count(b"\n", start, end):  # bare \n line endings
+                lines = text.replace("\r\n", "\n").split("\n")
+
+            if lines[-1].endswith("\r"):
+                lines[-1] = lines[-1][:-1]
+
+            start = end + 1
+
+        if start == len(buffer):
+            buffer.clear()
+            start = 0
+        elif start > len(buffer) // 2:
+            del buffer[:start]
+            start = 0
+
+        self._start = start
+        self._scanned = len(buffer)
+
+        if len(buffer) - start > self.max_line_length:
+            raise ValueError(f"Line longer than {self.max_line_length} bytes")
+
+        return lines
+
+    def clear(self) -> None:
+        self._buffer.clear()
+        self._start = self._scanned = 0
+
+
+class LineFramerTestCase(unittest.TestCase):
+    def test_lines(self):
+        framer = LineFramer()
+        self.assertEqual(
+            framer.feed(b"PING :cho.ppy.sh\r\n:a PRIVMSG #mp_1 :hi\r\n:b"),
+            ["PING :cho.ppy.sh", ":a PRIVMSG #mp_1 :hi"],
+        )
+        self.assertEqual(framer.feed(b" QUIT :ping\r"), [])
+        self.assertEqual(framer.feed(b"\n\n"), [":b QUIT :ping", ""])
+        self.assertEqual(len(framer), 0)
+
+    def test_split_character(self):
+        framer = LineFramer()
+        data = ":a PRIVMSG #mp_1 :こんにちは\r\n".encode()
+
+        lines = [
+            line
+            for index in range(len(data))
+            for line in framer.feed(data[index : index + 1])
+        ]
+        self.assertEqual(lines, [":a PRIVMSG #mp_1 :こんにちは"])
+
+    def test_max_line_length(self):
+        framer = LineFramer(max_line_length=8)
+        self.assertEqual(framer.feed(b"12345678\n1234"), ["12345678"])
+
+        with self.assertRaises(ValueError):
+            framer.feed(b"56789")
+
+
+if __name__ == "__main__":
+    unittest.main()
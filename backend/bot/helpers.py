@@ -1,12 +1,15 @@
 import json
 import os
-from typing import Any
+from typing import Any, Mapping
 from bot.enums import (
     BOT_MODE,
     PLAY_MODE,
     SCORE_MODE,
     TEAM_MODE,
     RANK_STATUS,
+    RoomBeatmapData,
+    RoomData,
+    RoomQuery,
     UserCredentials,
 )
 from ossapi.enums import BeatmapsetSearchGenre, BeatmapsetSearchLanguage
@@ -29,7 +32,9 @@ def get_user_credentials() -> UserCredentials:
         configuration = json.loads(f.read())
 
     if not configuration.get("username") or not configuration.get("password"):
-        raise KeyError("No user IRC credentials found! set config.json or env vars to continue...")
+        raise KeyError(
+            "No user IRC credentials found! set config.json or env vars to continue..."
+        )
 
     return {
         "username": configuration.get("username"),
@@ -37,6 +42,36 @@ def get_user_credentials() -> UserCredentials:
     }
 
 
+def get_extra_credentials() -> list[UserCredentials]:
+    """
+    more bot accounts to shard rooms over, from `EXTRA_ACCOUNTS` ("username:password,...")
+    or the `accounts` list of config.json
+    """
+    accounts = os.environ.get("EXTRA_ACCOUNTS")
+
+    if accounts:
+        credentials = [
+            account.strip().partition(":") for account in accounts.split(",")
+        ]
+        return [
+            {"username": username, "password": password}
+            for username, _, password in credentials
+            if password
+        ]
+
+    if not os.path.exists("config.json"):
+        return []
+
+    with open("config.json", "r") as f:
+        configuration = json.loads(f.read())
+
+    return [
+        {"username": account["username"], "password": account["password"]}
+        for account in configuration.get("accounts", [])
+        if account.get("username") and account.get("password")
+    ]
+
+
 def parse_beatmap_data(beatmap: dict[str, Any]) -> dict[str, Any]:
     required_keys = [
         "star",
@@ -50,9 +85,15 @@ def parse_beatmap_data(beatmap: dict[str, Any]) -> dict[str, Any]:
         "language",
     ]
 
-    if not isinstance(beatmap, dict) or not all(key in beatmap for key in required_keys):
+    if not isinstance(beatmap, dict) or not all(
+        key in beatmap for key in required_keys
+    ):
         raise ValueError("Invalid beatmap data")
 
+    # read only parts of RoomBeatmap.get_json, in case a client sends the room back as it got it
+    for key in ["lists", "current", "status", "progress"]:
+        beatmap.pop(key, None)
+
     keys_to_convert = ["star", "ar", "cs", "od", "length", "bpm"]
 
     for key in keys_to_convert:
@@ -104,6 +145,59 @@ def parse_room_data(room: dict[str, Any]) -> dict[str, Any]:
     return room
 
 
+def parse_fields(fields: str) -> tuple[str, ...]:
+    """`name,users,beatmap.current` into room fields, an empty string selects every field"""
+    selected = tuple(field.strip() for field in fields.split(",") if field.strip())
+
+    for field in selected:
+        name, _, beatmap_field = field.partition(".")
+
+        if name not in RoomData.__annotations__ or (
+            beatmap_field
+            and (
+                name != "beatmap"
+                or beatmap_field not in RoomBeatmapData.__annotations__
+            )
+        ):
+            raise ValueError(f"Unknown field {field}")
+
+    return selected
+
+
+def parse_room_query(args: Mapping[str, str]) -> RoomQuery:
+    """/room query string: bot_mode, play_mode, is_connected, offset, limit and fields"""
+    bot_mode = args.get("bot_mode")
+    play_mode = args.get("play_mode")
+    is_connected = args.get("is_connected")
+
+    if bot_mode and bot_mode not in BOT_MODE.__members__:
+        raise ValueError("Bot mode is invalid.")
+
+    if play_mode and play_mode not in PLAY_MODE.__members__:
+        raise ValueError("Play mode is invalid.")
+
+    if is_connected and is_connected not in ("true", "false"):
+        raise ValueError("is_connected must be true or false.")
+
+    try:
+        offset = int(args.get("offset") or 0)
+        limit = int(args["limit"]) if args.get("limit") else None
+    except ValueError:
+        raise ValueError("offset and limit must be numbers.")
+
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset and limit can't be negative.")
+
+    return RoomQuery(
+        bot_mode=bot_mode or None,
+        play_mode=play_mode or None,
+        is_connected=is_connected == "true" if is_connected else None,
+        offset=offset,
+        limit=limit,
+        fields=parse_fields(args.get("fields", "")),
+    )
+
+
 def extract_enum(enum: Any) -> list[str]:
     return [a.name for a in enum]
 
@@ -1,11 +1,40 @@
-import socket
+import asyncio
+import os
 import threading
-import time
 import queue
+import unittest
+from collections import deque
 from dataclasses import dataclass, field
 from typing import Generator
-from my_logger import logger
-from bot.enums import MESSAGE_YIELD
+from my_logger import get_logger
+from bot.enums import MESSAGE_PRIORITY, MESSAGE_YIELD
+from bot.framing import LineFramer
+from bot.metrics import WAIT_BUCKETS, metrics
+from bot.outbound import OutboundQueue, TokenBucket, get_channel
+
+logger = get_logger("irc")
+traffic_logger = get_logger("traffic")  # every line sent or dropped, see LOG_SAMPLE
+
+lines_received = metrics.counter(
+    "irc_lines_received_total", "Lines read from bancho.", ("account",)
+)
+reconnects = metrics.counter(
+    "irc_reconnects_total", "Connections reestablished after being lost.", ("account",)
+)
+outbound_depth = metrics.gauge(
+    "irc_outbound_queue_depth", "Messages waiting to be sent.", ("account",)
+)
+outbound_wait = metrics.histogram(
+    "irc_outbound_wait_seconds",
+    "Time from queueing a message to sending it.",
+    ("account",),
+    WAIT_BUCKETS,
+)
+rate_limit_wait = metrics.counter(
+    "irc_rate_limit_wait_seconds_total",
+    "Time the sender spent waiting for a rate limit token.",
+    ("account",),
+)
 
 
 @dataclass
@@ -14,114 +43,403 @@ class OsuIrc:
     password: str
     host: str = "irc.ppy.sh"
     port: int = 6667
-    irc_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     is_running: bool = False
     is_connected: bool = False
-    send_cooldown_per_second = 0.6  #! 10 message per 5 seconds
+    connect_timeout: float = 10.0
+    reconnect_delay: float = 5.0
+    recv_buffer_size: int = int(os.environ.get("IRC_RECV_BUFFER_SIZE", 64 * 1024))
+
+    _loop: asyncio.AbstractEventLoop | None = None
+    _loop_thread: threading.Thread | None = None
+    _main_task: asyncio.Task[None] | None = None
+    _reader: asyncio.StreamReader | None = None
+    _writer: asyncio.StreamWriter | None = None
+    rate_limiter: TokenBucket = field(
+        default_factory=TokenBucket
+    )  #! 10 message per 5 seconds
+    outbound: OutboundQueue = field(default_factory=OutboundQueue)
 
-    message_queue: queue.Queue[str] = field(default_factory=queue.Queue)
-    sender_thread: threading.Thread | None = None
+    _connected: asyncio.Event | None = None
+    _outgoing_ready: asyncio.Event | None = None
+    _pending: deque[tuple[str, MESSAGE_PRIORITY]] = field(
+        default_factory=deque
+    )  # messages sent before the loop started
+    _incoming: queue.Queue[str | MESSAGE_YIELD | None] = field(
+        default_factory=queue.Queue
+    )
 
-    def connect(self, timeout: float = 10.0) -> bool:
-        logger.info(f"~ Connecting to {self.host}:{self.port}...")
+    async def connect(self) -> bool:
+        logger.info("~ Connecting to %s:%s...", self.host, self.port)
         self.is_connected = False
 
         if not self.username or not self.password:
             logger.info("~ Connection refused! no username or password supplied")
-            time.sleep(1)
             return self.is_connected
 
-        self.irc_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.irc_socket.settimeout(timeout)
-
         try:
-            self.irc_socket.connect((self.host, self.port))
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host, self.port, limit=self.recv_buffer_size
+                ),
+                self.connect_timeout,
+            )
             logger.info("~ Connected!")
-            self.is_connected = True
-            self.direct_send(f"PASS {self.password}")
-            self.direct_send(f"NICK {self.username}")
-        except TimeoutError:
+            await self.direct_send(f"PASS {self.password}")
+            await self.direct_send(f"NICK {self.username}")
+        except asyncio.TimeoutError:
             logger.info("~ Timeout Error!")
-        except (socket.gaierror, ConnectionRefusedError):
+            self._close_writer()
+            return self.is_connected
+        except OSError:
+            # also a connection reset while logging in
             logger.info("~ No Internet Connection!")
+            self._close_writer()
+            return self.is_connected
+
+        self.is_connected = True
 
+        assert self._connected
+        self._connected.set()
         return self.is_connected
 
     def disconnect(self) -> None:
-        self.is_connected = False
-        self.irc_socket.close()
+        """drop the current connection, the connection loop will reconnect while running"""
+        if self._loop and self._writer:
+            self._loop.call_soon_threadsafe(self._writer.close)
 
     def close(self) -> None:
-        self.is_running = False
-        self.disconnect()
+        self.stop()
 
-    def receive(self, size: int = 2048) -> str:
-        return self.irc_socket.recv(size).decode()
+    async def run_sender(self) -> None:
+        assert self._outgoing_ready and self._connected
 
-    def run_sender(self) -> None:
-        while self.is_running:
-            if not self.message_queue.empty() and self.is_connected:
-                message = self.message_queue.get()
-                self.direct_send(message)
-                time.sleep(self.send_cooldown_per_second)
+        while True:
+            while not self.outbound:
+                self._outgoing_ready.clear()
+                await self._outgoing_ready.wait()
 
-    def direct_send(self, message: str) -> None:
-        logger.debug(f"SEND: {message}")
-        self.irc_socket.send(f"{message}\n".encode())
+            await self._connected.wait()
 
-    def send(self, message: str) -> bool:
-        self.message_queue.put(message)
-        return self.is_connected
+            # the next message is picked only once a token is free, so rooms that queued
+            # while we waited still get their turn
+            while delay := self.rate_limiter.delay():
+                rate_limit_wait.inc(delay, (self.username,))
+                await asyncio.sleep(delay)
 
-    def send_private_message(self, channel: str, message: str) -> bool:
-        return self.send(f"PRIVMSG {channel} : {message}")
+            message = self.outbound.pop()
+            outbound_depth.set(len(self.outbound), (self.username,))
 
-    def message_generator(self) -> Generator[str | MESSAGE_YIELD, None, None]:
-        """generate live user messages"""
+            if not message:
+                continue
 
-        buffer: str = ""
+            outbound_wait.observe(
+                self.outbound.clock() - message.queued_at, (self.username,)
+            )
 
-        while self.is_running:
-            if not self.is_connected:
-                reconnected: bool = self.connect()
+            try:
+                await self.direct_send(message.line)
+                self.rate_limiter.consume()
+            except ConnectionError:
+                # sent again first thing after the reconnect, closing the writer ends the receiver
+                logger.info("~ Send error, message kept for the reconnect")
+                self.outbound.requeue(message)
+                self._connected.clear()
+                self._close_writer()
+            except Exception:
+                logger.exception("~ Failed to send %s", message.line)
 
-                if reconnected:
-                    yield MESSAGE_YIELD.RECONNECTED
-                else:
-                    yield MESSAGE_YIELD.RECONECTION_FAILED
+    async def run_receiver(self) -> None:
+        assert self._reader
+        framer = LineFramer()
 
-                continue
+        while data := await self._reader.read(self.recv_buffer_size):
+            lines = framer.feed(data)
+            lines_received.inc(len(lines), (self.username,))
 
-            try:
-                message: str = self.receive()
-            except Exception:
-                logger.info(f"~ Connection has been lost. Receive error")
-                self.disconnect()
-                yield MESSAGE_YIELD.DISCONNECT
-                continue
+            for line in lines:
+                self._incoming.put(line)
 
-            if message:
-                messages: list[str] = f"{buffer}{message}".split("\n")
-                buffer = messages[-1]
+    async def run_connection(self) -> None:
+        assert self._connected
+        sender = asyncio.create_task(self.run_sender())
+        was_disconnected = False
 
-                yield from messages[0:-1]
-                continue
+        try:
+            while self.is_running:
+                if not await self.connect():
+                    if was_disconnected:
+                        self._incoming.put(MESSAGE_YIELD.RECONECTION_FAILED)
+
+                    was_disconnected = True
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+
+                if was_disconnected:
+                    reconnects.inc(labels=(self.username,))
+                    self._incoming.put(MESSAGE_YIELD.RECONNECTED)
+
+                try:
+                    await self.run_receiver()
+                    logger.info("~ Connection has been lost. 0 byte message")
+                except (ConnectionError, ValueError):
+                    logger.info("~ Connection has been lost. Receive error")
+
+                self._connected.clear()
+                self.is_connected = False
+                self._close_writer()
+                self._incoming.put(MESSAGE_YIELD.DISCONNECT)
+                was_disconnected = True
+        finally:
+            sender.cancel()
+            self._connected.clear()
+            self.is_connected = False
+            self._close_writer()
+
+    def _close_writer(self) -> None:
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def direct_send(self, message: str) -> None:
+        if not self._writer:
+            raise ConnectionError("Not connected")
+
+        traffic_logger.debug("SEND: %s", message)
+        self._writer.write(f"{message}\n".encode())
+        await self._writer.drain()
+
+    def enqueue(self, message: str, priority: MESSAGE_PRIORITY) -> None:
+        assert self._outgoing_ready
+
+        if self.outbound.put(message, priority):
+            outbound_depth.set(len(self.outbound), (self.username,))
+            self._outgoing_ready.set()
+        else:
+            traffic_logger.debug("DROP: %s", message)
+
+    def send(
+        self, message: str, priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.CONTROL
+    ) -> bool:
+        if self._loop:
+            self._loop.call_soon_threadsafe(self.enqueue, message, priority)
+        else:
+            self._pending.append((message, priority))
+
+        return self.is_connected
+
+    def send_private_message(
+        self,
+        channel: str,
+        message: str,
+        priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.CONTROL,
+    ) -> bool:
+        return self.send(f"PRIVMSG {channel} : {message}", priority)
+
+    def discard_channel(self, channel: str) -> None:
+        """drop the messages still queued for a channel"""
+        if self._loop:
+            self._loop.call_soon_threadsafe(self.outbound.discard, channel)
+            return
+
+        self.outbound.discard(channel)
+        self._pending = deque(
+            pending for pending in self._pending if get_channel(pending[0]) != channel
+        )
+
+    def get_queue_stats(self) -> dict[str, dict[str, float]]:
+        """outbound queue depth and wait time per channel"""
+        return {
+            channel: stats.get_json()
+            for channel, stats in list(self.outbound.stats.items())
+        }
+
+    def message_generator(self) -> Generator[str | MESSAGE_YIELD, None, None]:
+        """generate live user messages, blocks until a line arrives or the irc is stopped"""
 
-            yield MESSAGE_YIELD.DISCONNECT
-            self.disconnect()
-            logger.info("~ Connection has been lost. 0 byte message")
+        incoming = self._incoming
+
+        while True:
+            message = incoming.get()
+
+            if message is None:
+                return
+
+            yield message
 
     def start(self) -> None:
+        if self.is_running:
+            return
+
         self.is_running = True
+        self._incoming = queue.Queue()
+        self._outgoing_ready = asyncio.Event()
+        self._connected = asyncio.Event()
+
+        while self._pending:
+            self.enqueue(*self._pending.popleft())
 
-        self.sender_thread = threading.Thread(target=self.run_sender, args=())
-        self.sender_thread.start()
+        self._loop = asyncio.new_event_loop()
+        self._main_task = self._loop.create_task(self.run_connection())
 
-        self.connect()
+        def run() -> None:
+            assert self._loop and self._main_task
+            asyncio.set_event_loop(self._loop)
+
+            try:
+                self._loop.run_until_complete(self._main_task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self._loop.close()
+
+        self._loop_thread = threading.Thread(target=run, daemon=True)
+        self._loop_thread.start()
 
     def stop(self) -> None:
+        if not self.is_running:
+            return
+
         self.is_running = False
-        self.disconnect()
 
-        if self.sender_thread:
-            self.sender_thread.join()
+        if self._loop and self._main_task:
+            self._loop.call_soon_threadsafe(self._main_task.cancel)
+
+        if self._loop_thread and self._loop_thread is not threading.current_thread():
+            self._loop_thread.join()
+
+        self._loop = None
+        self._main_task = None
+        self._incoming.put(None)
+
+
+class OsuIrcTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        from bot.fakebancho import FakeBancho
+
+        self.bancho = FakeBancho()
+        port = self.bancho.start()
+        self.irc = OsuIrc(
+            username="tester",
+            password="secret",
+            host="127.0.0.1",
+            port=port,
+            reconnect_delay=0.05,
+        )
+        self.irc.rate_limiter.capacity = 100
+
+    def tearDown(self) -> None:
+        self.irc.stop()
+        self.bancho.stop()
+
+    def test_login(self):
+        self.irc.start()
+        self.assertTrue(
+            self.bancho.wait_for(lambda: "NICK tester" in self.bancho.received)
+        )
+        self.assertEqual(self.bancho.received[:2], ["PASS secret", "NICK tester"])
+
+    def test_reset_during_login(self):
+        resets = [ConnectionResetError()]
+        direct_send = self.irc.direct_send
+
+        async def send(message: str) -> None:
+            if message.startswith("PASS") and resets:
+                raise resets.pop()
+
+            await direct_send(message)
+
+        setattr(self.irc, "direct_send", send)
+        self.irc.start()
+        self.assertTrue(
+            self.bancho.wait_for(lambda: "NICK tester" in self.bancho.received)
+        )
+        self.assertTrue(self.irc.is_running)
+
+    def test_send_errors(self):
+        errors: dict[str, Exception] = {
+            "!mp start": ConnectionResetError(),
+            "!mp abort": ValueError(),
+        }
+        direct_send = self.irc.direct_send
+
+        async def send(message: str) -> None:
+            if error := errors.pop(message.partition(" : ")[2], None):
+                raise error
+
+            await direct_send(message)
+
+        self.irc.start()
+        self.assertTrue(
+            self.bancho.wait_for(lambda: "NICK tester" in self.bancho.received)
+        )
+        setattr(self.irc, "direct_send", send)
+
+        for message in ["!mp start", "!mp abort", "!mp close"]:
+            self.irc.send_private_message("#mp_1", message)
+
+        # the reset one is sent again after the reconnect, the one failing otherwise is dropped
+        self.assertTrue(
+            self.bancho.wait_for(
+                lambda: "PRIVMSG #mp_1 : !mp close" in self.bancho.received
+            )
+        )
+        sent = [line for line in self.bancho.received if line.startswith("PRIVMSG")]
+        self.assertEqual(
+            sent, ["PRIVMSG #mp_1 : !mp start", "PRIVMSG #mp_1 : !mp close"]
+        )
+
+    def test_send_before_start(self):
+        self.irc.send_private_message("#mp_1", "!mp start")
+        self.irc.start()
+        self.assertTrue(
+            self.bancho.wait_for(
+                lambda: "PRIVMSG #mp_1 : !mp start" in self.bancho.received
+            )
+        )
+
+    def test_rate_limit(self):
+        self.irc.rate_limiter = TokenBucket(capacity=2, period=0.3)
+        self.irc.start()
+
+        for message in ["a", "b", "c"]:
+            self.irc.send_private_message("#mp_1", message)
+
+        self.assertTrue(
+            self.bancho.wait_for(lambda: "PRIVMSG #mp_1 : b" in self.bancho.received)
+        )
+        self.assertNotIn("PRIVMSG #mp_1 : c", self.bancho.received)
+        self.assertTrue(
+            self.bancho.wait_for(lambda: "PRIVMSG #mp_1 : c" in self.bancho.received)
+        )
+        self.assertGreater(self.irc.get_queue_stats()["#mp_1"]["max_wait"], 0.2)
+
+    def test_message_generator(self):
+        self.irc.start()
+        messages = self.irc.message_generator()
+        welcome = next(messages)
+        self.assertTrue(
+            isinstance(welcome, str) and welcome.startswith(":cho.ppy.sh 001 tester")
+        )
+
+        self.bancho.push(":BanchoBot!cho@ppy.sh PRIVMSG #mp_1 :The match has started!")
+        self.assertEqual(
+            next(messages),
+            ":BanchoBot!cho@ppy.sh PRIVMSG #mp_1 :The match has started!",
+        )
+
+        self.irc.stop()
+        self.assertEqual(list(messages), [])
+
+    def test_reconnect(self):
+        self.irc.start()
+        messages = self.irc.message_generator()
+        next(messages)
+
+        self.bancho.drop_clients()
+        self.assertEqual(next(messages), MESSAGE_YIELD.DISCONNECT)
+        self.assertEqual(next(messages), MESSAGE_YIELD.RECONNECTED)
+        self.assertTrue(self.irc.is_connected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import bisect
+import math
+import threading
+import unittest
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+Labels = tuple[str, ...]  # label values, in the order of the metric's label names
+
+# seconds, for handler and parse times up to osu! api calls
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+# seconds, for messages waiting on the bancho rate limit
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: tuple[tuple[str, str], ...]
+    value: float
+
+
+class MetricFamily(NamedTuple):
+    """a collected metric, plain tuples so it can cross process boundaries"""
+
+    name: str
+    kind: str
+    help: str
+    samples: list[Sample]
+
+
+@dataclass
+class Counter:
+    name: str
+    help: str
+    label_names: tuple[str, ...] = ()
+    _values: dict[Labels, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get(self, labels: Labels = ()) -> float:
+        return self._values.get(labels, 0.0)
+
+    def collect(self) -> list[Sample]:
+        with self._lock:
+            values = list(self._values.items())
+
+        return [
+            Sample(self.name, tuple(zip(self.label_names, labels)), value)
+            for labels, value in values
+        ]
+
+
+@dataclass
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, labels: Labels = ()) -> None:
+        self._values[labels] = value
+
+
+@dataclass
+class Histogram:
+    name: str
+    help: str
+    label_names: tuple[str, ...] = ()
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    _counts: dict[Labels, list[int]] = field(
+        default_factory=dict
+    )  # per bucket, the last one is +Inf
+    _sums: dict[Labels, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    kind = "histogram"
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._counts.get(labels)
+
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+
+            counts[index] += 1
+            self._sums[labels] = self._sums.get(labels, 0.0) + value
+
+    def get_count(self, labels: Labels = ()) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def collect(self) -> list[Sample]:
+        with self._lock:
+            values = [
+                (labels, list(counts), self._sums[labels])
+                for labels, counts in self._counts.items()
+            ]
+
+        samples = []
+
+        for labels, counts, total in values:
+            named = tuple(zip(self.label_names, labels))
+            cumulative = 0
+
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                samples.append(
+                    Sample(
+                        f"{self.name}_bucket",
+                        (*named, ("le", format_value(bound))),
+                        cumulative,
+                    )
+                )
+
+            samples.append(Sample(f"{self.name}_sum", named, total))
+            samples.append(Sample(f"{self.name}_count", named, cumulative))
+
+        return samples
+
+
+Metric = Counter | Gauge | Histogram
+
+
+@dataclass
+class MetricRegistry:
+    """
+    Metrics of the process, updated in place on the hot paths (a lock and an add) and only
+    formatted when /metrics is scraped.
+    """
+
+    metrics: dict[str, Metric] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(
+        self, name: str, help: str, label_names: tuple[str, ...] = ()
+    ) -> Counter:
+        metric = self.register(Counter(name, help, label_names))
+        assert type(metric) is Counter
+        return metric
+
+    def gauge(self, name: str, help: str, label_names: tuple[str, ...] = ()) -> Gauge:
+        metric = self.register(Gauge(name, help, label_names))
+        assert isinstance(metric, Gauge)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        metric = self.register(Histogram(name, help, label_names, buckets))
+        assert isinstance(metric, Histogram)
+        return metric
+
+    def collect(self) -> list[MetricFamily]:
+        return [
+            MetricFamily(metric.name, metric.kind, metric.help, metric.collect())
+            for metric in list(self.metrics.values())
+        ]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def add_label(
+    families: list[MetricFamily], name: str, value: str
+) -> list[MetricFamily]:
+    """every sample labelled, to tell apart the metrics collected from several processes"""
+    return [
+        family._replace(
+            samples=[
+                sample._replace(labels=((name, value), *sample.labels))
+                for sample in family.samples
+            ]
+        )
+        for family in families
+    ]
+
+
+def merge(families: list[MetricFamily]) -> list[MetricFamily]:
+    """one family per name, the samples of families with the same name concatenated"""
+    merged: dict[str, MetricFamily] = {}
+
+    for family in families:
+        if family.name in merged:
+            merged[family.name].samples.extend(family.samples)
+        else:
+            merged[family.name] = family._replace(samples=list(family.samples))
+
+    return list(merged.values())
+
+
+def render(families: list[MetricFamily]) -> str:
+    """Prometheus text exposition format 0.0.4"""
+    lines = []
+
+    for family in families:
+        lines.append(f"# HELP {family.name} {family.help}")
+        lines.append(f"# TYPE {family.name} {family.kind}")
+
+        for sample in family.samples:
+            labels = ",".join(
+                f'{name}="{escape_label(value)}"' for name, value in sample.labels
+            )
+            series = f"{sample.name}{{{labels}}}" if labels else sample.name
+            lines.append(f"{series} {format_value(sample.value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+metrics = MetricRegistry()
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = MetricRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("lines_total", "Lines.", ("account",))
+        counter.inc(labels=("bot",))
+        counter.inc(2, labels=("bot",))
+        self.assertIs(
+            self.registry.counter("lines_total", "Lines.", ("account",)), counter
+        )
+        self.assertEqual(
+            render(self.registry.collect()),
+            '# HELP lines_total Lines.\n# TYPE lines_total counter\nlines_total{account="bot"} 3\n',
+        )
+
+    def test_histogram(self):
+        histogram = self.registry.histogram(
+            "handler_seconds", "Handler time.", buckets=(0.1, 1.0)
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        self.assertEqual(histogram.get_count(), 3)
+        text = render(self.registry.collect())
+        self.assertIn('handler_seconds_bucket{le="0.1"} 1\n', text)
+        self.assertIn('handler_seconds_bucket{le="1"} 2\n', text)
+        self.assertIn(
+            'handler_seconds_bucket{le="+Inf"} 3\nhandler_seconds_sum 2.55\nhandler_seconds_count 3\n',
+            text,
+        )
+
+    def test_merge(self):
+        self.registry.gauge("depth", "Depth.").set(4)
+        families = merge(
+            add_label(self.registry.collect(), "worker", "first")
+            + add_label(self.registry.collect(), "worker", 'b"')
+        )
+        self.assertEqual(
+            render(families),
+            '# HELP depth Depth.\n# TYPE depth gauge\ndepth{worker="first"} 4\ndepth{worker="b\\""} 4\n',
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,64 @@
 import os
+import threading
+import unittest
+from dataclasses import dataclass, field
+from typing import Any, Callable
 from ossapi import Ossapi
 
-osu_api = Ossapi(os.environ.get("CLIENT_ID"), os.environ.get("CLIENT_SECRET"))
+
+@dataclass
+class LazyApi:
+    """
+    Ossapi, built on first use. Building it fetches an OAuth token, so importing the bot
+    (app.py, tests, worker processes) neither waits on nor needs the osu! api.
+    """
+
+    client_id: str | None = None
+    client_secret: str | None = None
+    factory: Callable[[str | None, str | None], Any] = Ossapi
+
+    _api: Any = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def get(self) -> Ossapi:
+        if self._api is None:
+            with self._lock:
+                if self._api is None:
+                    self._api = self.factory(self.client_id, self.client_secret)
+
+        return self._api
+
+    def __getattr__(self, name: str) -> Any:
+        # only reached for attributes LazyApi doesn't have itself, the api methods.
+        # private ones are missing while copy or pickle rebuild the instance, don't build the api for those
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self.get(), name)
+
+
+osu_api: Ossapi = LazyApi(os.environ.get("CLIENT_ID"), os.environ.get("CLIENT_SECRET"))
+
+
+class LazyApiTestCase(unittest.TestCase):
+    def test_lazy(self):
+        built: list[tuple[str | None, str | None]] = []
+
+        class Api:
+            def __init__(
+                self, client_id: str | None, client_secret: str | None
+            ) -> None:
+                built.append((client_id, client_secret))
+
+            def beatmap(self, beatmap_id: int) -> int:
+                return beatmap_id
+
+        api: Any = LazyApi("id", "secret", factory=Api)
+        self.assertEqual(built, [])
+        self.assertEqual(api.beatmap(7), 7)
+        self.assertEqual(api.beatmap(8), 8)
+        self.assertEqual(built, [("id", "secret")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,523 @@
+import time
+import unittest
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable
+from bot.enums import MESSAGE_PRIORITY
+from bot.scheduler import FakeClock
+
+
+def get_channel(line: str) -> str:
+    """target channel of a raw irc line, empty for lines without one (PASS, NICK, ...)"""
+    command, _, rest = line.partition(" ")
+
+    if command in {"PRIVMSG", "JOIN", "PART"}:
+        return rest.partition(" ")[0]
+
+    return ""
+
+
+# pending messages starting with one of these are superseded by newer ones of the same kind
+COALESCE_PREFIXES = {
+    "!mp map ": "!mp map",
+    "!mp host ": "!mp host",
+    "Match starts in ": "countdown",
+    "Countdown aborted": "countdown",
+}
+
+
+def get_coalesce_key(line: str) -> str:
+    """messages with the same key on the same channel collapse into the latest one, empty for the rest"""
+    text = line.partition(" :")[2].lstrip()
+
+    for prefix, key in COALESCE_PREFIXES.items():
+        if text.startswith(prefix):
+            return key
+
+    return ""
+
+
+@dataclass
+class TokenBucket:
+    """
+    Bancho allows `capacity` messages per `period` seconds.
+    Every spent token comes back `period` seconds after it was spent, so a full bucket can burst
+    the whole budget at once and no `period` window ever carries more than `capacity` messages.
+    """
+
+    capacity: int = 10
+    period: float = 5.0
+    clock: Callable[[], float] = time.monotonic
+    _spent: deque[float] = field(
+        default_factory=deque
+    )  # refill time of every spent token
+
+    def refill(self) -> None:
+        now = self.clock()
+
+        while self._spent and self._spent[0] <= now:
+            self._spent.popleft()
+
+    @property
+    def tokens(self) -> int:
+        self.refill()
+        return self.capacity - len(self._spent)
+
+    def delay(self) -> float:
+        """seconds until a token is available"""
+        if self.tokens > 0:
+            return 0.0
+
+        return max(self._spent[0] - self.clock(), 0.0)
+
+    def consume(self) -> bool:
+        if self.tokens <= 0:
+            return False
+
+        self._spent.append(self.clock() + self.period)
+        return True
+
+    def get_spent(self) -> int:
+        """tokens spent within the last period, read only so other threads can poll it"""
+        now = self.clock()
+        return sum(1 for refill_at in list(self._spent) if refill_at > now)
+
+
+@dataclass
+class OutboundMessage:
+    channel: str
+    line: str
+    queued_at: float
+    priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.CONTROL
+    key: str = ""
+
+
+@dataclass
+class Lane:
+    """per channel FIFO queues of one priority, served round-robin"""
+
+    channels: dict[str, deque[OutboundMessage]] = field(default_factory=dict)
+    turns: deque[str] = field(
+        default_factory=deque
+    )  # channels with pending messages, in serving order
+
+    def put(self, message: OutboundMessage) -> None:
+        channel_queue = self.channels.get(message.channel)
+
+        if channel_queue is None:
+            channel_queue = self.channels[message.channel] = deque()
+            self.turns.append(message.channel)
+
+        channel_queue.append(message)
+
+    def put_front(self, message: OutboundMessage) -> None:
+        channel_queue = self.channels.get(message.channel)
+
+        if channel_queue is None:
+            channel_queue = self.channels[message.channel] = deque()
+        else:
+            self.turns.remove(message.channel)
+
+        self.turns.appendleft(message.channel)
+        channel_queue.appendleft(message)
+
+    def remove(self, message: OutboundMessage) -> None:
+        channel_queue = self.channels[message.channel]
+        del channel_queue[
+            next(
+                index
+                for index, pending in enumerate(channel_queue)
+                if pending is message
+            )
+        ]
+
+        if not channel_queue:
+            del self.channels[message.channel]
+            self.turns.remove(message.channel)
+
+    def pop(self) -> OutboundMessage | None:
+        if not self.turns:
+            return None
+
+        channel = self.turns.popleft()
+        channel_queue = self.channels[channel]
+        message = channel_queue.popleft()
+
+        if channel_queue:
+            self.turns.append(channel)
+        else:
+            del self.channels[channel]
+
+        return message
+
+    def discard(self, channel: str) -> deque[OutboundMessage]:
+        channel_queue = self.channels.pop(channel, None)
+
+        if channel_queue is None:
+            return deque()
+
+        self.turns.remove(channel)
+        return channel_queue
+
+
+@dataclass
+class ChannelStats:
+    depth: int = 0
+    sent: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.sent if self.sent else 0.0
+
+    def get_json(self) -> dict[str, float]:
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "average_wait": self.average_wait,
+            "max_wait": self.max_wait,
+        }
+
+
+@dataclass
+class OutboundQueue:
+    """
+    Per channel FIFO queues served round-robin, one message per channel per turn,
+    so a burst from one room can't delay the others. Control messages always go out before
+    informational ones, which are dropped once their channel's backlog reaches `info_backlog_limit`.
+    A message superseding a pending one (see get_coalesce_key) drops it and queues at the tail,
+    every other message is sent as is.
+    Not thread-safe, OsuIrc only touches it from its event loop.
+    """
+
+    clock: Callable[[], float] = time.monotonic
+    max_tracked_channels: int = 512
+    info_backlog_limit: int = 20  # pending messages of one channel
+
+    _lanes: list[Lane] = field(
+        default_factory=lambda: [Lane() for _ in MESSAGE_PRIORITY]
+    )
+    _size: int = 0
+    _keyed: dict[tuple[str, str], OutboundMessage] = field(
+        default_factory=dict
+    )  # pending by (channel, key)
+    stats: OrderedDict[str, ChannelStats] = field(default_factory=OrderedDict)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get_stats(self, channel: str) -> ChannelStats:
+        stats = self.stats.get(channel)
+
+        if stats:
+            self.stats.move_to_end(channel)
+            return stats
+
+        stats = self.stats[channel] = ChannelStats()
+
+        while len(self.stats) > self.max_tracked_channels:
+            oldest_channel = next(iter(self.stats))
+
+            if self.stats[oldest_channel].depth:
+                break
+
+            del self.stats[oldest_channel]
+
+        return stats
+
+    def put(
+        self, line: str, priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.CONTROL
+    ) -> OutboundMessage | None:
+        channel = get_channel(line)
+        key = get_coalesce_key(line)
+        stats = self.get_stats(channel)
+        pending = self._keyed.pop((channel, key), None) if key else None
+
+        if pending:
+            # the newer message goes to the tail, it must not overtake what was queued after the old one
+            self._lanes[pending.priority].remove(pending)
+            self._size -= 1
+            stats.depth -= 1
+            stats.coalesced += 1
+
+        if (
+            not pending
+            and priority == MESSAGE_PRIORITY.INFO
+            and stats.depth >= self.info_backlog_limit
+        ):
+            stats.dropped += 1
+            return None
+
+        message = OutboundMessage(
+            channel=channel,
+            line=line,
+            queued_at=self.clock(),
+            priority=priority,
+            key=key,
+        )
+
+        if key:
+            self._keyed[(channel, key)] = message
+
+        self._lanes[priority].put(message)
+        self._size += 1
+        stats.depth += 1
+        return message
+
+    def pop(self) -> OutboundMessage | None:
+        message = None
+
+        for lane in self._lanes:
+            if message := lane.pop():
+                break
+
+        if not message:
+            return None
+
+        if message.key:
+            del self._keyed[(message.channel, message.key)]
+
+        self._size -= 1
+        wait = self.clock() - message.queued_at
+        stats = self.get_stats(message.channel)
+        stats.depth -= 1
+        stats.sent += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        return message
+
+    def requeue(self, message: OutboundMessage) -> None:
+        """put back a popped message that couldn't be sent, ahead of the rest of its channel"""
+        if message.key:
+            if (message.channel, message.key) in self._keyed:
+                return  # superseded while it was being sent
+
+            self._keyed[(message.channel, message.key)] = message
+
+        self._lanes[message.priority].put_front(message)
+        self._size += 1
+        stats = self.get_stats(message.channel)
+        stats.depth += 1
+        stats.sent -= 1
+
+    def discard(self, channel: str) -> int:
+        """drop every pending message of a channel, for rooms moved to another connection"""
+        discarded = 0
+
+        for lane in self._lanes:
+            for message in lane.discard(channel):
+                self._keyed.pop((message.channel, message.key), None)
+                discarded += 1
+
+        self._size -= discarded
+        stats = self.get_stats(channel)
+        stats.depth -= discarded
+        stats.dropped += discarded
+        return discarded
+
+    def get_json(self) -> dict[str, dict[str, float]]:
+        return {channel: stats.get_json() for channel, stats in self.stats.items()}
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket(capacity=10, period=5.0, clock=clock)
+
+        self.assertTrue(all(bucket.consume() for _ in range(10)))
+        self.assertFalse(bucket.consume())
+        self.assertEqual(bucket.delay(), 5.0)
+
+    def test_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(capacity=2, period=5.0, clock=clock)
+        bucket.consume()
+        clock.now = 1.0
+        bucket.consume()
+
+        clock.now = 5.0
+        self.assertEqual(bucket.tokens, 1)
+        self.assertEqual(bucket.delay(), 0.0)
+        bucket.consume()
+        self.assertEqual(bucket.delay(), 1.0)
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+    def test_get_channel(self):
+        self.assertEqual(get_channel("PRIVMSG #mp_1 : !mp start"), "#mp_1")
+        self.assertEqual(get_channel("JOIN #mp_1"), "#mp_1")
+        self.assertEqual(get_channel("PASS secret"), "")
+
+    def test_round_robin(self):
+        outbound = OutboundQueue()
+
+        for message in [
+            "!mp name a",
+            "!mp password",
+            "!mp set 0 0 16",
+            "!mp mods Freemod",
+        ]:
+            outbound.put(f"PRIVMSG #mp_1 : {message}")
+
+        outbound.put("PRIVMSG #mp_2 : !mp host someone")
+        outbound.put("PRIVMSG #mp_3 : !mp start")
+
+        channels = [outbound.pop().channel for _ in range(len(outbound))]  # type: ignore[union-attr]
+        self.assertEqual(
+            channels, ["#mp_1", "#mp_2", "#mp_3", "#mp_1", "#mp_1", "#mp_1"]
+        )
+        self.assertIsNone(outbound.pop())
+
+    def test_stats(self):
+        clock = FakeClock()
+        outbound = OutboundQueue(clock=clock)
+        outbound.put("PRIVMSG #mp_1 : a")
+        outbound.put("PRIVMSG #mp_1 : b")
+        self.assertEqual(outbound.stats["#mp_1"].depth, 2)
+
+        clock.now = 1.0
+        outbound.pop()
+        clock.now = 3.0
+        outbound.pop()
+
+        stats = outbound.stats["#mp_1"]
+        self.assertEqual(
+            (stats.depth, stats.sent, stats.max_wait, stats.average_wait),
+            (0, 2, 3.0, 2.0),
+        )
+
+    def test_priority(self):
+        outbound = OutboundQueue()
+        outbound.put(
+            "PRIVMSG #mp_1 : Match starts in 30 seconds", MESSAGE_PRIORITY.INFO
+        )
+        outbound.put("PRIVMSG #mp_1 : Links: ...", MESSAGE_PRIORITY.INFO)
+        outbound.put("PRIVMSG #mp_2 : !mp host someone", MESSAGE_PRIORITY.CONTROL)
+
+        self.assertEqual(outbound.pop().line, "PRIVMSG #mp_2 : !mp host someone")  # type: ignore[union-attr]
+        self.assertEqual(outbound.pop().line, "PRIVMSG #mp_1 : Match starts in 30 seconds")  # type: ignore[union-attr]
+
+    def test_drop_info_on_backlog(self):
+        outbound = OutboundQueue(info_backlog_limit=2)
+        outbound.put("PRIVMSG #mp_1 : !mp start")
+        outbound.put("PRIVMSG #mp_1 : Queue: a, b", MESSAGE_PRIORITY.INFO)
+
+        self.assertIsNone(
+            outbound.put("PRIVMSG #mp_1 : Links: ...", MESSAGE_PRIORITY.INFO)
+        )
+        self.assertIsNotNone(outbound.put("PRIVMSG #mp_1 : !mp abort"))
+        self.assertEqual(len(outbound), 3)
+        self.assertEqual(outbound.stats["#mp_1"].dropped, 1)
+
+    def test_info_backlog_per_channel(self):
+        outbound = OutboundQueue(info_backlog_limit=2)
+        outbound.put("PRIVMSG #mp_1 : !mp start")
+        outbound.put("PRIVMSG #mp_1 : !mp abort")
+
+        # one room's backlog doesn't silence the others on the connection
+        self.assertIsNone(
+            outbound.put("PRIVMSG #mp_1 : Queue: a, b", MESSAGE_PRIORITY.INFO)
+        )
+        self.assertIsNotNone(
+            outbound.put("PRIVMSG #mp_2 : Queue: c, d", MESSAGE_PRIORITY.INFO)
+        )
+        self.assertEqual(
+            (outbound.stats["#mp_1"].dropped, outbound.stats["#mp_2"].dropped), (1, 0)
+        )
+
+    def test_coalesce(self):
+        outbound = OutboundQueue()
+        outbound.put("PRIVMSG #mp_1 : !mp map 1 0")
+        outbound.put("PRIVMSG #mp_1 : !mp host a")
+        outbound.put("PRIVMSG #mp_2 : !mp host c")
+        outbound.put(
+            "PRIVMSG #mp_1 : Match starts in 10 seconds", MESSAGE_PRIORITY.INFO
+        )
+        outbound.put("PRIVMSG #mp_1 : !mp map 2 0 | Violations: AR 8.0 != 9.0-10.0")
+        outbound.put("PRIVMSG #mp_1 : !mp host b")
+        outbound.put("PRIVMSG #mp_1 : Match starts in 3 seconds", MESSAGE_PRIORITY.INFO)
+        outbound.put("PRIVMSG #mp_1 : !mp start")
+        outbound.put("PRIVMSG #mp_1 : !mp start")
+
+        lines = [outbound.pop().line for _ in range(len(outbound))]  # type: ignore[union-attr]
+        self.assertEqual(
+            lines,
+            [
+                "PRIVMSG #mp_1 : !mp map 2 0 | Violations: AR 8.0 != 9.0-10.0",
+                "PRIVMSG #mp_2 : !mp host c",
+                "PRIVMSG #mp_1 : !mp host b",
+                "PRIVMSG #mp_1 : !mp start",
+                "PRIVMSG #mp_1 : !mp start",
+                "PRIVMSG #mp_1 : Match starts in 3 seconds",
+            ],
+        )
+        self.assertEqual(outbound.stats["#mp_1"].coalesced, 3)
+
+        outbound.put("PRIVMSG #mp_1 : !mp host a")
+        self.assertEqual(outbound.pop().line, "PRIVMSG #mp_1 : !mp host a")  # type: ignore[union-attr]
+
+    def test_requeue(self):
+        outbound = OutboundQueue()
+        outbound.put("PRIVMSG #mp_1 : !mp start")
+        outbound.put("PRIVMSG #mp_1 : !mp abort")
+        outbound.put("PRIVMSG #mp_2 : !mp start")
+        message = outbound.pop()
+        assert message
+        outbound.requeue(message)
+
+        lines = [outbound.pop().line for _ in range(len(outbound))]  # type: ignore[union-attr]
+        self.assertEqual(
+            lines,
+            [
+                "PRIVMSG #mp_1 : !mp start",
+                "PRIVMSG #mp_2 : !mp start",
+                "PRIVMSG #mp_1 : !mp abort",
+            ],
+        )
+
+        message = outbound.put("PRIVMSG #mp_1 : !mp host a")
+        assert message
+        outbound.pop()
+        outbound.put("PRIVMSG #mp_1 : !mp host b")
+        outbound.requeue(message)  # superseded while it was being sent
+        self.assertEqual([outbound.pop().line, outbound.pop()], ["PRIVMSG #mp_1 : !mp host b", None])  # type: ignore[union-attr]
+
+    def test_coalesce_order(self):
+        clock = FakeClock()
+        outbound = OutboundQueue(clock=clock)
+
+        for line in ["!mp host a", "!mp start", "!mp host b", "!mp start"]:
+            outbound.put(f"PRIVMSG #mp_1 : {line}")
+            clock.advance(1.0)
+
+        messages = [outbound.pop() for _ in range(len(outbound))]
+        self.assertEqual(
+            [(message.line, message.queued_at) for message in messages],  # type: ignore[union-attr]
+            [
+                ("PRIVMSG #mp_1 : !mp start", 1.0),
+                ("PRIVMSG #mp_1 : !mp host b", 2.0),
+                ("PRIVMSG #mp_1 : !mp start", 3.0),
+            ],
+        )
+        self.assertEqual(outbound.stats["#mp_1"].depth, 0)
+
+    def test_discard(self):
+        outbound = OutboundQueue()
+        outbound.put("PRIVMSG #mp_1 : !mp host a")
+        outbound.put("PRIVMSG #mp_2 : !mp host b")
+        outbound.put("PRIVMSG #mp_1 : Queue: a", MESSAGE_PRIORITY.INFO)
+
+        self.assertEqual(outbound.discard("#mp_1"), 2)
+        self.assertEqual(outbound.pop().line, "PRIVMSG #mp_2 : !mp host b")  # type: ignore[union-attr]
+        self.assertIsNone(outbound.pop())
+        self.assertIsNotNone(outbound.put("PRIVMSG #mp_1 : !mp host a"))
+        self.assertEqual(len(outbound), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
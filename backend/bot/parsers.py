@@ -1,72 +1,68 @@
 from typing import Optional
-from bot.enums import SlotDict, MessageDict
+from bot.enums import IrcMessage, SlotInfo
 from bot.constants import VALID_ROLES
 
+ROLES = frozenset(VALID_ROLES)
+
 
 def normalize_username(username: str) -> str:
     return username.strip().replace(" ", "_")
 
 
-def parse_slot(message: str) -> SlotDict:
-    message_words = message.split()
-    slot = message_words[1]
-
-    if message_words[2] != "Ready":
-        status = " ".join(message_words[2:4])
-        url = message_words[4]
-        user_roles = " ".join(message_words[5:])
-    else:
-        status = message_words[2]
-        url = message_words[3]
-        user_roles = " ".join(message_words[4:])
-
-    username = user_roles
-    roles = []
-    start_roles_index = user_roles.rfind("[")
-
-    if user_roles.endswith("]") and start_roles_index != -1:
-        roles = user_roles[start_roles_index + 1 : -1].replace(" ", "").split("/")
-        roles = roles[:-1] + roles[-1].split(",")
-
-        if any(role.strip() not in VALID_ROLES for role in roles):
-            roles = []
-        else:
-            username = user_roles[: start_roles_index - 1]
-
-    username = username.strip().replace(" ", "_")
-    user_id = url.split("/")[-1]
-
-    return SlotDict(
-        username=username,
-        user_id=user_id,
-        status=status,
-        slot=int(slot) if slot.isdigit() else 0,
-        roles=roles,
+def parse_slot(message: str) -> SlotInfo:
+    """`Slot 1  Not Ready https://osu.ppy.sh/u/2 Some Player  [Host / Hidden]`, split around the url"""
+    slot, _, rest = message[len("Slot ") :].partition(" ")
+    status, _, rest = rest.strip().partition(" https://")
+    url, _, username = rest.partition(" ")
+    username = username.strip()
+    roles: list[str] = []
+    start_roles_index = username.rfind("[")
+
+    if username.endswith("]") and start_roles_index != -1:
+        found = username[start_roles_index + 1 : -1].replace(" ", "").split("/")
+        found = found[:-1] + found[-1].split(",")
+
+        # a username can end in brackets too
+        if ROLES.issuperset(found):
+            roles = found
+            username = username[:start_roles_index]
+
+    # positional, building the tuple from keywords is noticeably slower
+    user_id = url.rpartition("/")[2]
+    return SlotInfo(
+        int(slot) if slot.isdigit() else 0,
+        status.rstrip(),
+        user_id,
+        "_".join(username.split()),
+        roles,
     )
 
 
-def parse_message(message: str) -> Optional[MessageDict]:
-    words = message.strip().split(" ")
+NO_CHANNEL_COMMANDS = {"JOIN", "PART", "QUIT"}
+
+
+def peek_message(message: str) -> tuple[str, str]:
+    """command and channel (first parameter) of a raw line, without parsing the rest of it"""
+    words = message.split(" ", 3)
+    return (words[1], words[2]) if len(words) > 2 else ("", "")
+
+
+def parse_message(message: str) -> Optional[IrcMessage]:
+    words = message.strip().split(" ", 3)
 
     if len(words) < 3 or not message.startswith(":"):
         return None
 
-    no_channel_commands = {"JOIN", "PART", "QUIT"}
-    invalid_channel_end_strings = {"!cho@ppy.sh", "!cho@cho.ppy.sh"}
-    invalid_message_start_char = ":"
-
-    sender = words[0][1:].rstrip("".join(invalid_channel_end_strings))
+    sender = words[0][1:].partition("!")[0]
     command = words[1]
     channel = words[2]
-    message = " ".join(words[3:])
+    message = words[3] if len(words) > 3 else ""
 
-    if command in no_channel_commands:
+    if command in NO_CHANNEL_COMMANDS:
+        message = f"{channel} {message}" if message else channel
         channel = ""
-        message = " ".join(words[2:])
-
-    message = message.lstrip(invalid_message_start_char)
 
-    return MessageDict(sender=sender, command=command, channel=channel, message=message)
+    return IrcMessage(sender, command, channel, message.lstrip(":"))
 
 
 def get_beatmapset_id_from_url(url: str) -> int:
@@ -0,0 +1,205 @@
+import json
+import queue
+import threading
+import unittest
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator
+
+
+def get_delta(previous: dict[str, Any], current: dict[str, Any]) -> dict[str, Any]:
+    """keys of `current` that changed, nested dicts (the room beatmap) are compared one level down"""
+    delta: dict[str, Any] = {}
+
+    for key, value in current.items():
+        previous_value = previous.get(key)
+
+        if value == previous_value:
+            continue
+
+        if isinstance(value, dict) and isinstance(previous_value, dict):
+            value = {
+                nested_key: nested_value
+                for nested_key, nested_value in value.items()
+                if previous_value.get(nested_key) != nested_value
+            }
+
+        delta[key] = value
+
+    return delta
+
+
+def format_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+@dataclass
+class Subscriber:
+    events: queue.Queue[str] = field(default_factory=lambda: queue.Queue(maxsize=256))
+    is_dropped: bool = False
+
+    def stream(self, keepalive: float = 15.0) -> Generator[str, None, None]:
+        """server-sent events until the subscriber falls behind and is dropped"""
+        while not self.is_dropped:
+            try:
+                yield self.events.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+
+        # the client reconnects and starts over from a fresh snapshot
+        yield format_event("dropped", {})
+
+
+@dataclass
+class RoomPublisher:
+    """
+    Fans room changes out to live subscribers as deltas against the last state they were sent.
+    Each subscriber has a bounded queue, one that falls `max_pending` events behind is dropped
+    instead of buffered for.
+    """
+
+    max_pending: int = 256
+    # called with True when the first subscriber arrives and False when the last one leaves,
+    # under the publisher lock so the calls stay in order, it must not block
+    on_active: Callable[[bool], None] | None = None
+
+    _subscribers: list[Subscriber] = field(default_factory=list)
+    _states: dict[str, dict[str, Any]] = field(
+        default_factory=dict
+    )  # last published json by room id
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __len__(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(events=queue.Queue(maxsize=self.max_pending))
+
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+            if len(self._subscribers) == 1 and self.on_active:
+                self.on_active(True)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+                if not self._subscribers and self.on_active:
+                    self.on_active(False)
+
+            if not self._subscribers:
+                self._states.clear()
+
+    def seed(self, rooms_json: list[Any]) -> None:
+        """take a snapshot a subscriber was sent as published, so the next change to a room is a delta"""
+        with self._lock:
+            for room_json in rooms_json:
+                self._states.setdefault(room_json["id"], room_json)
+
+    def publish_room(self, room_json: Any) -> None:
+        if not self._subscribers:
+            return  # nobody to diff for, a new subscriber starts from a snapshot
+
+        with self._lock:
+            previous = self._states.get(room_json["id"], {})
+            self._states[room_json["id"]] = room_json
+
+        delta = get_delta(previous, room_json)
+
+        if delta:
+            self.publish_raw(format_event("room", {"id": room_json["id"], **delta}))
+
+    def publish_removed(self, unique_id: str) -> None:
+        with self._lock:
+            self._states.pop(unique_id, None)
+
+        self.publish_raw(format_event("removed", {"id": unique_id}))
+
+    def publish_raw(self, event: str) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.events.put_nowait(event)
+            except queue.Full:
+                subscriber.is_dropped = True
+                self.unsubscribe(subscriber)
+
+
+class RoomPublisherTestCase(unittest.TestCase):
+    def test_delta(self):
+        previous = {
+            "id": "a",
+            "users": ["x"],
+            "beatmap": {"current": {"id": 1}, "star": [0, 10]},
+        }
+        current = {
+            "id": "a",
+            "users": ["x", "y"],
+            "beatmap": {"current": {"id": 2}, "star": [0, 10]},
+        }
+        self.assertEqual(
+            get_delta(previous, current),
+            {"users": ["x", "y"], "beatmap": {"current": {"id": 2}}},
+        )
+
+    def test_publish(self):
+        publisher = RoomPublisher()
+        subscriber = publisher.subscribe()
+
+        publisher.publish_room({"id": "a", "users": []})
+        publisher.publish_room({"id": "a", "users": []})
+        publisher.publish_room({"id": "a", "users": ["x"]})
+        publisher.publish_removed("a")
+
+        events = [
+            subscriber.events.get_nowait() for _ in range(subscriber.events.qsize())
+        ]
+        self.assertEqual(
+            events,
+            [
+                'event: room\ndata: {"id":"a","users":[]}\n\n',
+                'event: room\ndata: {"id":"a","users":["x"]}\n\n',
+                'event: removed\ndata: {"id":"a"}\n\n',
+            ],
+        )
+
+    def test_seed(self):
+        publisher = RoomPublisher()
+        subscriber = publisher.subscribe()
+        publisher.seed([{"id": "a", "users": [], "skips": []}])
+        publisher.publish_room({"id": "a", "users": ["x"], "skips": []})
+        self.assertEqual(
+            subscriber.events.get_nowait(),
+            'event: room\ndata: {"id":"a","users":["x"]}\n\n',
+        )
+
+    def test_active(self):
+        changes: list[bool] = []
+        publisher = RoomPublisher(on_active=changes.append)
+        first, second = publisher.subscribe(), publisher.subscribe()
+        publisher.unsubscribe(first)
+        self.assertEqual(changes, [True])
+
+        publisher.unsubscribe(second)
+        publisher.unsubscribe(second)
+        self.assertEqual(changes, [True, False])
+
+    def test_drop_slow_subscriber(self):
+        publisher = RoomPublisher(max_pending=2)
+        slow = publisher.subscribe()
+
+        for index in range(3):
+            publisher.publish_room({"id": "a", "count": index})
+
+        self.assertTrue(slow.is_dropped)
+        self.assertEqual(len(publisher), 0)
+        self.assertEqual(list(slow.stream())[-1], "event: dropped\ndata: {}\n\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
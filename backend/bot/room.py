@@ -1,18 +1,50 @@
-import re
 from collections import deque
+from concurrent.futures import Future
+import json
+import time
+import unittest
 import uuid
-from typing import Any
+from types import SimpleNamespace
+from typing import Any, Callable, Sequence
 from dataclasses import dataclass, field
-from bot.parsers import (
-    get_beatmap_id_from_url,
-    parse_slot,
-    normalize_username,
+from bot.parsers import normalize_username
+from bot.classifier import (
+    AllPlayersReady,
+    BeatmapChangedTo,
+    ChangedBeatmapTo,
+    HostChanged,
+    MatchClosed,
+    MatchFinished,
+    MatchStarted,
+    PlayerCount,
+    UserJoined,
+    UserLeft,
+    classify_bancho_message,
 )
 from bot.beatmap import RoomBeatmap
 from bot.counter import Counter
-from bot.enums import BOT_MODE, PLAY_MODE, TEAM_MODE, SCORE_MODE, RoomData
-from bot.osuapi import osu_api
+from bot.enums import (
+    BOT_MODE,
+    MESSAGE_PRIORITY,
+    PLAY_MODE,
+    TEAM_MODE,
+    SCORE_MODE,
+    RoomData,
+    RoomQuery,
+    SlotInfo,
+)
+from bot.beatmapcache import get_beatmap, get_beatmapset
 from bot.irc import OsuIrc
+from bot.metrics import metrics
+from bot.workqueue import SerialQueue, api_workers
+from ossapi import Beatmap, Beatmapset
+from my_logger import get_logger
+
+logger = get_logger("rooms")
+
+event_seconds = metrics.histogram(
+    "room_event_seconds", "Time to run a room event, by handler.", ("event",)
+)
 
 
 class Users(deque[Any]):
@@ -40,6 +72,8 @@ class Room:
 
     room_id: str = ""
     unique_id: str = ""
+    on_room_id_changed: Callable[["Room", str], None] | None = None
+    on_changed: Callable[["Room"], None] | None = None
 
     _closed: bool = False
     users: Users = field(default_factory=Users)
@@ -50,6 +84,14 @@ class Room:
     countdown_message_seconds = [3, 10, 30, 60, 90, 120, 150, 180]
 
     _counter: Counter = field(default_factory=Counter)
+    _events: SerialQueue = field(default_factory=SerialQueue)
+    _beatmap_request: int = (
+        0  # bumped on every host map change, older validations are discarded
+    )
+    _version: int = 0  # bumped after every room event, see get_json_text
+    _snapshot: tuple[
+        tuple[int, int], str
+    ] | None = None  # (version, serialized get_json)
 
     is_connected = False
     is_created = False
@@ -59,9 +101,12 @@ class Room:
         if not self.unique_id:
             self.unique_id = str(uuid.uuid4())
 
+        self._counter.stop()
         self._counter = Counter()
-        self._counter.on_count = self.on_count
-        self._counter.on_finished = self.on_count_finished
+        self._counter.on_count = lambda count: self.post(self.on_count, count)
+        self._counter.on_finished = lambda: self.post(self.on_count_finished)
+        self.beatmap.on_ready = lambda: self.post(self.on_beatmaps_ready)
+        self.beatmap.on_changed = lambda: self.post(self.on_beatmaps_changed)
 
         room_modes = [
             ("Bot mode", self.bot_mode, BOT_MODE),
@@ -74,34 +119,101 @@ class Room:
             if selected not in selection:
                 raise ValueError(f"{name} is invalid.")
 
-    def get_json(self) -> RoomData:
-        return {
-            "id": self.unique_id,
-            "name": self.name,
-            "room_id": self.room_id,
-            "bot_mode": self.bot_mode.name,
-            "play_mode": self.play_mode.name,
-            "team_mode": self.team_mode.name,
-            "score_mode": self.score_mode.name,
-            "room_size": self.room_size,
-            "is_connected": self.is_connected,
-            "is_created": self.is_created,
-            "is_configured": self.is_configured,
-            "users": list(self.users),
-            "skips": list(self.skip_votes),
-            "beatmap": self.beatmap.get_json(),
+    def post(self, callback: Callable[..., Any], *args: Any) -> None:
+        """run a room event after the ones already queued, events of one room never overlap"""
+        self._events.post(self.run_event, callback, *args)
+
+    def run_event(self, callback: Callable[..., Any], *args: Any) -> None:
+        started = time.perf_counter()
+
+        try:
+            callback(*args)
+        finally:
+            self.mark_changed()
+            event_seconds.observe(
+                time.perf_counter() - started, (getattr(callback, "__name__", "event"),)
+            )
+
+    def mark_changed(self) -> None:
+        self._version += 1
+
+        if self.on_changed:
+            self.on_changed(self)
+
+    def get_version(self) -> tuple[int, int]:
+        return self._version, self.beatmap.get_version()
+
+    def get_json_text(self, fields: Sequence[str] = ()) -> str:
+        """get_json serialized, rebuilt only when the room or its maps changed since the last call"""
+        if fields:
+            return json.dumps(
+                self.get_json(fields), separators=(",", ":")
+            )  # projections are small, not cached
+
+        version = (
+            self.get_version()
+        )  # read before serializing, a change meanwhile bumps it again
+        snapshot = self._snapshot
+
+        if not snapshot or snapshot[0] != version:
+            snapshot = self._snapshot = (
+                version,
+                json.dumps(self.get_json(), separators=(",", ":")),
+            )
+
+        return snapshot[1]
+
+    def get_json(self, fields: Sequence[str] = ()) -> RoomData:
+        """every field or only `fields` (see RoomQuery.fields), the ones not asked for are never built"""
+        names = {field.partition(".")[0] for field in fields}
+        # "beatmap" selects the whole beatmap, "beatmap.current" only parts of it
+        beatmap_fields = (
+            ()
+            if "beatmap" in fields
+            else [field[8:] for field in fields if field[:8] == "beatmap."]
+        )
+        getters: dict[str, Callable[[], Any]] = {
+            "id": lambda: self.unique_id,
+            "name": lambda: self.name,
+            "room_id": lambda: self.room_id,
+            "bot_mode": lambda: self.bot_mode.name,
+            "play_mode": lambda: self.play_mode.name,
+            "team_mode": lambda: self.team_mode.name,
+            "score_mode": lambda: self.score_mode.name,
+            "room_size": lambda: self.room_size,
+            "shard": lambda: self.irc.username,
+            "is_connected": lambda: self.is_connected,
+            "is_created": lambda: self.is_created,
+            "is_configured": lambda: self.is_configured,
+            "users": lambda: list(self.users),
+            "skips": lambda: list(self.skip_votes),
+            "beatmap": lambda: self.beatmap.get_json(beatmap_fields),
+        }
+        return {  # type: ignore[return-value]
+            name: getter()
+            for name, getter in getters.items()
+            if not fields or name in names
         }
 
+    def matches(self, query: RoomQuery) -> bool:
+        return (
+            (query.bot_mode is None or self.bot_mode.name == query.bot_mode)
+            and (query.play_mode is None or self.play_mode.name == query.play_mode)
+            and (query.is_connected is None or self.is_connected == query.is_connected)
+        )
+
     def on_count(self, count: int) -> None:
         if count in self.countdown_message_seconds:
             self.send_start_message(count)
 
     def on_count_finished(self) -> None:
         if self.users:
-            self.send_message("!mp start")
+            self.send_command("!mp start")
 
     def configure(self, **kwargs: Any) -> None:
         beatmap = kwargs.pop("beatmap", {})
+        room_id = kwargs.pop("room_id", self.room_id)
+        kwargs.pop("unique_id", None)
         self.password = kwargs.get("password", "")
 
         for key, value in kwargs.items():
@@ -111,7 +223,12 @@ class Room:
         self.beatmap.configure(**beatmap)
         self.is_configured = False
         self.__post_init__()
-        self.on_match_created(self.room_id)
+        self.on_match_created(room_id)
+        self.mark_changed()
+
+    def update(self, data: dict[str, Any]) -> None:
+        """configure as a room event, so it never runs alongside the room's other events"""
+        self.configure(**data)
 
     def restart(self) -> None:
         self.on_closed()
@@ -127,6 +244,7 @@ class Room:
         if not self.is_created:
             self.irc.send_private_message("BanchoBot", f"mp make {self.unique_id}")
             self.is_created = True
+            self.mark_changed()
 
         return self.is_created
 
@@ -135,19 +253,39 @@ class Room:
             return False
 
         if room_id:
-            self.room_id = room_id
+            self.set_room_id(room_id)
 
         self.irc.send(f"JOIN {self.room_id}")
         return self.is_connected
 
+    def add_referees(self, usernames: list[str]) -> None:
+        """let the other bot accounts take the room over if this connection drops"""
+        if usernames:
+            self.send_command(f"!mp addref {' '.join(usernames)}")
+
+    def move_to(self, irc: OsuIrc) -> None:
+        """continue on another connection, its account was added as referee when the match was made"""
+        if self.room_id:
+            self.irc.discard_channel(self.room_id)
+
+        self.irc = irc
+        self.disconnect()
+
+        if self.room_id:
+            self.join()
+        elif self.is_created:
+            # the match was requested but never confirmed, ask again from the new account
+            self.is_created = False
+            self.create()
+
     def send_close(self) -> None:
-        self.send_message("!mp close")
+        self.send_command("!mp close")
 
     def on_closed(self) -> None:
         self.tmp_users.clear()
         self._counter.stop()
         self._tmp_total_users = 0
-        self.room_id = ""
+        self.set_room_id("")
         self.users.clear()
         self.clear_skip_votes()
         self.clear_abort_votes()
@@ -155,8 +293,15 @@ class Room:
         self.is_created = False
         self.is_configured = False
 
-    def on_match_created(self, room_id: str) -> None:
+    def set_room_id(self, room_id: str) -> None:
+        previous_room_id = self.room_id
         self.room_id = room_id
+
+        if previous_room_id != room_id and self.on_room_id_changed:
+            self.on_room_id_changed(self, previous_room_id)
+
+    def on_match_created(self, room_id: str) -> None:
+        self.set_room_id(room_id)
         self.setup()
 
     def setup(self) -> None:
@@ -170,16 +315,35 @@ class Room:
             "!mp mods Freemod",
         ]
 
-        self.send_messages(messages)
-        self.set_current_beatmap(self.beatmap.current.id)
+        self.send_messages(messages, MESSAGE_PRIORITY.CONTROL)
+
+        # a room made or reconfigured a moment ago may still be generating its maps, see on_beatmaps_ready
+        if self.beatmap.status != "pending":
+            self.set_current_beatmap(self.beatmap.current.id)
+
         self.is_configured = True
 
-    def send_messages(self, messages: list[str]) -> None:
+    def on_beatmaps_ready(self) -> None:
+        if self.is_configured:
+            self.set_current_beatmap(self.beatmap.current.id)
+
+    def on_beatmaps_changed(self) -> None:
+        """maps queued or a fill failed on the refiller thread, nothing to send, run_event publishes it"""
+
+    def send_messages(
+        self, messages: list[str], priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.INFO
+    ) -> None:
         for message in messages:
-            self.send_message(message)
+            self.send_message(message, priority)
+
+    def send_message(
+        self, message: str, priority: MESSAGE_PRIORITY = MESSAGE_PRIORITY.INFO
+    ) -> None:
+        self.irc.send_private_message(self.room_id, message, priority)
 
-    def send_message(self, message: str) -> None:
-        self.irc.send_private_message(self.room_id, message)
+    def send_command(self, command: str) -> None:
+        """state changing messages, sent ahead of informational chatter"""
+        self.send_message(command, MESSAGE_PRIORITY.CONTROL)
 
     def rotate(self) -> None:
         if self.bot_mode == BOT_MODE.AUTO_HOST:
@@ -195,15 +359,22 @@ class Room:
 
         host = self.users.popleft()
         self.users.append(host)
-        self.send_message(f"!mp host {self.users[0]}")
+        self.send_command(f"!mp host {self.users[0]}")
 
     def rotate_beatmap(self) -> None:
         self.beatmap.rotate()
         self.set_current_beatmap(self.beatmap.current.id)
 
-    def set_current_beatmap(self, beatmap_id: int) -> None:
+    def set_current_beatmap(self, beatmap_id: int, reason: str = "") -> None:
+        """every `!mp map` goes through here, the bundled default map (id 0, see DefaultBeatmap) is never sent"""
+        if not beatmap_id:
+            if reason:
+                self.send_message(reason)
+
+            return
+
         message = f"!mp map {beatmap_id} {self.play_mode.value}"
-        self.send_message(message)
+        self.send_command(f"{message} | {reason}" if reason else message)
 
     def add_user(self, username: str) -> None:
         normalized_username = normalize_username(username)
@@ -235,7 +406,7 @@ class Room:
             self.rotate_host()
 
         if not self.users:
-            self.send_message("!mp abort")
+            self.send_command("!mp abort")
 
     def clear_skip_votes(self) -> None:
         self.skip_votes.clear()
@@ -257,13 +428,13 @@ class Room:
     def on_match_finished(self) -> None:
         queue = self.get_queue()
         message = f"!mp settings | Queue: {queue}"
-        self.send_message(message)
+        self.send_command(message)
 
         if self.bot_mode == BOT_MODE.AUTO_ROTATE_MAP:
             self.rotate_beatmap()
 
     def on_match_ready(self) -> None:
-        self.send_message("!mp start")
+        self.send_command("!mp start")
 
     def on_beatmap_changed_to(
         self,
@@ -275,9 +446,7 @@ class Room:
         if beatmap_id == self.beatmap.current.id:
             return
 
-        beatmap_id = beatmap_id or self.beatmap.current.id
-        message = f"!mp map {beatmap_id} {self.play_mode.value}"
-        self.send_message(message)
+        self.set_current_beatmap(beatmap_id or self.beatmap.current.id)
 
     def on_changed_beatmap_to(self, title: str, url: str, beatmap_id: int) -> None:
         self.clear_skip_votes()
@@ -287,18 +456,44 @@ class Room:
             self.send_beatmap_alt()
             return
 
+        self._beatmap_request += 1
+        request = self._beatmap_request
+
         if beatmap_id == self.beatmap.current.id:
             return
 
-        beatmap = osu_api.beatmap(beatmap_id)
+        future = api_workers.submit(self.fetch_beatmap, beatmap_id)
+        future.add_done_callback(
+            lambda future: self.post(self.on_beatmap_fetched, request, future)
+        )
+
+    def fetch_beatmap(
+        self, beatmap_id: int
+    ) -> tuple[Beatmap | None, Beatmapset | None]:
+        beatmap = get_beatmap(beatmap_id)
 
         if not beatmap:
-            message = f"!mp map {self.beatmap.current.id} {self.play_mode.value} | Failed to find beatmap!"
-            self.send_message(message)
-            return
+            return None, None
 
         # TODO bypas for now, ossapi wrapper can't fetch the full data of beatmapset using beatmap.beatmapset
-        beatmapset = osu_api.beatmapset(beatmap.beatmapset_id)
+        return beatmap, get_beatmapset(beatmap.beatmapset_id)
+
+    def on_beatmap_fetched(
+        self, request: int, future: Future[tuple[Beatmap | None, Beatmapset | None]]
+    ) -> None:
+        if request != self._beatmap_request:
+            return  # the host picked another map meanwhile
+
+        try:
+            beatmap, beatmapset = future.result()
+        except Exception:
+            logger.exception("Failed to fetch beatmap for %s", self.room_id)
+            beatmap, beatmapset = None, None
+
+        if not beatmap or not beatmapset:
+            self.set_current_beatmap(self.beatmap.current.id, "Failed to find beatmap!")
+            return
+
         errors: list[str] = []
 
         beatmapset_errors = self.beatmap.get_beatmapset_errors(beatmapset)
@@ -308,14 +503,17 @@ class Room:
         errors.extend(beatmap_errors)
 
         if errors:
-            message = f"!mp map {self.beatmap.current.id} {self.play_mode.value} | Violations: {', '.join(errors[0:2])}"
-            self.send_message(message)
+            self.set_current_beatmap(
+                self.beatmap.current.id, f"Violations: {', '.join(errors[0:2])}"
+            )
             return
 
         self.beatmap.set_current(beatmap)
         self.send_beatmap_alt()
 
-    def on_slot(self, slot: int, status: str, user_id: str, username: str, roles: list[str]) -> None:
+    def on_slot(
+        self, slot: int, status: str, user_id: str, username: str, roles: list[str]
+    ) -> None:
         self.tmp_users.add(username)
         self.users.append(username)
 
@@ -349,7 +547,7 @@ class Room:
         half_total = round(current_votes / 2)
 
         if current_votes >= half_total:
-            self.send_message("!mp abort")
+            self.send_command("!mp abort")
             return
 
         self.send_message(f"Abort voting: {current_votes} / {half_total}")
@@ -410,52 +608,93 @@ class Room:
 
             return
 
-        if message == "Closed the match":
-            self.on_closed()
-        elif "joined in slot" in message:
-            username = normalize_username(message.split(" joined in slot")[0])
-            self.add_user(username)
-
-            # autohost | set first user as host
-            if self.bot_mode == BOT_MODE.AUTO_HOST and len(self.users) == 1:
-                self.rotate_host()
-        elif message.endswith("left the game."):
-            username = normalize_username(message.split(" left the game.")[0])
-
-            # autohost | rotate on host leave
-            if self.bot_mode == BOT_MODE.AUTO_HOST and self.users and self.users[0] == username:
-                self.rotate_host()
-
-            self.remove_user(username)
-        elif message.endswith(" became the host."):
-            username = normalize_username(message.split(" became the host.")[0])
-            self.on_host_changed(username)
-        elif message == "The match has started!":
-            self.on_match_started()
-        elif message == "The match has finished!":
-            self.on_match_finished()
-        elif message == "All players are ready":
-            self.on_match_ready()
-        elif message.startswith("Beatmap changed to: "):
-            search = re.search("Beatmap.*?: (.*)? \[(.*?)\] \((.*)?\)", message)
-            if search:
+        match classify_bancho_message(message):
+            case MatchClosed():
+                self.on_closed()
+            case UserJoined(username=username):
+                self.add_user(username)
+
+                # autohost | set first user as host
+                if self.bot_mode == BOT_MODE.AUTO_HOST and len(self.users) == 1:
+                    self.rotate_host()
+            case UserLeft(username=username):
+                # autohost | rotate on host leave
+                if (
+                    self.bot_mode == BOT_MODE.AUTO_HOST
+                    and self.users
+                    and self.users[0] == username
+                ):
+                    self.rotate_host()
+
+                self.remove_user(username)
+            case HostChanged(username=username):
+                self.on_host_changed(username)
+            case MatchStarted():
+                self.on_match_started()
+            case MatchFinished():
+                self.on_match_finished()
+            case AllPlayersReady():
+                self.on_match_ready()
+            case BeatmapChangedTo(
+                title=title, version=version, url=url, beatmap_id=beatmap_id
+            ):
                 self.on_beatmap_changed_to(
-                    version=search.group(2),
-                    title=search.group(1),
-                    url=search.group(3),
-                    beatmap_id=int(search.group(3).split("/")[-1]),
+                    title=title, version=version, url=url, beatmap_id=beatmap_id
                 )
-        elif message.startswith("Changed beatmap to "):
-            message_split = message.split(" ")
-            url = message_split[3]
-            title = "".join(message_split[4:])
-
-            self.on_changed_beatmap_to(
-                title=title,
-                beatmap_id=get_beatmap_id_from_url(url),
-                url=url,
+            case ChangedBeatmapTo(title=title, url=url, beatmap_id=beatmap_id):
+                self.on_changed_beatmap_to(title=title, url=url, beatmap_id=beatmap_id)
+            case SlotInfo(
+                slot=slot,
+                status=status,
+                user_id=user_id,
+                username=username,
+                roles=roles,
+            ):
+                self.on_slot(
+                    slot=slot,
+                    status=status,
+                    user_id=user_id,
+                    username=username,
+                    roles=roles,
+                )
+            case PlayerCount(players=players):
+                self.on_players(players=players)
+
+
+class RoomTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sent: list[str] = []
+        irc = SimpleNamespace(
+            send_private_message=lambda room_id, message, priority: self.sent.append(
+                message
             )
-        elif message.startswith("Slot "):
-            self.on_slot(**parse_slot(message))
-        elif message.startswith("Players: "):
-            self.on_players(players=int(message.split(" ")[-1]))
+        )
+        # the bundled default map stands in while the osu! api is unreachable, a full list isn't refilled
+        beatmap = RoomBeatmap(beatmap_list=[SimpleNamespace(id=0)], high_water_mark=1)
+        self.room = Room(irc=irc, beatmap=beatmap, name="room", room_id="#mp_1")  # type: ignore[arg-type]
+
+    def fetched(self, beatmap: Any = None, beatmapset: Any = None) -> None:
+        future: Future[tuple[Any, Any]] = Future()
+        future.set_result((beatmap, beatmapset))
+        self.room.on_beatmap_fetched(self.room._beatmap_request, future)
+
+    def test_default_map(self):
+        self.fetched()
+        self.room.on_beatmap_changed_to(title="", version="", url="", beatmap_id=0)
+        self.room.set_current_beatmap(self.room.beatmap.current.id)
+        self.assertEqual(self.sent, ["Failed to find beatmap!"])
+
+    def test_failed_fetch(self):
+        self.room.beatmap.beatmap_list[0] = SimpleNamespace(id=7)
+        self.fetched()
+        self.room.on_beatmap_changed_to(title="", version="", url="", beatmap_id=0)
+        self.assertEqual(
+            self.sent, ["!mp map 7 0 | Failed to find beatmap!", "!mp map 7 0"]
+        )
+
+    def test_beatmaps_changed(self):
+        changed: list[Room] = []
+        self.room.on_changed = changed.append
+        assert self.room.beatmap.on_changed
+        self.room.beatmap.on_changed()  # a fill failing on the refiller thread
+        self.assertEqual(changed, [self.room])
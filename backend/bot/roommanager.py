@@ -1,123 +1,353 @@
 from __future__ import annotations
-import re
 import threading
+import json
+import time
+import unittest
+import zlib
 
-from my_logger import logger
-from typing import Optional
+from my_logger import get_logger
+from types import SimpleNamespace
+from typing import Any, Optional
 from dataclasses import dataclass, field
-from bot.parsers import parse_message
+from bot.parsers import parse_message, peek_message
+from bot.classifier import MatchCreated, classify_bancho_message
 
-from bot.enums import MESSAGE_YIELD, RoomData
+from bot.beatmap import RoomBeatmap
+from bot.enums import MESSAGE_YIELD, MessageResponse, RoomData, RoomQuery
+from bot.helpers import parse_room_data
 from bot.room import Room
+from bot.publisher import RoomPublisher
 from bot.irc import OsuIrc
+from bot.metrics import MetricFamily, metrics
+from bot.shards import Shard, pick_shard
+
+logger = get_logger("rooms")
+traffic_logger = get_logger("traffic")
+
+parse_seconds = metrics.histogram(
+    "irc_parse_seconds", "Time to parse a line addressed to the bot or a room."
+)
 
 
 @dataclass
 class RoomManager:
-    irc: OsuIrc
-    rooms: list[Room] = field(default_factory=list)
+    irc: OsuIrc  # first shard, the account the api logs in with
+    rooms: dict[str, Room] = field(default_factory=dict)  # unique_id -> room
+    shards: list[Shard] = field(default_factory=list)
+    publisher: RoomPublisher = field(
+        default_factory=RoomPublisher
+    )  # room deltas for /room/events
+    referees: list[str] = field(
+        default_factory=list
+    )  # accounts run by other processes, see RoomWorkerPool
+    _rooms_by_room_id: dict[str, Room] = field(
+        default_factory=dict
+    )  # "#mp_<id>" -> room
+    _shards_by_room: dict[str, Shard] = field(
+        default_factory=dict
+    )  # unique_id -> shard
+    _shards_lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        if not any(shard.irc is self.irc for shard in self.shards):
+            self.shards.insert(0, Shard(self.irc))
+
+    @property
+    def is_running(self) -> bool:
+        return any(shard.irc.is_running for shard in self.shards)
+
+    def add_shard(self, irc: OsuIrc) -> Shard:
+        shard = Shard(irc)
+        self.shards.append(shard)
+        return shard
+
+    def get_shard(self, room: Room) -> Optional[Shard]:
+        return self._shards_by_room.get(room.unique_id)
+
+    def assign_room(self, room: Room, shard: Shard) -> None:
+        with self._shards_lock:
+            previous_shard = self._shards_by_room.get(room.unique_id)
+
+            if previous_shard:
+                previous_shard.rooms.discard(room.unique_id)
+
+            shard.rooms.add(room.unique_id)
+            self._shards_by_room[room.unique_id] = shard
+
+    def rebalance(self, shard: Shard) -> None:
+        """move the rooms of a dropped connection to the least loaded connected shards"""
+        for unique_id in list(shard.rooms):
+            room = self.rooms.get(unique_id)
+            target = pick_shard(self.shards, exclude=shard, connected_only=True)
+
+            if not room or not target:
+                continue
+
+            logger.info(
+                "Moving %s from %s to %s",
+                room.room_id or room.unique_id,
+                shard.name,
+                target.name,
+            )
+            self.assign_room(room, target)
+            room.post(room.move_to, target.irc)
 
     def get_rooms_json(self) -> list[RoomData]:
-        return [room.get_json() for room in self.rooms]
+        return [room.get_json() for room in self.rooms.values()]
+
+    def get_rooms(self, query: RoomQuery = RoomQuery()) -> list[Room]:
+        """rooms matching the query filters, paged"""
+        rooms = [room for room in list(self.rooms.values()) if room.matches(query)]
+        end = None if query.limit is None else query.offset + query.limit
+        return rooms[query.offset : end]
+
+    def get_rooms_json_text(self, query: RoomQuery = RoomQuery()) -> list[str]:
+        return [room.get_json_text(query.fields) for room in self.get_rooms(query)]
+
+    def dump_rooms_json(self, query: RoomQuery = RoomQuery()) -> str:
+        """/room listing from the rooms' cached snapshots, serialized where the rooms live"""
+        return f"[{','.join(self.get_rooms_json_text(query))}]"
+
+    def dump_room_json(
+        self, unique_id: str, fields: tuple[str, ...] = ()
+    ) -> str | None:
+        room = self.get_room(unique_id=unique_id)
+        return room.get_json_text(fields) if room else None
+
+    def collect_metrics(self) -> list[MetricFamily]:
+        return metrics.collect()
+
+    def get_rooms_etag(
+        self, unique_id: str = "", query: RoomQuery = RoomQuery()
+    ) -> str:
+        """
+        changes whenever the listing (or one room) would serialize differently, without serializing.
+        empty for a missing room, there is nothing a client could have cached
+        """
+        if unique_id:
+            room = self.get_room(unique_id=unique_id)
+
+            if not room:
+                return ""
+
+            rooms = [room]
+        else:
+            rooms = [room for room in list(self.rooms.values()) if room.matches(query)]
+
+        versions = ";".join(f"{room.unique_id}:{room.get_version()}" for room in rooms)
+        return f"{zlib.crc32(f'{tuple(query)}{versions}'.encode()):08x}"
+
+    def create_room(self, data: Any) -> tuple[MessageResponse | RoomData, int]:
+        try:
+            parse_room_data(data)
+        except Exception as e:
+            return {"message": str(e)}, 400
+
+        data["irc"] = self.irc
+        data["beatmap"] = RoomBeatmap(**data.pop("beatmap"))
+        room = self.add_room(Room(**data))
+        room.create()
+
+        return room.get_json(), 201
+
+    def update_room(
+        self, unique_id: str, data: Any
+    ) -> tuple[MessageResponse | RoomData, int]:
+        if not unique_id:
+            return {"message": "Missing room_id on data"}, 400
+
+        try:
+            parse_room_data(data)
+        except Exception as e:
+            return {"message": str(e)}, 400
+
+        room = self.get_room(unique_id=unique_id)
+
+        if not room:
+            return {"message": "No room found!"}, 400
+
+        # as a room event, it only runs right away on this thread when the room is idle
+        room.post(room.update, data)
+
+        return room.get_json(), 200
+
+    def delete_room(self, unique_id: str) -> tuple[MessageResponse, int]:
+        if not unique_id:
+            return {"message": "Missing room_id"}, 400
+
+        room = self.get_room(unique_id=unique_id)
+
+        if not room:
+            return {"message": "No room found!"}, 400
+
+        room.send_close()
+        self.remove_room(room)
+
+        return {"message": "Room has been deleted"}, 204
 
     def get_room(self, unique_id: str = "", room_id: str = "") -> Optional[Room]:
-        for room in self.rooms:
-            if (unique_id and unique_id == room.unique_id) or (room_id and room_id == room.room_id):
-                return room
-        return None
+        room = self.rooms.get(unique_id) if unique_id else None
+
+        if not room and room_id:
+            room = self._rooms_by_room_id.get(room_id)
+
+        return room
 
     def add_room(self, room: Room) -> Room:
-        self.rooms.append(room)
+        shard = pick_shard(self.shards) or self.shards[0]
+        self.assign_room(room, shard)
+        room.irc = shard.irc
+
+        self.rooms[room.unique_id] = room
+        room.on_room_id_changed = self.on_room_id_changed
+        room.on_changed = self.on_room_changed
+        self.on_room_changed(room)
+
+        if room.room_id:
+            self._rooms_by_room_id[room.room_id] = room
+
         return room
 
     def remove_room(self, room: Room) -> bool:
-        try:
-            self.rooms.remove(room)
-            return True
-        except ValueError:
+        if self.rooms.get(room.unique_id) is not room:
             return False
 
-    def disconnect_rooms(self) -> None:
-        for room in self.rooms:
-            room.disconnect()
+        del self.rooms[room.unique_id]
+        room.on_room_id_changed = None
+        room.on_changed = None
+        room.beatmap.stop()
+        self.publisher.publish_removed(room.unique_id)
 
-    def on_match_created(self, message: str) -> None:
-        match_info = re.search(r"https://osu.ppy.sh/mp/(\d*)? (.*)", message)
+        with self._shards_lock:
+            shard = self._shards_by_room.pop(room.unique_id, None)
 
-        if not match_info:
-            return
+            if shard:
+                shard.rooms.discard(room.unique_id)
+
+        if self._rooms_by_room_id.get(room.room_id) is room:
+            del self._rooms_by_room_id[room.room_id]
+
+        return True
+
+    def on_room_id_changed(self, room: Room, previous_room_id: str) -> None:
+        if previous_room_id and self._rooms_by_room_id.get(previous_room_id) is room:
+            del self._rooms_by_room_id[previous_room_id]
 
-        room_id, name = match_info.groups()
-        room = self.get_room(unique_id=name)
+        if room.room_id:
+            self._rooms_by_room_id[room.room_id] = room
+
+    def on_room_changed(self, room: Room) -> None:
+        if len(self.publisher):
+            # through the cached text, which /room reuses, and so tuples compare equal to seeded lists
+            self.publisher.publish_room(json.loads(room.get_json_text()))
+
+    def get_shard_rooms(self, shard: Shard) -> list[Room]:
+        return [
+            room
+            for unique_id in list(shard.rooms)
+            if (room := self.rooms.get(unique_id))
+        ]
+
+    def disconnect_rooms(self, shard: Optional[Shard] = None) -> None:
+        # as room events, so the change is versioned and published like any other
+        for room in self.get_shard_rooms(shard) if shard else list(self.rooms.values()):
+            room.post(room.disconnect)
+
+    def on_match_created(self, event: MatchCreated) -> None:
+        room = self.get_room(unique_id=event.name)
 
         if room:
-            room.on_match_created(room_id=f"#mp_{room_id}")
-            room.connect()
+            referees = [
+                shard.name for shard in self.shards if shard.irc is not room.irc
+            ] + self.referees
+            room.post(room.on_match_created, f"#mp_{event.match_id}")
+            room.post(room.add_referees, referees)
+            room.post(room.connect)
+
+    def on_message_receive(
+        self, message: Optional[str | MESSAGE_YIELD], shard: Optional[Shard] = None
+    ) -> None:
+        shard = shard or self.shards[0]
+        username = shard.irc.username
 
-    def on_message_receive(self, message: Optional[str | MESSAGE_YIELD]) -> None:
         if isinstance(message, str):
-            message_dict = parse_message(message=message)
+            command, channel = peek_message(message)
 
-            if not message_dict:
+            # most of a busy connection is QUIT/JOIN/PART and chat from channels we are not in
+            if command == "QUIT" or not (
+                channel.startswith("#mp_") or channel == username
+            ):
                 return
 
-            if message_dict.get("command") != "QUIT":
-                logger.debug(message_dict)
+            started = time.perf_counter()
+            parsed = parse_message(message)
+            parse_seconds.observe(time.perf_counter() - started)
 
-            channel = message_dict.get("channel", "")
-            cmd_str = message_dict.get("command", "")
-            sender = message_dict.get("sender", "")
-            message = message_dict.get("message", "")
-
-            if cmd_str == "QUIT":
+            if not parsed:
                 return
 
-            if channel == self.irc.username and sender == "BanchoBot":
-                if message.startswith("Created the tournament match"):
-                    self.on_match_created(message)
+            traffic_logger.debug("RECV: %s", parsed)
+            sender, command, channel, message = parsed
+
+            if channel == username and sender == "BanchoBot":
+                event = classify_bancho_message(message)
+
+                if isinstance(event, MatchCreated):
+                    self.on_match_created(event)
             elif channel.startswith("#mp_"):
                 room = self.get_room(room_id=channel)
 
-                if isinstance(room, Room):
-                    room.on_message_receive(sender, message)
-            elif channel == self.irc.username and message.startswith("#mp_"):
+                # referee accounts can see rooms run by another shard
+                if isinstance(room, Room) and room.irc is shard.irc:
+                    room.post(room.on_message_receive, sender, message)
+            elif channel == username and message.startswith("#mp_"):
                 room = self.get_room(room_id=message.split(" ")[0])
 
-                if not isinstance(room, Room):
+                if not isinstance(room, Room) or room.irc is not shard.irc:
                     return
 
-                if cmd_str == "403":
-                    room.restart()
-                elif cmd_str == "332":
-                    room.connect()
+                if command == "403":
+                    room.post(room.restart)
+                elif command == "332":
+                    room.post(room.connect)
 
             return
 
         match message:
             case MESSAGE_YIELD.DISCONNECT:
-                logger.error("Connection has been lost")
-                self.disconnect_rooms()
+                logger.error("Connection of %s has been lost", username)
+                self.disconnect_rooms(shard)
+                self.rebalance(shard)
             case MESSAGE_YIELD.RECONECTION_FAILED:
-                logger.error("Reconnection failed")
+                logger.error("Reconnection of %s failed", username)
             case MESSAGE_YIELD.RECONNECTED:
-                logger.info("Connection has been reestablished")
-                self.join_rooms()
+                logger.info("Connection of %s has been reestablished", username)
+                self.join_rooms(shard)
 
     def create_rooms(self) -> None:
-        for room in self.rooms:
+        for room in self.rooms.values():
             if room._closed:
                 room.create()
 
-    def join_rooms(self) -> None:
-        for room in self.rooms:
-            room.join()
+    def join_rooms(self, shard: Optional[Shard] = None) -> None:
+        for room in self.get_shard_rooms(shard) if shard else list(self.rooms.values()):
+            room.post(room.join)
 
-    def run_message_listener(self) -> None:
-        for message in self.irc.message_generator():
-            self.on_message_receive(message)
+    def run_message_listener(self, shard: Optional[Shard] = None) -> None:
+        shard = shard or self.shards[0]
+
+        for message in shard.irc.message_generator():
+            self.on_message_receive(message, shard)
 
     def start(self, run_on_thread: bool = False) -> Optional[threading.Thread]:
-        self.irc.start()
+        for shard in self.shards:
+            shard.irc.start()
+
+        # every shard but the first always listens on its own thread
+        for shard in self.shards[1:]:
+            threading.Thread(
+                target=self.run_message_listener, args=(shard,), daemon=True
+            ).start()
 
         if run_on_thread:
             thread = threading.Thread(target=self.run_message_listener)
@@ -126,3 +356,174 @@ class RoomManager:
 
         self.run_message_listener()
         return None
+
+    def stop(self) -> None:
+        for shard in self.shards:
+            shard.irc.stop()
+
+
+class RoomManagerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        from bot.fakebancho import FakeBancho
+
+        self.banchos = [FakeBancho(), FakeBancho()]
+        self.ircs = [
+            OsuIrc(
+                username=name,
+                password="secret",
+                host="127.0.0.1",
+                port=bancho.start(),
+                reconnect_delay=60,
+            )
+            for name, bancho in zip(["first", "second"], self.banchos)
+        ]
+        self.manager = RoomManager(irc=self.ircs[0])
+        self.manager.add_shard(self.ircs[1])
+
+    def tearDown(self) -> None:
+        self.manager.stop()
+
+        for bancho in self.banchos:
+            bancho.stop()
+
+    def make_beatmap(self) -> RoomBeatmap:
+        # placeholder maps up to the high-water mark keep RoomBeatmap from searching the osu! api
+        return RoomBeatmap(
+            beatmap_list=[
+                SimpleNamespace(id=index)
+                for index in range(RoomBeatmap.high_water_mark)
+            ]
+        )
+
+    def make_room(self, name: str) -> Room:
+        return self.manager.add_room(
+            Room(irc=self.manager.irc, beatmap=self.make_beatmap(), name=name)
+        )
+
+    def test_assign(self):
+        rooms = [self.make_room(f"room {index}") for index in range(4)]
+        self.assertEqual(
+            [room.irc.username for room in rooms],
+            ["first", "second", "first", "second"],
+        )
+        self.assertEqual([len(shard.rooms) for shard in self.manager.shards], [2, 2])
+
+        self.manager.remove_room(rooms[0])
+        self.assertIs(self.make_room("room 4").irc, self.ircs[0])
+
+    def test_update(self):
+        room = self.make_room("room")
+        names: list[str] = []
+        modes = {
+            name: getattr(room, name).name
+            for name in ["bot_mode", "play_mode", "team_mode", "score_mode"]
+        }
+        beatmap = room.beatmap.get_json(
+            ["star", "ar", "cs", "length", "bpm", "rank_status", "genre", "language"]
+        )
+        data = {"name": "renamed", "room_size": 16, **modes, "beatmap": beatmap}
+
+        def event() -> None:
+            self.manager.update_room(room.unique_id, data)
+            names.append(
+                room.name
+            )  # queued behind this event, not run in the middle of it
+
+        room.post(event)
+        self.assertEqual((names, room.name), (["room"], "renamed"))
+
+    def test_snapshot(self):
+        room = self.make_room("room")
+        etag = self.manager.get_rooms_etag()
+        listing = self.manager.dump_rooms_json()
+
+        self.assertEqual(self.manager.get_rooms_etag(), etag)
+        self.assertIs(room.get_json_text(), room.get_json_text())
+
+        room.post(room.add_user, "Some Player")
+        self.assertNotEqual(self.manager.get_rooms_etag(), etag)
+        self.assertNotEqual(self.manager.dump_rooms_json(), listing)
+        self.assertEqual(
+            json.loads(self.manager.dump_rooms_json())[0]["users"], ["Some_Player"]
+        )
+
+    def test_disconnect(self):
+        room = self.make_room("room")
+        room.post(room.connect)
+        etag = self.manager.get_rooms_etag(room.unique_id)
+        subscriber = self.manager.publisher.subscribe()
+        self.manager.publisher.seed(json.loads(self.manager.dump_rooms_json()))
+
+        self.manager.on_message_receive(
+            MESSAGE_YIELD.DISCONNECT, self.manager.shards[0]
+        )
+        self.assertNotEqual(self.manager.get_rooms_etag(room.unique_id), etag)
+        self.assertFalse(json.loads(room.get_json_text())["is_connected"])
+        self.assertEqual(
+            subscriber.events.get(timeout=5),
+            f'event: room\ndata: {{"id":"{room.unique_id}","is_connected":false}}\n\n',
+        )
+        self.assertEqual(self.manager.get_rooms_etag("missing"), "")
+
+    def test_query(self):
+        rooms = [self.make_room(f"room {index}") for index in range(3)]
+        rooms[1].is_connected = True
+
+        query = RoomQuery(
+            is_connected=False, limit=1, offset=1, fields=("name", "beatmap.current")
+        )
+        listing = json.loads(self.manager.dump_rooms_json(query))
+        self.assertEqual(
+            listing, [{"name": "room 2", "beatmap": {"current": {"id": 0}}}]
+        )
+        self.assertEqual(
+            len(json.loads(self.manager.dump_rooms_json(RoomQuery(play_mode="MANIA")))),
+            0,
+        )
+        self.assertNotEqual(
+            self.manager.get_rooms_etag(query=query), self.manager.get_rooms_etag()
+        )
+
+    def test_publish(self):
+        subscriber = self.manager.publisher.subscribe()
+        room = self.make_room("room")
+        room.post(room.add_user, "Some Player")
+        self.manager.remove_room(room)
+
+        events = [subscriber.events.get(timeout=5) for _ in range(3)]
+        self.assertTrue(
+            events[0].startswith(
+                f'event: room\ndata: {{"id":"{room.unique_id}","name":"room"'
+            )
+        )
+        self.assertEqual(
+            events[1],
+            f'event: room\ndata: {{"id":"{room.unique_id}","users":["Some_Player"]}}\n\n',
+        )
+        self.assertEqual(
+            events[2], f'event: removed\ndata: {{"id":"{room.unique_id}"}}\n\n'
+        )
+
+    def test_rebalance(self):
+        room = self.make_room("room")
+        room.set_room_id("#mp_1")
+        self.manager.start(run_on_thread=True)
+        self.assertTrue(
+            self.banchos[0].wait_for(lambda: "NICK first" in self.banchos[0].received)
+        )
+        self.assertTrue(
+            self.banchos[1].wait_for(lambda: "NICK second" in self.banchos[1].received)
+        )
+
+        self.banchos[0].stop()
+        self.banchos = self.banchos[1:]
+
+        self.assertTrue(
+            self.banchos[0].wait_for(lambda: "JOIN #mp_1" in self.banchos[0].received)
+        )
+        self.assertIs(room.irc, self.ircs[1])
+        self.assertEqual(self.manager.get_shard(room), self.manager.shards[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import heapq
+import itertools
+import threading
+import time
+import unittest
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+from my_logger import get_logger
+
+logger = get_logger("rooms")
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@dataclass(order=True)
+class Timer:
+    deadline: float
+    sequence: int
+    callback: Callable[..., Any] = field(compare=False)
+    args: tuple[Any, ...] = field(compare=False, default=())
+    cancelled: bool = field(compare=False, default=False)
+    popped: bool = field(
+        compare=False, default=False
+    )  # no longer in the heap, due or purged
+
+
+@dataclass
+class Scheduler:
+    """
+    Heap based timers for every room, run on one shared thread.
+    Cancelling only flags the timer, flagged timers are skipped when they come due
+    and purged once they make up most of the heap.
+    """
+
+    clock: Callable[[], float] = time.monotonic
+    run_on_thread: bool = True
+    is_running: bool = False
+
+    _timers: list[Timer] = field(default_factory=list)
+    _cancelled: int = 0
+    _sequence: Iterator[int] = field(default_factory=itertools.count)
+    _condition: threading.Condition = field(default_factory=threading.Condition)
+    _thread: threading.Thread | None = None
+
+    def __len__(self) -> int:
+        return len(self._timers) - self._cancelled
+
+    def call_later(
+        self, delay: float, callback: Callable[..., Any], *args: Any
+    ) -> Timer:
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def call_at(
+        self, deadline: float, callback: Callable[..., Any], *args: Any
+    ) -> Timer:
+        """run `callback` once `clock` reaches `deadline`, right away on the next run if it already has"""
+        timer = Timer(deadline, next(self._sequence), callback, args)
+
+        with self._condition:
+            heapq.heappush(self._timers, timer)
+            self._condition.notify()
+
+        if self.run_on_thread and not self.is_running:
+            self.start()
+
+        return timer
+
+    def cancel(self, timer: Timer) -> None:
+        with self._condition:
+            if timer.cancelled:
+                return
+
+            timer.cancelled = True
+
+            # a popped timer isn't counted, it already left the heap (or is about to run, run_pending skips it)
+            if timer.popped:
+                return
+
+            self._cancelled += 1
+
+            if self._cancelled > 64 and self._cancelled > len(self._timers) // 2:
+                for purged in self._timers:
+                    purged.popped = purged.cancelled
+
+                self._timers = [timer for timer in self._timers if not timer.cancelled]
+                heapq.heapify(self._timers)
+                self._cancelled = 0
+
+    def pop_due(self) -> Timer | None:
+        with self._condition:
+            while self._timers and self._timers[0].deadline <= self.clock():
+                timer = heapq.heappop(self._timers)
+                timer.popped = True
+
+                if not timer.cancelled:
+                    return timer
+
+                self._cancelled -= 1
+
+        return None
+
+    def run_pending(self) -> int:
+        ran = 0
+
+        while timer := self.pop_due():
+            if timer.cancelled:  # cancelled between popping and running
+                continue
+
+            ran += 1
+
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Scheduled callback failed")
+
+        return ran
+
+    def next_delay(self) -> float | None:
+        if not self._timers:
+            return None
+
+        return max(self._timers[0].deadline - self.clock(), 0.0)
+
+    def run(self) -> None:
+        while self.is_running:
+            self.run_pending()
+
+            with self._condition:
+                delay = self.next_delay()
+
+                if delay is None or delay > 0:
+                    self._condition.wait(delay)
+
+    def start(self) -> None:
+        with self._condition:
+            if self.is_running:
+                return
+
+            self.is_running = True
+
+        self._thread = threading.Thread(target=self.run, daemon=True, name="scheduler")
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self.is_running = False
+            self._condition.notify()
+
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+scheduler = Scheduler()
+
+
+class SchedulerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        self.scheduler = Scheduler(clock=self.clock, run_on_thread=False)
+        self.calls: list[str] = []
+
+    def test_order(self):
+        self.scheduler.call_later(2, self.calls.append, "b")
+        self.scheduler.call_later(1, self.calls.append, "a")
+        self.scheduler.call_later(3, self.calls.append, "c")
+
+        self.clock.advance(2)
+        self.assertEqual(self.scheduler.run_pending(), 2)
+        self.assertEqual(self.calls, ["a", "b"])
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_cancel(self):
+        timer = self.scheduler.call_later(1, self.calls.append, "a")
+        self.scheduler.cancel(timer)
+        self.clock.advance(1)
+
+        self.assertEqual(self.scheduler.run_pending(), 0)
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_cancel_fired(self):
+        timer = self.scheduler.call_later(1, self.calls.append, "a")
+        self.clock.advance(1)
+        self.scheduler.run_pending()
+        self.scheduler.cancel(timer)
+
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(len(self.scheduler), 0)
+
+        self.scheduler.call_later(1, self.calls.append, "b")
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_thread(self):
+        scheduler = Scheduler()
+        fired = threading.Event()
+        scheduler.call_later(0.01, fired.set)
+
+        self.assertTrue(fired.wait(1))
+        scheduler.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
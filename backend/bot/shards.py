@@ -0,0 +1,86 @@
+import unittest
+from dataclasses import dataclass, field
+from bot.irc import OsuIrc
+from bot.scheduler import FakeClock
+
+
+@dataclass
+class Shard:
+    """one bancho login and the rooms it runs, each login has its own outbound rate budget"""
+
+    irc: OsuIrc
+    rooms: set[str] = field(default_factory=set)  # room unique ids
+    budget_weight: float = 10.0  # a saturated outbound budget weighs as this many rooms
+
+    @property
+    def name(self) -> str:
+        return self.irc.username
+
+    @property
+    def is_connected(self) -> bool:
+        return self.irc.is_connected
+
+    def get_message_rate(self) -> float:
+        """messages per second sent over the last rate limit period"""
+        return self.irc.rate_limiter.get_spent() / self.irc.rate_limiter.period
+
+    def get_load(self) -> float:
+        """rooms served plus the share of the outbound budget spent or already queued"""
+        rate_limiter = self.irc.rate_limiter
+        usage = (
+            rate_limiter.get_spent() + len(self.irc.outbound)
+        ) / rate_limiter.capacity
+        return len(self.rooms) + usage * self.budget_weight
+
+
+def pick_shard(
+    shards: list[Shard], exclude: Shard | None = None, connected_only: bool = False
+) -> Shard | None:
+    """least loaded shard, None when no shard qualifies"""
+    candidates = [
+        shard
+        for shard in shards
+        if shard is not exclude and (shard.is_connected or not connected_only)
+    ]
+
+    if not candidates:
+        return None
+
+    return min(candidates, key=Shard.get_load)
+
+
+class ShardTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def make_shard(self, name: str, rooms: int = 0) -> Shard:
+        irc = OsuIrc(username=name, password="")
+        irc.rate_limiter.clock = self.clock
+        return Shard(irc, rooms={f"{name}-{index}" for index in range(rooms)})
+
+    def test_room_count(self):
+        shards = [self.make_shard("a", rooms=2), self.make_shard("b", rooms=1)]
+        self.assertIs(pick_shard(shards), shards[1])
+        self.assertIs(pick_shard(shards, exclude=shards[1]), shards[0])
+
+    def test_message_rate(self):
+        shards = [self.make_shard("a", rooms=1), self.make_shard("b", rooms=2)]
+
+        for _ in range(10):
+            shards[0].irc.rate_limiter.consume()
+
+        self.assertEqual(shards[0].get_message_rate(), 2.0)
+        self.assertIs(pick_shard(shards), shards[1])
+
+        self.clock.advance(5)
+        self.assertIs(pick_shard(shards), shards[0])
+
+    def test_connected_only(self):
+        shards = [self.make_shard("a"), self.make_shard("b", rooms=3)]
+        shards[1].irc.is_connected = True
+        self.assertIs(pick_shard(shards, connected_only=True), shards[1])
+        self.assertIsNone(pick_shard(shards, exclude=shards[1], connected_only=True))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,643 @@
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from multiprocessing.context import SpawnContext
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Iterator
+from bot.enums import MessageResponse, RoomData, RoomQuery, UserCredentials
+from bot.metrics import MetricFamily, add_label, merge, metrics
+from bot.publisher import RoomPublisher, Subscriber
+from my_logger import get_logger
+
+logger = get_logger("rooms")
+
+# (request id, method, args), None stops the worker
+WorkerRequest = tuple[int, str, tuple[Any, ...]] | None
+# (request id, result, error)
+WorkerResponse = tuple[int, Any, str | None]
+# response request id of room events forwarded from a worker's publisher
+EVENT_REQUEST_ID = -1
+
+WORKER_TIMEOUT: MessageResponse = {"message": "Room worker didn't answer in time"}
+
+
+class WorkerTimeoutError(Exception):
+    """a worker didn't answer within RoomWorkerPool.timeout, app.py answers it with a 503"""
+
+
+@dataclass
+class EventForwarder:
+    """
+    Worker side of RoomWorkerPool.publisher, sends the worker's room events back over the response queue.
+    Subscribed only while the Flask process has /room/events clients, otherwise the worker's rooms
+    don't build deltas for nobody (see RoomManager.on_room_changed).
+    """
+
+    publisher: RoomPublisher
+    responses: "multiprocessing.Queue[WorkerResponse]"
+    poll: float = (
+        1.0  # seconds the forwarding thread takes at most to notice it was stopped
+    )
+
+    _subscriber: Subscriber | None = None
+    _thread: threading.Thread | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def start(self) -> None:
+        with self._lock:
+            if not self._subscriber:
+                self._subscriber = self.publisher.subscribe()
+
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self.forward, daemon=True, name="room-events"
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._subscriber:
+                self.publisher.unsubscribe(self._subscriber)
+                self._subscriber = None
+
+    def forward(self) -> None:
+        while True:
+            with self._lock:
+                subscriber = self._subscriber
+
+                if not subscriber:
+                    self._thread = None
+                    return
+
+                if (
+                    subscriber.is_dropped
+                ):  # fell behind, the flask side gets the changes from here on
+                    subscriber = self._subscriber = self.publisher.subscribe()
+
+            try:
+                self.responses.put(
+                    (EVENT_REQUEST_ID, subscriber.events.get(timeout=self.poll), None)
+                )
+            except queue.Empty:
+                continue
+
+
+def run_worker(
+    credentials: UserCredentials,
+    referees: list[str],
+    requests: "multiprocessing.Queue[WorkerRequest]",
+    responses: "multiprocessing.Queue[WorkerResponse]",
+) -> None:
+    """worker process main, one bancho connection and the rooms it runs, the other accounts referee them"""
+    from bot.irc import OsuIrc
+    from bot.roommanager import RoomManager
+
+    irc = OsuIrc(username=credentials["username"], password=credentials["password"])
+    manager = RoomManager(irc=irc, referees=referees)
+    forwarder = EventForwarder(manager.publisher, responses)
+    methods: dict[str, Callable[..., Any]] = {
+        "create_room": manager.create_room,
+        "update_room": manager.update_room,
+        "delete_room": manager.delete_room,
+        "get_rooms_json_text": manager.get_rooms_json_text,
+        "dump_room_json": manager.dump_room_json,
+        "get_rooms_etag": manager.get_rooms_etag,
+        "collect_metrics": manager.collect_metrics,
+        "forward_events": forwarder.start,
+        "stop_events": forwarder.stop,
+        "start": lambda: bool(manager.start(run_on_thread=True)),
+        "stop": manager.stop,
+        "ping": lambda: True,
+    }
+    while request := requests.get():
+        request_id, method, args = request
+
+        try:
+            responses.put((request_id, methods[method](*args), None))
+        except Exception as e:
+            logger.exception("Worker %s failed on %s", credentials["username"], method)
+            responses.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+    manager.stop()
+
+
+@dataclass
+class RoomWorker:
+    credentials: UserCredentials
+    process: BaseProcess
+    requests: "multiprocessing.Queue[WorkerRequest]"
+    responses: "multiprocessing.Queue[WorkerResponse]"  # one per process, a killed one can't leave it locked for the rest
+    rooms: dict[str, Any] = field(
+        default_factory=dict
+    )  # unique_id -> room data, to make them again on a respawn
+
+    @property
+    def name(self) -> str:
+        return self.credentials["username"]
+
+
+@dataclass
+class RoomWorkerPool:
+    """
+    RoomManager api backed by worker processes, one per bot account, so room handling,
+    beatmap filtering and /room serialization run outside the Flask process and its GIL.
+    Processes are spawned on first use, the Flask process only keeps which worker runs which room
+    and the data to make those rooms again. A worker that exits or doesn't answer a ping within
+    `timeout` is replaced every `check_interval` seconds, with its rooms made again.
+
+    New rooms go to the worker with the fewest rooms and every other account is added as their
+    referee, but a dropped connection isn't rebalanced onto another worker (see RoomManager.rebalance),
+    its rooms wait for the worker to reconnect.
+    """
+
+    accounts: list[UserCredentials]
+    timeout: float = 10.0
+    check_interval: float = (
+        5.0  # 0 leaves checking the workers to the caller, see check
+    )
+    context: SpawnContext = field(
+        default_factory=lambda: multiprocessing.get_context("spawn")
+    )
+    target: Callable[..., None] = run_worker
+    is_running: bool = False
+    publisher: RoomPublisher = field(
+        default_factory=RoomPublisher
+    )  # events forwarded from every worker
+
+    workers: list[RoomWorker] = field(default_factory=list)
+    _futures: dict[int, tuple[RoomWorker, Future[Any]]] = field(default_factory=dict)
+    _request_ids: Iterator[int] = field(default_factory=itertools.count)
+    _closed: threading.Event = field(default_factory=threading.Event)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self.publisher.on_active = self.on_events_active
+
+    def on_events_active(self, is_active: bool) -> None:
+        """workers forward room events only while /room/events has clients, the calls aren't waited on"""
+        for worker in list(self.workers):
+            self.call(worker, "forward_events" if is_active else "stop_events")
+
+    def spawn(self) -> None:
+        with self._lock:
+            if self.workers:
+                return
+
+            self._closed.clear()
+
+            for credentials in self.accounts:
+                self.workers.append(
+                    RoomWorker(credentials, *self.start_process(credentials))
+                )
+
+        for worker in self.workers:
+            self.listen(worker)
+
+        if self.check_interval:
+            threading.Thread(
+                target=self.watch, daemon=True, name="room-worker-watch"
+            ).start()
+
+        if len(self.publisher):
+            self.on_events_active(True)
+
+    def start_process(
+        self, credentials: UserCredentials
+    ) -> tuple[
+        BaseProcess,
+        "multiprocessing.Queue[WorkerRequest]",
+        "multiprocessing.Queue[WorkerResponse]",
+    ]:
+        referees = [
+            account["username"]
+            for account in self.accounts
+            if account is not credentials
+        ]
+        requests: "multiprocessing.Queue[WorkerRequest]" = self.context.Queue()
+        responses: "multiprocessing.Queue[WorkerResponse]" = self.context.Queue()
+        process = self.context.Process(
+            target=self.target,
+            args=(credentials, referees, requests, responses),
+            name=f"room-worker-{credentials['username']}",
+            daemon=True,
+        )
+        process.start()
+        return process, requests, responses
+
+    def watch(self) -> None:
+        while not self._closed.wait(self.check_interval):
+            for worker in list(self.workers):
+                self.check(worker)
+
+    def check(self, worker: RoomWorker) -> bool:
+        """replace the worker's process if it exited or doesn't answer, False when it had to"""
+        ping = self.call(worker, "ping")
+        deadline = time.monotonic() + self.timeout
+
+        # a process that dies while the ping waits is noticed without sitting out the timeout
+        while (
+            not ping.done()
+            and worker.process.is_alive()
+            and time.monotonic() < deadline
+        ):
+            concurrent.futures.wait([ping], timeout=0.1)
+
+        if ping.done():
+            return True
+
+        if worker.process.is_alive():
+            logger.error(
+                "Room worker %s didn't answer a ping within %ss, restarting it",
+                worker.name,
+                self.timeout,
+            )
+            worker.process.kill()
+            worker.process.join(self.timeout)
+        else:
+            logger.error(
+                "Room worker %s exited with %s, restarting it",
+                worker.name,
+                worker.process.exitcode,
+            )
+
+        if not self._closed.is_set():
+            self.respawn(worker)
+
+        return False
+
+    def respawn(self, worker: RoomWorker) -> None:
+        """a new process for the worker's account, it gets the rooms the old one ran"""
+        with self._lock:
+            lost = [
+                request_id
+                for request_id, (owner, _) in self._futures.items()
+                if owner is worker
+            ]
+            futures = [self._futures.pop(request_id)[1] for request_id in lost]
+
+        for future in futures:
+            future.set_exception(
+                RuntimeError(f"Room worker {worker.name} was restarted")
+            )
+
+        worker.process, worker.requests, worker.responses = self.start_process(
+            worker.credentials
+        )
+        self.listen(worker)
+
+        # none of these are waited on, the new process answers them in order once it is up
+        if self.is_running:
+            self.call(worker, "start")
+
+        if len(self.publisher):
+            self.call(worker, "forward_events")
+
+        for unique_id, data in list(worker.rooms.items()):
+            self.call(worker, "create_room", dict(data))
+            logger.info("Making room %s again on worker %s", unique_id, worker.name)
+
+    def listen(self, worker: RoomWorker) -> None:
+        name = f"room-worker-{worker.name}-responses"
+        threading.Thread(
+            target=self.collect_responses,
+            args=(worker, worker.responses),
+            daemon=True,
+            name=name,
+        ).start()
+
+    def collect_responses(
+        self, worker: RoomWorker, responses: "multiprocessing.Queue[WorkerResponse]"
+    ) -> None:
+        # polled, nothing is put in the queue of a replaced process to end this as it may be locked for good
+        while not self._closed.is_set() and worker.responses is responses:
+            try:
+                request_id, result, error = responses.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            if request_id == EVENT_REQUEST_ID:
+                self.publisher.publish_raw(result)
+                continue
+
+            with self._lock:
+                _, future = self._futures.pop(request_id, (None, None))
+
+            if not future:
+                continue
+
+            if error:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(result)
+
+    def call(self, worker: RoomWorker, method: str, *args: Any) -> Future[Any]:
+        future: Future[Any] = Future()
+
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._futures[request_id] = (worker, future)
+
+        worker.requests.put((request_id, method, args))
+        return future
+
+    def wait(self, future: Future[Any], method: str) -> Any:
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # the request still runs, a late response resolves the future nobody waits on anymore
+            logger.error(
+                "Room worker didn't answer %s within %ss", method, self.timeout
+            )
+            raise WorkerTimeoutError(method) from None
+
+    def request(self, worker: RoomWorker, method: str, *args: Any) -> Any:
+        return self.wait(self.call(worker, method, *args), method)
+
+    def broadcast(self, method: str, *args: Any) -> list[Any]:
+        self.spawn()
+        futures = [self.call(worker, method, *args) for worker in self.workers]
+        return [self.wait(future, method) for future in futures]
+
+    def get_worker(self, unique_id: str) -> RoomWorker | None:
+        self.spawn()
+        return next(
+            (worker for worker in self.workers if unique_id in worker.rooms), None
+        )
+
+    def start(self, run_on_thread: bool = True) -> None:
+        self.broadcast("start")
+        self.is_running = True
+
+    def stop(self) -> None:
+        self.broadcast("stop")
+        self.is_running = False
+
+    def close(self) -> None:
+        self._closed.set()
+
+        for worker in self.workers:
+            worker.requests.put(None)
+            worker.process.join(self.timeout)
+
+        self.workers = []
+
+    def dump_rooms_json(self, query: RoomQuery = RoomQuery()) -> str:
+        # every worker filters and serializes its own rooms, the page is only cut and concatenated here
+        end = None if query.limit is None else query.offset + query.limit
+        listings = self.broadcast(
+            "get_rooms_json_text", query._replace(offset=0, limit=end)
+        )
+        rooms = [room for listing in listings for room in listing][query.offset : end]
+        return f"[{','.join(rooms)}]"
+
+    def dump_room_json(
+        self, unique_id: str, fields: tuple[str, ...] = ()
+    ) -> str | None:
+        worker = self.get_worker(unique_id)
+        return (
+            self.request(worker, "dump_room_json", unique_id, fields)
+            if worker
+            else None
+        )
+
+    def get_rooms_etag(
+        self, unique_id: str = "", query: RoomQuery = RoomQuery()
+    ) -> str:
+        if unique_id:
+            worker = self.get_worker(unique_id)
+            etag = (
+                self.request(worker, "get_rooms_etag", unique_id, query)
+                if worker
+                else ""
+            )
+            return etag  # type: ignore[no-any-return]
+
+        return "-".join(self.broadcast("get_rooms_etag", "", query))
+
+    def collect_metrics(self) -> list[MetricFamily]:
+        """metrics of this process and of every worker, labelled with the worker's account"""
+        families = metrics.collect()
+        collected_by_worker = self.broadcast("collect_metrics")
+
+        for worker, collected in zip(self.workers, collected_by_worker):
+            families.extend(add_label(collected, "worker", worker.name))
+
+        return merge(families)
+
+    def create_room(self, data: Any) -> tuple[MessageResponse | RoomData, int]:
+        self.spawn()
+        worker = min(self.workers, key=lambda worker: len(worker.rooms))
+        future = self.call(worker, "create_room", data)
+
+        def on_created(future: Future[Any]) -> None:
+            # also when the request timed out, the room the worker made late is reachable all the same
+            if not future.exception():
+                room, status = future.result()
+
+                if status == 201:
+                    worker.rooms[room["id"]] = {**data, "unique_id": room["id"]}
+
+        future.add_done_callback(on_created)
+
+        try:
+            return self.wait(future, "create_room")  # type: ignore[no-any-return]
+        except WorkerTimeoutError:
+            return WORKER_TIMEOUT, 503
+
+    def update_room(
+        self, unique_id: str, data: Any
+    ) -> tuple[MessageResponse | RoomData, int]:
+        worker = self.get_worker(unique_id)
+
+        if not worker:
+            return {"message": "No room found!"}, 400
+
+        try:
+            room, status = self.request(worker, "update_room", unique_id, data)
+        except WorkerTimeoutError:
+            return WORKER_TIMEOUT, 503
+
+        if status == 200:
+            worker.rooms[unique_id] = {**data, "unique_id": unique_id}
+
+        return room, status
+
+    def delete_room(self, unique_id: str) -> tuple[MessageResponse, int]:
+        worker = self.get_worker(unique_id)
+
+        if not worker:
+            return {"message": "No room found!"}, 400
+
+        future = self.call(worker, "delete_room", unique_id)
+        rooms = worker.rooms
+
+        def on_deleted(future: Future[Any]) -> None:
+            if not future.exception() and future.result()[1] == 204:
+                rooms.pop(unique_id, None)
+
+        future.add_done_callback(on_deleted)
+
+        try:
+            return self.wait(future, "delete_room")  # type: ignore[no-any-return]
+        except WorkerTimeoutError:
+            return WORKER_TIMEOUT, 503
+
+
+def run_echo_worker(
+    credentials: UserCredentials,
+    referees: list[str],
+    requests: "multiprocessing.Queue[WorkerRequest]",
+    responses: "multiprocessing.Queue[WorkerResponse]",
+) -> None:
+    """stand-in for run_worker in tests, keeps rooms as plain dicts"""
+    rooms: dict[str, Any] = {}
+
+    while request := requests.get():
+        request_id, method, args = request
+
+        if method == "create_room":
+            time.sleep(args[0].get("delay", 0))
+            unique_id = args[0].get("unique_id", args[0]["name"])
+            room = rooms[unique_id] = {
+                "id": unique_id,
+                "shard": credentials["username"],
+                "referees": referees,
+            }
+            responses.put((request_id, (room, 201), None))
+        elif method == "ping":
+            responses.put((request_id, True, None))
+        elif method == "get_rooms_json_text":
+            responses.put(
+                (request_id, [json.dumps(unique_id) for unique_id in rooms], None)
+            )
+        else:
+            responses.put((request_id, None, f"KeyError: {method!r}"))
+
+
+class RoomWorkerPoolTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        accounts: list[UserCredentials] = [
+            {"username": "first", "password": ""},
+            {"username": "second", "password": ""},
+        ]
+        self.pool = RoomWorkerPool(
+            accounts=accounts, target=run_echo_worker, check_interval=0
+        )
+
+    def tearDown(self) -> None:
+        self.pool.close()
+
+    def test_create(self):
+        rooms: list[Any] = [
+            self.pool.create_room({"name": name})[0] for name in ["a", "b", "c"]
+        ]
+        self.assertEqual(
+            [room["shard"] for room in rooms], ["first", "second", "first"]
+        )
+        self.assertEqual(
+            [room["referees"] for room in rooms], [["second"], ["first"], ["second"]]
+        )
+        self.assertEqual(
+            sorted(json.loads(self.pool.dump_rooms_json())), ["a", "b", "c"]
+        )
+        self.assertEqual(
+            json.loads(self.pool.dump_rooms_json(RoomQuery(offset=1, limit=1))), ["c"]
+        )
+
+    def test_timeout(self):
+        self.pool.timeout = 0.1
+        self.assertEqual(
+            self.pool.create_room({"name": "slow", "delay": 0.3}), (WORKER_TIMEOUT, 503)
+        )
+
+        # the worker made the room anyway, it becomes reachable once the late response arrives
+        deadline = time.monotonic() + 5
+        while not self.pool.get_worker("slow") and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertIsNotNone(self.pool.get_worker("slow"))
+
+        with self.assertRaises(WorkerTimeoutError):
+            self.pool.broadcast("create_room", {"name": "slower", "delay": 0.3})
+
+        self.pool.timeout = (
+            10.0  # close() waits for the workers to answer before stopping them
+        )
+
+    def test_respawn(self):
+        self.pool.create_room({"name": "a"})
+        self.pool.create_room({"name": "b"})
+        first = self.pool.workers[0]
+        self.assertTrue(self.pool.check(first))
+
+        first.process.kill()
+        first.process.join()
+        self.assertFalse(self.pool.check(first))
+        self.assertTrue(self.pool.check(first))
+        self.assertEqual(sorted(json.loads(self.pool.dump_rooms_json())), ["a", "b"])
+
+        # stuck on a request for longer than the timeout
+        self.pool.timeout = 0.2
+        self.pool.call(first, "create_room", {"name": "slow", "delay": 5})
+        self.assertFalse(self.pool.check(first))
+        self.pool.timeout = 10.0
+        self.assertTrue(self.pool.check(first))
+        self.assertEqual(sorted(json.loads(self.pool.dump_rooms_json())), ["a", "b"])
+
+    def test_watch(self):
+        pool = RoomWorkerPool(
+            accounts=[{"username": "first", "password": ""}], target=run_echo_worker
+        )
+        pool.check_interval = 0.2
+        pool.create_room({"name": "a"})
+        process = pool.workers[0].process
+        process.kill()
+        process.join()
+
+        deadline = time.monotonic() + 10
+        while pool.workers[0].process is process and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # the rooms are made again by requests queued right after the new process started
+        self.assertIsNot(pool.workers[0].process, process)
+        self.assertEqual(pool.request(pool.workers[0], "ping"), True)
+        self.assertEqual(json.loads(pool.dump_rooms_json()), ["a"])
+        pool.close()
+
+    def test_forward_events(self):
+        publisher = RoomPublisher()
+        responses: "multiprocessing.Queue[WorkerResponse]" = (
+            multiprocessing.get_context("spawn").Queue()
+        )
+        forwarder = EventForwarder(publisher, responses, poll=0.05)
+        self.assertEqual(len(publisher), 0)
+
+        forwarder.start()
+        forwarder.start()
+        self.assertEqual(len(publisher), 1)
+        publisher.publish_removed("a")
+        self.assertEqual(
+            responses.get(timeout=5),
+            (EVENT_REQUEST_ID, 'event: removed\ndata: {"id":"a"}\n\n', None),
+        )
+
+        forwarder.stop()
+        self.assertEqual(len(publisher), 0)
+
+    def test_missing_room(self):
+        self.assertIsNone(self.pool.dump_room_json("a"))
+
+    def test_error(self):
+        with self.assertRaises(RuntimeError):
+            self.pool.start()
+
+
+if __name__ == "__main__":
+    unittest.main()
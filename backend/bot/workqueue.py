@@ -0,0 +1,107 @@
+import os
+import threading
+import unittest
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from my_logger import get_logger
+
+logger = get_logger("rooms")
+
+# blocking osu! api calls made on behalf of rooms run here instead of on the irc dispatch thread
+api_workers = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("API_WORKERS", 4)), thread_name_prefix="osu-api"
+)
+
+
+@dataclass
+class SerialQueue:
+    """
+    Runs posted callbacks one at a time in posting order, on whichever thread posts while the
+    queue is idle. Callbacks posted while another one runs are picked up by that thread,
+    so a room's events never run concurrently and no thread per room is needed.
+    """
+
+    _events: deque[tuple[Callable[..., Any], tuple[Any, ...]]] = field(
+        default_factory=deque
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    _is_draining: bool = False
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def post(self, callback: Callable[..., Any], *args: Any) -> None:
+        with self._lock:
+            self._events.append((callback, args))
+
+            if self._is_draining:
+                return
+
+            self._is_draining = True
+
+        self.drain()
+
+    def drain(self) -> None:
+        while True:
+            with self._lock:
+                if not self._events:
+                    self._is_draining = False
+                    return
+
+                callback, args = self._events.popleft()
+
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Room event failed")
+
+
+class SerialQueueTestCase(unittest.TestCase):
+    def test_nested_post(self):
+        events = SerialQueue()
+        calls: list[str] = []
+
+        def first() -> None:
+            events.post(calls.append, "second")
+            calls.append("first")
+
+        events.post(first)
+        self.assertEqual(calls, ["first", "second"])
+
+    def test_serialized(self):
+        events = SerialQueue()
+        started = threading.Event()
+        release = threading.Event()
+        calls: list[str] = []
+
+        def slow() -> None:
+            started.set()
+            release.wait()
+            calls.append("slow")
+
+        thread = threading.Thread(target=events.post, args=(slow,))
+        thread.start()
+        started.wait()
+
+        events.post(
+            calls.append, "fast"
+        )  # returns at once, runs after slow on the other thread
+        self.assertEqual(calls, [])
+
+        release.set()
+        thread.join()
+        self.assertEqual(calls, ["slow", "fast"])
+
+    def test_error(self):
+        events = SerialQueue()
+        calls: list[str] = []
+
+        events.post(lambda: 1 / 0)
+        events.post(calls.append, "next")
+        self.assertEqual(calls, ["next"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,26 +1,156 @@
+import atexit
 import logging
+import multiprocessing
 import os
+import queue
 import sys
-import time
+import unittest
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# handlers run on the listener thread, logging calls only put the record on a queue.
+# LOG_LEVEL sets the level of every logger, LOG_LEVELS of single subsystems (see get_logger),
+# LOG_SAMPLE keeps 1 of every N records of a subsystem, both as `name=value,name2=value2`
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "DEBUG")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 5))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+
+class SampleFilter(logging.Filter):
+    """keeps the first of every `every` records, for high-volume loggers like channel traffic"""
+
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = max(every, 1)
+        self.seen = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        self.seen += 1
+        return (self.seen - 1) % self.every == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records on the queue unformatted, the message is only built on the listener thread.
+    Records are dropped when the listener falls behind rather than blocking the caller.
+    """
+
+    def __init__(self, records: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_settings(text: str) -> dict[str, str]:
+    """`name=value,name2=value2` -> {name: value}"""
+    settings = {}
+
+    for setting in text.split(","):
+        name, _, value = setting.partition("=")
+
+        if name.strip() and value.strip():
+            settings[name.strip()] = value.strip()
+
+    return settings
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """child of my_logger for a subsystem (irc, traffic, rooms, beatmaps), levels come from LOG_LEVELS"""
+    return logger.getChild(subsystem)
+
+
+def configure_subsystems(levels: str, samples: str) -> None:
+    for subsystem, level in parse_settings(levels).items():
+        get_logger(subsystem).setLevel(level.upper())
+
+    for subsystem, every in parse_settings(samples).items():
+        get_logger(subsystem).addFilter(SampleFilter(int(every)))
+
 
-# Create a logger
 logger = logging.getLogger("my_logger")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL.upper())
+logger.propagate = False
 
 log_dir = os.path.join(os.getcwd(), "logs")
 
 if not os.path.exists(log_dir):
     os.mkdir(log_dir)
 
-# Create a file handler and set the log file path
-log_file_path = os.path.join(log_dir, f"logs-{time.strftime('%Y-%m-%d%H:%M:%S')}.log")
-file_handler = logging.FileHandler(log_file_path)
+# room worker processes log to a file of their own, rotation isn't safe across processes
+process_name = multiprocessing.current_process().name
+log_name = "bot.log" if process_name == "MainProcess" else f"{process_name}.log"
+log_file_path = os.path.join(log_dir, log_name)
+
+file_handler = RotatingFileHandler(
+    log_file_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+)
 stream_handler = logging.StreamHandler(sys.stdout)
 
-# Create a formatter and set it for the file handler
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 file_handler.setFormatter(formatter)
+stream_handler.setFormatter(formatter)
+
+records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+queue_handler = DroppingQueueHandler(records)
+listener = QueueListener(
+    records, file_handler, stream_handler, respect_handler_level=True
+)
+
+logger.addHandler(queue_handler)
+configure_subsystems(LOG_LEVELS, LOG_SAMPLE)
+listener.start()
+atexit.register(listener.stop)
+
+
+class LoggerTestCase(unittest.TestCase):
+    def test_sample(self):
+        sample = SampleFilter(3)
+        record = logging.LogRecord(
+            "traffic", logging.DEBUG, __file__, 0, "RECV: %s", ("line",), None
+        )
+        self.assertEqual(
+            [sample.filter(record) for _ in range(7)],
+            [True, False, False, True, False, False, True],
+        )
+
+    def test_settings(self):
+        self.assertEqual(
+            parse_settings("irc=INFO, traffic = WARNING,,broken"),
+            {"irc": "INFO", "traffic": "WARNING"},
+        )
+
+    def test_lazy(self):
+        class Expensive:
+            formatted = 0
+
+            def __str__(self) -> str:
+                Expensive.formatted += 1
+                return "expensive"
+
+        records: "queue.Queue[logging.LogRecord]" = queue.Queue(1)
+        test_logger = logging.getLogger("my_logger_test")
+        test_logger.propagate = False
+        test_logger.addHandler(DroppingQueueHandler(records))
+        test_logger.setLevel(logging.INFO)
+
+        test_logger.debug("%s", Expensive())
+        test_logger.info("%s", Expensive())
+        test_logger.info("%s", Expensive())
+        self.assertEqual(
+            Expensive.formatted, 0
+        )  # disabled, then queued unformatted, then dropped
+        self.assertEqual(records.get_nowait().getMessage(), "expensive")
+
 
-# Add the file handler to the logger
-logger.addHandler(file_handler)
-logger.addHandler(stream_handler)
+if __name__ == "__main__":
+    unittest.main()
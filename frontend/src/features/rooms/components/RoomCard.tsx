@@ -15,6 +15,7 @@ export default function RoomCard(props: IRoom) {
     team_mode,
     is_created,
     room_id,
+    shard,
     users,
     is_connected,
     id,
@@ -46,6 +47,9 @@ export default function RoomCard(props: IRoom) {
           <span>
             <b>Room ID:</b> {room_id}
           </span>
+          <span>
+            <b>Shard:</b> {shard}
+          </span>
           <span>
             <b>Bot:</b> {bot_mode}
           </span>
@@ -82,6 +86,10 @@ export default function RoomCard(props: IRoom) {
           <span>
             <b>length: </b> {beatmap.length[0]} - {beatmap.length[1]}
           </span>
+          <span>
+            <b>Maps:</b> {beatmap.status ?? "..."}
+            {beatmap.progress && ` (${beatmap.progress[0]}/${beatmap.progress[1]})`}
+          </span>
           <span>
             <b>Users:</b> {users.length ? users?.join(", ") : "..."}
           </span>
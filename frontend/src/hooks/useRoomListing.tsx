@@ -2,33 +2,41 @@ import { useEffect, useState } from "react";
 import { IRoom } from "../types/roomInterface";
 import { API } from "../data/constants";
 
+type RoomDelta = Partial<IRoom> & Pick<IRoom, "id">;
+
+function applyDelta(rooms: IRoom[], delta: RoomDelta): IRoom[] {
+  const room = rooms.find((room) => room.id === delta.id);
+
+  // a room the listing doesn't have yet arrives whole
+  if (!room) return [...rooms, delta as IRoom];
+
+  const updated = { ...room, ...delta, beatmap: { ...room.beatmap, ...delta.beatmap } };
+  return rooms.map((room) => (room.id === delta.id ? updated : room));
+}
+
 export default function useRoomListing() {
   const [roomList, setRoomList] = useState<IRoom[]>([]);
 
   useEffect(() => {
-    let isFetching = false;
-
-    async function fetchRooms() {
-      if (isFetching) return;
-      isFetching = true;
-
-      try {
-        const res = await fetch(`${API}/room`);
-        if (!res.ok) return;
-        const rooms: IRoom[] = await res.json();
-        setRoomList(rooms);
-      } catch (error) {
-        console.error(error);
-      } finally {
-        isFetching = false;
-      }
-    }
-
-    fetchRooms();
-    const fetchInterval = setInterval(() => fetchRooms(), 1000);
+    // a snapshot on every (re)connect, then only what changed
+    const events = new EventSource(`${API}/room/events`);
+
+    events.addEventListener("snapshot", (event) => {
+      setRoomList(JSON.parse((event as MessageEvent).data));
+    });
+
+    events.addEventListener("room", (event) => {
+      const delta: RoomDelta = JSON.parse((event as MessageEvent).data);
+      setRoomList((rooms) => applyDelta(rooms, delta));
+    });
+
+    events.addEventListener("removed", (event) => {
+      const { id }: RoomDelta = JSON.parse((event as MessageEvent).data);
+      setRoomList((rooms) => rooms.filter((room) => room.id !== id));
+    });
 
     return () => {
-      clearInterval(fetchInterval);
+      events.close();
     };
   }, []);
 
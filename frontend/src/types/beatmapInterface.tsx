@@ -7,4 +7,7 @@ export interface IBeatmap {
   rank_status: string[];
   genre: string;
   language: string;
+  // generated in the background after a room is made or reconfigured, not part of the form
+  status?: "pending" | "ready" | "failed";
+  progress?: [number, number];
 }
@@ -18,6 +18,7 @@ export interface IRoomForm {
 export interface IRoom extends IRoomForm {
   room_id: string;
   id: string;
+  shard: string;
   is_configured: boolean;
   is_connected: boolean;
   is_created: boolean;